@@ -0,0 +1,154 @@
+import collections
+import logging
+import time
+import traceback
+import requests
+import process
+from requests.adapters import HTTPAdapter
+from ebclient.eb_consts import EBConsts
+from ebclient.eb_request import RequestCall
+
+
+__author__ = 'dusanklinec'
+logger = logging.getLogger(__name__)
+
+
+class ApiCallStats(process.CmdStats):
+    """
+    Latency record of one API call, new_connections counts the TCP+TLS handshakes the call paid
+    """
+    def __init__(self, url=None, label=None, *args, **kwargs):
+        super(ApiCallStats, self).__init__(cmd=url, label=label)
+        self.new_connections = 0
+
+    def to_json(self):
+        js = super(ApiCallStats, self).to_json()
+        js['new_connections'] = self.new_connections
+        return js
+
+
+class ApiSession(object):
+    """
+    Keep-alive HTTPS session shared by all EnigmaBridge API requests of the process.
+    Sequential calls reuse the pooled connection instead of a new TCP+TLS handshake per call.
+    Latency of each call is recorded to the process stats collector.
+    """
+
+    def __init__(self, pool_maxsize=4, collector=None, *args, **kwargs):
+        self.pool_maxsize = pool_maxsize
+        self.collector = collector if collector is not None else process.collector
+        self.session = None
+        self.adapter = None
+
+    def get_session(self):
+        if self.session is None:
+            self.adapter = HTTPAdapter(pool_connections=2, pool_maxsize=self.pool_maxsize)
+            self.session = requests.Session()
+            self.session.mount('https://', self.adapter)
+            self.session.mount('http://', self.adapter)
+        return self.session
+
+    def get_num_connections(self, url):
+        try:
+            return self.adapter.poolmanager.connection_from_url(url).num_connections
+        except Exception:
+            return 0
+
+    def post(self, url, label=None, **kwargs):
+        """
+        POST over the shared session
+        :param url:
+        :param label: stats label, e.g., the API operation
+        :param kwargs: requests arguments
+        :return: response
+        """
+        session = self.get_session()
+        stats = ApiCallStats(url=url, label='api:%s' % label if label is not None else 'api')
+        conn_before = self.get_num_connections(url)
+        stats.time_start = time.time()
+        try:
+            resp = session.post(url, **kwargs)
+            stats.returncode = resp.status_code
+            stats.out_bytes = len(resp.content)
+            return resp
+
+        finally:
+            stats.wall = time.time() - stats.time_start
+            stats.new_connections = self.get_num_connections(url) - conn_before
+            logger.debug('API call %s: %.3f s, new connections: %d' % (stats.label, stats.wall, stats.new_connections))
+            self.collector.add(stats)
+
+    def call(self, req):
+        """
+        Calls the registration request (ebclient BaseRegistrationRequest) over the shared session
+        :param req:
+        :return: response data
+        """
+        req.build_request()
+        req.caller = PooledRequestCall(req.request, api_session=self, label=req.operation)
+
+        try:
+            req.caller.call()
+            req.response = req.caller.response
+
+            if req.response is None:
+                raise ValueError('Empty response')
+            if req.response.response is None \
+                    or 'response' not in req.response.response \
+                    or req.response.response['response'] is None:
+                raise ValueError('No result data')
+
+            return req.response.response['response']
+
+        except Exception as e:
+            logger.debug('Exception traceback: %s' % traceback.format_exc())
+            logger.info('Exception thrown %s' % e)
+            raise
+
+    def summary(self):
+        """
+        Latency and handshakes per API operation
+        :return: dict label -> {count, wall, new_connections}
+        """
+        res = collections.OrderedDict()
+        for rec in self.collector.records:
+            if not isinstance(rec, ApiCallStats):
+                continue
+            agg = res.setdefault(rec.label, {'count': 0, 'wall': 0.0, 'new_connections': 0})
+            agg['count'] += 1
+            agg['wall'] += rec.wall or 0.0
+            agg['new_connections'] += rec.new_connections
+        return res
+
+    def close(self):
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+            self.adapter = None
+
+
+class PooledRequestCall(RequestCall):
+    """
+    RequestCall posting over the shared ApiSession instead of a new connection per request
+    """
+
+    def __init__(self, request=None, response_checker=None, api_session=None, label=None, *args, **kwargs):
+        super(PooledRequestCall, self).__init__(request=request, response_checker=response_checker)
+        self.api_session = api_session
+        self.label = label
+
+    def call_once(self, request=None, *args, **kwargs):
+        if request is not None:
+            self.request = request
+
+        config = self.request.configuration
+        if config.http_method != EBConsts.HTTP_METHOD_POST or config.method != EBConsts.METHOD_REST:
+            raise ValueError('Not implemented yet, only REST POST method is allowed')
+
+        url = self.request.url if self.request.url is not None else self.build_url()
+        logger.debug("URL to call: %s", url)
+
+        resp = self.api_session.post(url, label=self.label, json=self.request.body, timeout=config.timeout,
+                                     headers=self.request.headers)
+        self.last_resp = resp
+        return self.check_response(resp)
@@ -0,0 +1,189 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+import util
+
+
+__author__ = 'dusanklinec'
+logger = logging.getLogger(__name__)
+
+
+class BuildFingerprint(object):
+    """
+    Fingerprint of the build inputs.
+    Data (e.g., generated properties) are hashed by content, source trees by path, size and mtime
+    of each file - the same up-to-date criterion ant uses, without reading the whole tree.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.hasher = hashlib.sha256()
+
+    def add_data(self, name, data):
+        self.hasher.update('data:%s:%d:' % (name, len(data)))
+        self.hasher.update(data)
+        return self
+
+    def add_file(self, path):
+        """
+        Adds the file content, missing file is recorded as missing
+        :param path:
+        :return:
+        """
+        if not os.path.isfile(path):
+            return self.add_data(path, '<missing>')
+        with open(path, 'rb') as f:
+            return self.add_data(path, f.read())
+
+    def add_tree(self, root, exclude=None):
+        """
+        Adds the directory tree
+        :param root:
+        :param exclude: relative paths (dirs or files) to skip
+        :return:
+        """
+        exclude = set(os.path.normpath(x) for x in (exclude if exclude is not None else []))
+        for dirpath, dirnames, filenames in os.walk(root):
+            rel_dir = os.path.relpath(dirpath, root)
+            dirnames[:] = sorted(x for x in dirnames if os.path.normpath(os.path.join(rel_dir, x)) not in exclude)
+            for fname in sorted(filenames):
+                rel = os.path.normpath(os.path.join(rel_dir, fname))
+                if rel in exclude:
+                    continue
+                try:
+                    st = os.lstat(os.path.join(dirpath, fname))
+                except OSError:
+                    continue
+                self.hasher.update('file:%s:%d:%d\n' % (rel, st.st_size, int(st.st_mtime)))
+        return self
+
+    def hexdigest(self):
+        return self.hasher.hexdigest()
+
+
+class BuildCache(object):
+    """
+    Local cache of build artifacts keyed by the build fingerprint.
+    Each entry is a directory with the artifacts (files or directories) and a manifest.
+    Only the most recent entries are kept.
+    """
+    MANIFEST = 'manifest.json'
+
+    def __init__(self, cache_dir, keep=2, *args, **kwargs):
+        self.cache_dir = cache_dir
+        self.keep = keep
+
+    def get_entry_dir(self, fingerprint):
+        return os.path.join(self.cache_dir, fingerprint)
+
+    def get_manifest(self, fingerprint):
+        """
+        Returns the manifest of the complete cache entry, None if there is no such entry
+        :param fingerprint:
+        :return:
+        """
+        manifest_path = os.path.join(self.get_entry_dir(fingerprint), self.MANIFEST)
+        if not os.path.exists(manifest_path):
+            return None
+        try:
+            with open(manifest_path, 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError) as e:
+            logger.debug('Invalid cache manifest %s: %s' % (manifest_path, e))
+            return None
+
+    def has(self, fingerprint, names=None):
+        """
+        True if the cache has the complete entry with the given artifacts
+        :param fingerprint:
+        :param names: required artifacts, all by default
+        :return:
+        """
+        manifest = self.get_manifest(fingerprint)
+        if manifest is None:
+            return False
+        for name in (names if names is not None else manifest['artifacts']):
+            if name not in manifest['artifacts'] \
+                    or not os.path.exists(os.path.join(self.get_entry_dir(fingerprint), name)):
+                return False
+        return True
+
+    def get_path(self, fingerprint, name):
+        if not self.has(fingerprint, [name]):
+            return None
+        return os.path.join(self.get_entry_dir(fingerprint), name)
+
+    def store(self, fingerprint, artifacts):
+        """
+        Stores the artifacts to the cache. The manifest is written last, incomplete entry is never used.
+        :param fingerprint:
+        :param artifacts: dict name -> path of the built file / directory
+        :return: entry directory
+        """
+        util.make_or_verify_dir(self.cache_dir, mode=0o755)
+        entry_dir = self.get_entry_dir(fingerprint)
+        if os.path.exists(entry_dir):
+            shutil.rmtree(entry_dir)
+        os.mkdir(entry_dir, 0o755)
+
+        for name, path in artifacts.items():
+            dst = os.path.join(entry_dir, name)
+            if os.path.isdir(path):
+                shutil.copytree(path, dst, symlinks=True)
+            else:
+                shutil.copy2(path, dst)
+
+        with util.safe_open(os.path.join(entry_dir, self.MANIFEST), chmod=0o644) as f:
+            f.write(json.dumps({'fingerprint': fingerprint, 'time': time.time(),
+                                'artifacts': sorted(artifacts.keys())}, indent=2))
+
+        self.prune(exclude=[fingerprint])
+        return entry_dir
+
+    def restore(self, fingerprint, name, dst):
+        """
+        Copies the cached artifact to the destination, existing destination is replaced
+        :param fingerprint:
+        :param name:
+        :param dst:
+        :return: True if restored
+        """
+        src = self.get_path(fingerprint, name)
+        if src is None:
+            return False
+
+        if os.path.isdir(dst):
+            shutil.rmtree(dst)
+        elif os.path.exists(dst):
+            os.remove(dst)
+
+        if os.path.isdir(src):
+            shutil.copytree(src, dst, symlinks=True)
+        else:
+            shutil.copy2(src, dst)
+        return True
+
+    def prune(self, exclude=None):
+        """
+        Removes the oldest entries over the limit
+        :param exclude: entries to keep
+        :return:
+        """
+        if not os.path.isdir(self.cache_dir):
+            return
+        exclude = exclude if exclude is not None else []
+        entries = []
+        for fingerprint in os.listdir(self.cache_dir):
+            manifest = self.get_manifest(fingerprint)
+            if fingerprint not in exclude:
+                entries.append((manifest['time'] if manifest is not None else 0, fingerprint))
+
+        entries.sort(reverse=True)
+        for _, fingerprint in entries[max(0, self.keep - len(exclude)):]:
+            shutil.rmtree(self.get_entry_dir(fingerprint), ignore_errors=True)
+
+    def clear(self):
+        if os.path.isdir(self.cache_dir):
+            shutil.rmtree(self.cache_dir)
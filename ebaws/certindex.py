@@ -0,0 +1,185 @@
+import calendar
+import hashlib
+import json
+import logging
+import os
+import time
+from consts import CONFIG_DIR, CERT_INDEX_FILE
+
+
+__author__ = 'dusanklinec'
+logger = logging.getLogger(__name__)
+
+
+class CertIndex(object):
+    """
+    Persisted index of the certificates under the LetsEncrypt live directory:
+    path -> (mtime, inode, size, sha256, not_after, SANs).
+
+    Certificates are parsed only when the file changed (mtime / inode / size), so the periodic
+    renewal checks answer from the index. cryptography is imported only for parsing.
+    """
+    LE_CERT_PATH = '/etc/letsencrypt/live'
+    CERT_FILES = ['cert.pem', 'chain.pem', 'fullchain.pem']
+
+    # Expiry check result codes, compatible with LetsEncrypt.test_certificate_for_renew
+    OK = 0
+    MISSING = 1
+    EMPTY = 2
+    INVALID = 3
+    EXPIRED = 4
+    RENEW = 5
+
+    def __init__(self, path=None, root=None, *args, **kwargs):
+        self.path = path if path is not None else os.path.join(CONFIG_DIR, CERT_INDEX_FILE)
+        self.root = root if root is not None else self.LE_CERT_PATH
+        self.entries = {}
+        self.dirty = False
+
+    def load(self):
+        """
+        Loads the index, invalid / missing index is treated as empty
+        :return: self
+        """
+        self.entries = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r') as f:
+                    self.entries = json.load(f).get('entries', {})
+            except (IOError, ValueError) as e:
+                logger.debug('Could not load the certificate index %s: %s' % (self.path, e))
+        self.dirty = False
+        return self
+
+    def save(self):
+        """
+        Writes the index if it changed
+        :return:
+        """
+        if not self.dirty:
+            return
+        tmp_path = self.path + '.tmp'
+        with os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644), 'w') as f:
+            f.write(json.dumps({'time': time.time(), 'root': self.root, 'entries': self.entries}, indent=2))
+        os.rename(tmp_path, self.path)
+        self.dirty = False
+
+    def get_cert_file(self, domain):
+        return os.path.join(self.root, domain, 'cert.pem')
+
+    @staticmethod
+    def stat_key(st):
+        return {'mtime': st.st_mtime, 'inode': st.st_ino, 'size': st.st_size}
+
+    @staticmethod
+    def parse(data):
+        """
+        Parses the first certificate in the PEM data
+        :param data:
+        :return: (not_after epoch seconds, list of SANs)
+        """
+        from cryptography import x509
+        from cryptography.hazmat.backends import default_backend
+
+        cert = x509.load_pem_x509_certificate(data, default_backend())
+        try:
+            ext = cert.extensions.get_extension_for_class(x509.SubjectAlternativeName)
+            sans = ext.value.get_values_for_type(x509.DNSName)
+        except x509.ExtensionNotFound:
+            sans = []
+        return calendar.timegm(cert.not_valid_after.utctimetuple()), sorted(sans)
+
+    def refresh(self, path):
+        """
+        Returns the up-to-date index entry of the file, re-parses the file only if it changed
+        :param path:
+        :return: entry dict, None if the file does not exist
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            if path in self.entries:
+                del self.entries[path]
+                self.dirty = True
+            return None
+
+        entry = self.entries.get(path)
+        key = self.stat_key(st)
+        if entry is not None and all(entry.get(k) == v for k, v in key.items()):
+            return entry
+
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        entry = dict(key)
+        entry['sha256'] = hashlib.sha256(data).hexdigest()
+        entry['not_after'] = None
+        entry['sans'] = []
+        if len(data) > 0:
+            try:
+                entry['not_after'], entry['sans'] = self.parse(data)
+            except Exception as e:
+                logger.debug('Could not parse the certificate %s: %s' % (path, e))
+
+        self.entries[path] = entry
+        self.dirty = True
+        return entry
+
+    def update(self):
+        """
+        Incrementally updates the index with all certificates under the root
+        :return: True if the index changed
+        """
+        paths = set()
+        if os.path.isdir(self.root):
+            for domain in os.listdir(self.root):
+                for fname in self.CERT_FILES:
+                    path = os.path.join(self.root, domain, fname)
+                    if os.path.exists(path):
+                        paths.add(path)
+
+        for path in list(self.entries.keys()):
+            if path not in paths and path.startswith(self.root + os.sep):
+                del self.entries[path]
+                self.dirty = True
+
+        for path in paths:
+            self.refresh(path)
+        return self.dirty
+
+    def check_expiry(self, path, renewal_before=60*60*24*30, now=None):
+        """
+        Checks whether the certificate needs a renewal
+        :param path: certificate file
+        :param renewal_before: renew if the certificate expires sooner, in seconds
+        :param now: current epoch time
+        :return: result code, OK if no renewal is needed
+        """
+        entry = self.refresh(path)
+        if entry is None:
+            return self.MISSING
+        if entry['size'] == 0:
+            return self.EMPTY
+        if entry['not_after'] is None:
+            return self.INVALID
+
+        remaining = entry['not_after'] - (now if now is not None else time.time())
+        if remaining <= 0:
+            return self.EXPIRED
+        if remaining < renewal_before:
+            return self.RENEW
+        return self.OK
+
+    def check_domain(self, domain, renewal_before=60*60*24*30, domains=None):
+        """
+        Checks the domain certificate needs a renewal, also if it does not cover all the domains
+        :param domain: certificate name (directory in the live dir)
+        :param renewal_before:
+        :param domains: domains the certificate has to cover
+        :return: result code
+        """
+        path = self.get_cert_file(domain)
+        res = self.check_expiry(path, renewal_before=renewal_before)
+        if res == self.OK and domains is not None and not set(domains).issubset(self.entries[path]['sans']):
+            return self.INVALID
+        return res
@@ -9,23 +9,24 @@ import pid
 import time
 import util
 import errors
+import process
+import tasks
+import precheck
+import certindex
+import daemon
 import textwrap
-from blessed import Terminal
 from consts import *
 from core import Core
 from config import Config, EBSettings
-from registration import Registration, InfoLoader
 from softhsm import SoftHsmV1Config
-from ejbca import Ejbca
 from ebsysconfig import SysConfig
 from letsencrypt import LetsEncrypt
 from ebclient.registration import ENVIRONMENT_PRODUCTION, ENVIRONMENT_DEVELOPMENT, ENVIRONMENT_TEST
-from pkg_resources import get_distribution, DistributionNotFound
-import logging, coloredlogs
+import version
+import logging
 
 
 logger = logging.getLogger(__name__)
-coloredlogs.install(level=logging.ERROR)
 
 
 class App(Cmd):
@@ -37,6 +38,9 @@ class App(Cmd):
     PROCEED_NO = 'no'
     PROCEED_QUIT = 'quit'
 
+    # Certificate is renewed if it expires sooner
+    RENEWAL_BEFORE = precheck.RENEWAL_BEFORE
+
     def __init__(self, *args, **kwargs):
         """
         Init core
@@ -64,36 +68,30 @@ class App(Cmd):
 
         self.noninteractive = False
         self.version = self.load_version()
-        self.first_run = self.is_first_run()
+        self.first_run = None
 
         self.debug_simulate_vpc = False
 
-        self.t = Terminal()
-        self.update_intro()
+        # Terminal is created on the first use, intro is built in app_main
+        self._term = None
+
+    @property
+    def t(self):
+        if self._term is None:
+            from blessed import Terminal
+            self._term = Terminal()
+        return self._term
 
     def load_version(self):
-        dist = None
-        version = None
-        try:
-            dist = get_distribution(self.PIP_NAME)
-            dist_loc = os.path.normcase(dist.location)
-            here = os.path.normcase(__file__)
-            if not here.startswith(dist_loc):
-                raise DistributionNotFound
-            else:
-                version = dist.version
-        except:
-            version = 'Trunk'
-        return version
+        return version.__version__
 
     def is_first_run(self):
-        try:
-            config = Core.read_configuration()
-            return config is None or config.has_nonempty_config()
-        except:
-            return True
+        return precheck.read_config() is None
 
     def update_intro(self):
+        if self.first_run is None:
+            self.first_run = self.is_first_run()
+
         self.intro = '-'*self.get_term_width() + \
                      ('\n    Enigma Bridge AWS command line interface (v%s) \n' % self.version) + \
                      '\n    usage - shows simple command list' + \
@@ -136,6 +134,8 @@ class App(Cmd):
         Previous configuration data is backed up.
         :type line: object
         """
+        from registration import Registration
+        from ejbca import Ejbca
         if not self.check_root() or not self.check_pid():
             return self.return_code(1)
 
@@ -155,16 +155,28 @@ class App(Cmd):
         # Configuration read, if any
         self.config = Core.read_configuration()
         config_exists = self.config is not None and self.config.has_nonempty_config()
-        previous_registration_continue = False
-
-        # there may be 2-stage registration waiting to finish - continue with the registration
-        if config_exists and self.config.two_stage_registration_waiting:
-            print('\nThere is a previous unfinished registration for email: %s' % self.config.email)
-            should_continue = self.ask_proceed(question='Do you want to continue with this registration? (y/n): ',
-                                               support_non_interactive=True)
-            previous_registration_continue = should_continue
-
-        if config_exists and not previous_registration_continue:
+        # JBoss management user of the previous installation is reused
+        mgmt_password = self.config.jboss_mgmt_password if config_exists else None
+        journal = tasks.TaskJournal(Core.get_journal_path('init'))
+        journal.load()
+        resume = False
+
+        # Previous installation may be unfinished, e.g., 2-stage registration waiting for the challenge
+        # or a failed step - continue from the failed step.
+        if config_exists and (journal.is_unfinished() or self.config.two_stage_registration_waiting):
+            print('\nThere is a previous unfinished installation for email: %s' % self.config.email)
+            failed_step = journal.get_failed_step()
+            if failed_step is None and self.config.two_stage_registration_waiting:
+                failed_step = 'registration'
+            if failed_step is not None:
+                print('The installation stopped in the step: %s' % failed_step)
+            resume = self.ask_proceed(question='Do you want to continue with this installation? (y/n): ',
+                                      support_non_interactive=True)
+
+        if not resume:
+            journal.reset()
+
+        if config_exists and not resume:
             print(self.t.red('\nWARNING! This is a destructive process!'))
             print(self.t.red('WARNING! The previous installation will be overwritten.\n'))
             should_continue = self.ask_proceed(support_non_interactive=True)
@@ -185,7 +197,7 @@ class App(Cmd):
         # noinspection PyBroadException
         try:
             self.eb_cfg = Core.get_default_eb_config()
-            if previous_registration_continue:
+            if resume:
                 self.config.eb_config = self.eb_cfg
             else:
                 self.config = Config(eb_config=self.eb_cfg)
@@ -205,7 +217,7 @@ class App(Cmd):
             self.reg_svc.load_auth_types()
 
             # Show email prompt and intro text only for new initializations.
-            if not previous_registration_continue:
+            if not resume:
                 # Ask for email if we don't have any (e.g., previous unfinished reg).
                 self.email = self.ask_for_email(is_required=self.reg_svc.is_email_required())
                 if isinstance(self.email, types.IntType):
@@ -227,169 +239,66 @@ class App(Cmd):
                 self.email = self.config.email
 
             # System check proceeds (mem, network).
-            # We do this even if we continue with previous registration, to have fresh view on the system.
+            # We do this even if we continue with previous installation, to have fresh view on the system.
             # Check if we have EJBCA resources on the drive
             if not self.ejbca.test_environment():
                 print(self.t.red('\nError: Environment is damaged, some assets are missing for the key management '
                                  'installation. Cannot continue.'))
                 return self.return_code(1)
 
-            # Determine if we have enough RAM for the work.
-            # If not, a new swap file is created so the system has at least 2GB total memory space
-            # for compilation & deployment.
-            ret = self.install_check_memory(syscfg=self.syscfg)
-            if ret != 0:
-                return self.return_code(1)
-
             # Preferred LE method? If set...
-            args_le_preferred_method = self.get_args_le_verification()
-            args_is_vpc = self.get_args_vpc()
             self.last_is_vpc = False
+            ctx = {
+                'le_method_arg': self.get_args_le_verification(),
+                'is_vpc_arg': self.get_args_vpc(),
+                'jboss_mgmt_password_arg': mgmt_password,
+            }
+
+            # Installation steps: independent steps run in parallel, interactive ones on this thread.
+            # JBoss is restarted in the background while the registration takes place,
+            # the original EJBCA and its database are removed only after the new configuration is saved.
+            # Checkpoint steps are journaled, re-run after a failure continues from the failed step.
+            graph = tasks.TaskGraph(name='init', journal=journal)
+            graph.add('memory', self.init_task_memory, outputs=['memory_ok'])
+            graph.add('jboss_start', self.init_task_jboss_start, inputs=['memory_ok', 'jboss_mgmt_password_arg'],
+                      outputs=['jboss_ready', 'jboss_mgmt_password'], checkpoint=True)
+            graph.add('le_port', self.init_task_le_port, inputs=['le_method_arg', 'is_vpc_arg'],
+                      outputs=['le_method', 'is_vpc'], interactive=True, checkpoint=True,
+                      restore=self.init_restore_le_port)
+            graph.add('registration', self.init_task_registration, outputs=['registered'], interactive=True,
+                      checkpoint=True, fingerprint=self.init_fingerprint_registration,
+                      restore=self.init_restore_registration)
+            graph.add('domains', self.init_task_domains, inputs=['registered', 'le_method', 'is_vpc'],
+                      outputs=['new_config', 'domain_is_ok'], interactive=True, checkpoint=True,
+                      restore=self.init_restore_domains)
+            graph.add('save_config', self.init_task_save_config, inputs=['new_config'], outputs=['config_saved'],
+                      checkpoint=True)
+            graph.add('softhsm', self.init_task_softhsm, inputs=['config_saved'], outputs=['softhsm_ready'],
+                      checkpoint=True, restore=self.init_restore_softhsm)
+            graph.add('ejbca', self.init_task_ejbca, inputs=['config_saved', 'jboss_ready', 'jboss_mgmt_password'],
+                      outputs=['ejbca_installed'], checkpoint=True, restore=self.init_restore_ejbca,
+                      invalidates=['jboss_start'])
+            graph.add('keys', self.init_task_keys, inputs=['ejbca_installed', 'softhsm_ready'],
+                      outputs=['keys_generated'], checkpoint=True, optional=True)
+            graph.add('token', self.init_task_token, inputs=['ejbca_installed', 'softhsm_ready'],
+                      outputs=['token_added'], after=['keys'], checkpoint=True, optional=True)
+            graph.add('le_install', self.init_task_le_install, inputs=['ejbca_installed', 'domain_is_ok'],
+                      outputs=['le_code'], after=['token'], interactive=True, checkpoint=True, optional=True)
 
-            # Lets encrypt reachability test, if preferred method is DNS - do only one attempt.
-            # We test this to detect VPC also. If 443 is reachable, we are not in VPC
-            res, args_le_preferred_method = self.init_le_vpc_check(args_le_preferred_method,
-                                                                   args_is_vpc, reg_svc=self.reg_svc)
-            if res != 0:
-                return self.return_code(res)
-
-            # User registration may be multi-step process.
-            if previous_registration_continue:
-                tmp = 'Your validation challenge is in the ticket assigned to you in the ' \
-                      'system https://enigmabridge.freshdesk.com for account %s.' % self.email
-                print(self.wrap_term(single_string=True, max_width=self.get_term_width(), text=tmp))
-
-                self.reg_svc.reg_token = self.ask_for_token()
-
-            elif self.reg_svc.is_auth_needed():
-                self.reg_svc.init_auth()
-                Core.write_configuration(self.config)
-                self.init_print_challenge_intro()
-                self.reg_svc.reg_token = self.ask_for_token()
-
-            else:
-                # Init, but do not wait for token.
-                self.reg_svc.init_auth()
-
-            new_config = self.config
-            # Creates a new RSA key-pair identity
-            # Identity relates to bound DNS names and username.
-            # Requests for DNS manipulation need to be signed with the private key.
-            self.reg_svc.new_identity(id_dir=CONFIG_DIR, backup_dir=CONFIG_DIR_OLD)
-
-            # New client registration (new username, password, apikey).
-            # This step may require email validation to continue.
             try:
-                new_config = self.reg_svc.new_registration()
-            except Exception as e:
-                if self.debug:
-                    traceback.print_exc()
-                logger.debug('Exception in registration: %s' % e)
+                res = graph.run(ctx)
+            finally:
+                self.ejbca.jvm_session_close()
 
-                if self.reg_svc.is_auth_needed():
-                    print(self.t.red('Error in the registration, probably problem with the challenge. '))
-                else:
-                    print(self.t.red('Error in the registration'))
-                print('Please, try again. If problem persists, '
-                      'please contact our support at https://enigmabridge.freshdesk.com')
-                return self.return_code(14)
-
-            # Custom hostname for EJBCA - not yet supported
-            new_config.ejbca_hostname_custom = False
-            new_config.is_private_network = self.last_is_vpc
-            new_config.le_preferred_verification = args_le_preferred_method
-
-            # Assign a new dynamic domain for the host
-            res, domain_is_ok = self.init_domains_check(reg_svc=self.reg_svc)
-            new_config = self.reg_svc.config
+            self.print_task_report(graph)
             if res != 0:
+                print('\nThe installation can be continued from the failed step by running init again.')
                 return self.return_code(res)
 
-            # Install to the OS
-            self.syscfg.install_onboot_check()
-            self.syscfg.install_cron_renew()
-
-            # Dump config & SoftHSM
-            conf_file = Core.write_configuration(new_config)
-            print('New configuration was written to: %s\n' % conf_file)
-
-            # SoftHSMv1 reconfigure
-            soft_config_backup_location = self.soft_config.backup_current_config_file()
-            if soft_config_backup_location is not None:
-                print('EnigmaBridge PKCS#11 token configuration has been backed up to: %s' % soft_config_backup_location)
-
-            self.soft_config.configure(new_config)
-            soft_config_file = self.soft_config.write_config()
-
-            print('New EnigmaBridge PKCS#11 token configuration has been written to: %s\n' % soft_config_file)
-
-            # Init the token
-            backup_dir = self.soft_config.backup_previous_token_dir()
-            if backup_dir is not None:
-                print('EnigmaBridge PKCS#11 previous token database moved to: %s' % backup_dir)
-
-            out, err = self.soft_config.init_token(user=self.ejbca.JBOSS_USER)
-            print('EnigmaBridge PKCS#11 token initialization: %s' % out)
-
-            # EJBCA configuration
-            print('Going to install PKI system')
-            print('  This may take 15 minutes or less. Please, do not interrupt the installation')
-            print('  and wait until the process completes.\n')
-
-            self.ejbca.set_config(new_config)
-            self.ejbca.set_domains(new_config.domains)
-            self.ejbca.reg_svc = self.reg_svc
-
-            self.ejbca.configure()
-
-            if self.ejbca.ejbca_install_result != 0:
-                print('\nPKI installation error. Please try again.')
-                return self.return_code(1)
-
-            Core.write_configuration(self.ejbca.config)
-            print('\nPKI installed successfully.')
-
-            # Generate new keys
-            print('\nEnigma Bridge service will generate keys for your crypto token:')
-            ret, out, err = self.ejbca.pkcs11_generate_default_key_set(softhsm=self.soft_config)
-            key_gen_cmds = [
-                    self.ejbca.pkcs11_get_generate_key_cmd(softhsm=self.soft_config,
-                                                           bit_size=2048, alias='signKey', slot_id=0),
-                    self.ejbca.pkcs11_get_generate_key_cmd(softhsm=self.soft_config,
-                                                           bit_size=2048, alias='defaultKey', slot_id=0),
-                    self.ejbca.pkcs11_get_generate_key_cmd(softhsm=self.soft_config,
-                                                           bit_size=1024, alias='testKey', slot_id=0)
-                ]
-
-            if ret != 0:
-                print('\nError generating new keys')
-                print('You can do it later manually by calling')
-
-                for tmpcmd in key_gen_cmds:
-                    print('  %s' % self.ejbca.pkcs11_get_command(tmpcmd))
-
-                print('\nError from the command:')
-                print(''.join(out))
-                print('\n')
-                print(''.join(err))
-            else:
-                print('\nEnigmaBridge tokens generated successfully')
-                print('You can use these newly generated keys for your CA or generate another ones with:')
-                for tmpcmd in key_gen_cmds:
-                    print('  %s' % self.ejbca.pkcs11_get_command(tmpcmd))
-
-            # Add SoftHSM crypto token to EJBCA
-            print('\nAdding an EnigmaBridge crypto token to your PKI instance:')
-            ret, out, err = self.ejbca.ejbca_add_softhsm_token(softhsm=self.soft_config, name='EnigmaBridgeToken')
-            if ret != 0:
-                print('\nError in adding EnigmaBridge token to the PKI instance')
-                print('You can add it manually in the PKI (EJBCA) admin page later')
-                print('Pin for the EnigmaBridge token is 0000')
-            else:
-                print('\nEnigmaBridgeToken added to the PKI instance')
-
-            # LetsEncrypt enrollment
-            le_certificate_installed = self.le_install(self.ejbca)
+            new_config = ctx['new_config']
+            domain_is_ok = ctx['domain_is_ok']
+            le_certificate_installed = ctx['le_code']
+            self.last_is_vpc = ctx['is_vpc']
 
             print('\n')
             print('-'*self.get_term_width())
@@ -456,6 +365,279 @@ class App(Cmd):
 
         return self.return_code(1)
 
+    def init_task_memory(self, ctx):
+        """
+        Determine if we have enough RAM for the work.
+        If not, a new swap file is created so the system has at least 2GB total memory space
+        for compilation & deployment.
+        """
+        ret = self.install_check_memory(syscfg=self.syscfg)
+        ctx['memory_ok'] = ret == 0
+        return ret
+
+    def init_task_jboss_start(self, ctx):
+        """
+        Restarts the application server, runs in the background. Nothing is removed here.
+        The shared config is not touched, the management password is applied on the main thread.
+        """
+        from ejbca import Ejbca
+        ejbca = Ejbca(print_output=False, staging=self.args.le_staging)
+        ret = ejbca.jboss_prepare_start(mgmt_password=ctx['jboss_mgmt_password_arg'])
+        ctx['jboss_ready'] = ret == 0
+        ctx['jboss_mgmt_password'] = ejbca.jboss_mgmt_password
+        return ret
+
+    def init_task_le_port(self, ctx):
+        """
+        Lets encrypt reachability test, if preferred method is DNS - do only one attempt.
+        We test this to detect VPC also. If 443 is reachable, we are not in VPC
+        """
+        res, ctx['le_method'] = self.init_le_vpc_check(ctx['le_method_arg'], ctx['is_vpc_arg'],
+                                                        reg_svc=self.reg_svc)
+        ctx['is_vpc'] = self.last_is_vpc
+        return res
+
+    def init_restore_le_port(self, ctx):
+        self.last_is_vpc = ctx['is_vpc']
+
+    def init_task_registration(self, ctx):
+        """
+        User registration, may be multi-step process.
+        2-stage registration waiting for the challenge continues with the challenge.
+        """
+        if self.config.two_stage_registration_waiting:
+            tmp = 'Your validation challenge is in the ticket assigned to you in the ' \
+                  'system https://enigmabridge.freshdesk.com for account %s.' % self.email
+            print(self.wrap_term(single_string=True, max_width=self.get_term_width(), text=tmp))
+
+            self.reg_svc.reg_token = self.ask_for_token()
+
+        elif self.reg_svc.is_auth_needed():
+            self.reg_svc.init_auth()
+            Core.write_configuration(self.config)
+            self.init_print_challenge_intro()
+            self.reg_svc.reg_token = self.ask_for_token()
+
+        else:
+            # Init, but do not wait for token.
+            self.reg_svc.init_auth()
+
+        # Creates a new RSA key-pair identity
+        # Identity relates to bound DNS names and username.
+        # Requests for DNS manipulation need to be signed with the private key.
+        self.reg_svc.new_identity(id_dir=CONFIG_DIR, backup_dir=CONFIG_DIR_OLD)
+
+        # New client registration (new username, password, apikey).
+        # This step may require email validation to continue.
+        try:
+            self.reg_svc.new_registration()
+        except Exception as e:
+            if self.debug:
+                traceback.print_exc()
+            logger.debug('Exception in registration: %s' % e)
+
+            if self.reg_svc.is_auth_needed():
+                print(self.t.red('Error in the registration, probably problem with the challenge. '))
+            else:
+                print(self.t.red('Error in the registration'))
+            print('Please, try again. If problem persists, '
+                  'please contact our support at https://enigmabridge.freshdesk.com')
+            return self.return_code(14)
+
+        # Registration is stored so the installation can be resumed
+        Core.write_configuration(self.config)
+        ctx['registered'] = True
+        return 0
+
+    def init_fingerprint_registration(self, ctx):
+        return {'email': self.config.email, 'env': self.config.env}
+
+    def init_restore_registration(self, ctx):
+        """
+        Registration is restored from the stored configuration and identity
+        """
+        if self.config.two_stage_registration_waiting or self.config.username is None:
+            return False
+        return self.reg_svc.load_identity() is not None
+
+    def init_task_domains(self, ctx):
+        """
+        Assign a new dynamic domain for the host
+        """
+        new_config = self.reg_svc.config
+
+        # Custom hostname for EJBCA - not yet supported
+        new_config.ejbca_hostname_custom = False
+        new_config.is_private_network = ctx['is_vpc']
+        new_config.le_preferred_verification = ctx['le_method']
+
+        res, ctx['domain_is_ok'] = self.init_domains_check(reg_svc=self.reg_svc)
+        ctx['new_config'] = self.reg_svc.config
+        return res
+
+    def init_restore_domains(self, ctx):
+        """
+        Domains are restored from the stored configuration
+        """
+        if ctx['domain_is_ok'] and not self.config.domains:
+            return False
+        ctx['new_config'] = self.reg_svc.config
+
+    def init_task_save_config(self, ctx):
+        """
+        Install to the OS, dump the configuration
+        """
+        daemon_installed = False
+        if self.args.daemon:
+            daemon_installed = self.syscfg.install_daemon() == 0
+            if not daemon_installed:
+                print('Renewal daemon could not be installed, falling back to the renewal cron job\n')
+
+        if not daemon_installed:
+            self.syscfg.install_onboot_check()
+            self.syscfg.install_cron_renew()
+
+        conf_file = Core.write_configuration(ctx['new_config'])
+        print('New configuration was written to: %s\n' % conf_file)
+        ctx['config_saved'] = True
+        return 0
+
+    def init_task_softhsm(self, ctx):
+        """
+        SoftHSMv1 reconfigure, token init
+        """
+        soft_config_backup_location = self.soft_config.backup_current_config_file()
+        if soft_config_backup_location is not None:
+            print('EnigmaBridge PKCS#11 token configuration has been backed up to: %s' % soft_config_backup_location)
+
+        self.soft_config.configure(ctx['new_config'])
+        soft_config_file = self.soft_config.write_config()
+
+        print('New EnigmaBridge PKCS#11 token configuration has been written to: %s\n' % soft_config_file)
+
+        # Init the token
+        backup_dir = self.soft_config.backup_previous_token_dir()
+        if backup_dir is not None:
+            print('EnigmaBridge PKCS#11 previous token database moved to: %s' % backup_dir)
+
+        out, err = self.soft_config.init_token(user=self.ejbca.JBOSS_USER)
+        print('EnigmaBridge PKCS#11 token initialization: %s' % out)
+        ctx['softhsm_ready'] = True
+        return 0
+
+    def init_restore_softhsm(self, ctx):
+        self.soft_config.configure(ctx['new_config'])
+
+    def init_task_ejbca(self, ctx):
+        """
+        EJBCA configuration, application server is already running
+        """
+        new_config = ctx['new_config']
+        if ctx['jboss_mgmt_password'] is not None:
+            new_config.jboss_mgmt_password = ctx['jboss_mgmt_password']
+
+        print('Going to install PKI system')
+        print('  This may take 15 minutes or less. Please, do not interrupt the installation')
+        print('  and wait until the process completes.\n')
+
+        self.ejbca.set_config(new_config)
+        self.ejbca.set_domains(new_config.domains)
+        self.ejbca.reg_svc = self.reg_svc
+
+        # Original EJBCA and its database are removed only now, the new configuration is saved
+        ret = self.ejbca.jboss_prepare_clean()
+        if ret != 0:
+            return ret
+
+        self.ejbca.configure(prepare=False)
+
+        if self.ejbca.ejbca_install_result != 0:
+            print('\nPKI installation error. Please try again.')
+            return self.return_code(1)
+
+        Core.write_configuration(self.ejbca.config)
+        print('\nPKI installed successfully.')
+        ctx['ejbca_installed'] = True
+        return 0
+
+    def init_restore_ejbca(self, ctx):
+        """
+        Installed EJBCA, passwords are loaded from the backup
+        """
+        new_config = ctx['new_config']
+        self.ejbca.set_config(new_config)
+        self.ejbca.set_domains(new_config.domains)
+        self.ejbca.reg_svc = self.reg_svc
+        return self.ejbca.load_passwords() is not None
+
+    def init_task_keys(self, ctx):
+        """
+        Generates new keys in the EnigmaBridge token
+        """
+        print('\nEnigma Bridge service will generate keys for your crypto token:')
+        ret, out, err = self.ejbca.pkcs11_generate_default_key_set(softhsm=self.soft_config)
+        key_gen_cmds = [
+                self.ejbca.pkcs11_get_generate_key_cmd(softhsm=self.soft_config,
+                                                       bit_size=2048, alias='signKey', slot_id=0),
+                self.ejbca.pkcs11_get_generate_key_cmd(softhsm=self.soft_config,
+                                                       bit_size=2048, alias='defaultKey', slot_id=0),
+                self.ejbca.pkcs11_get_generate_key_cmd(softhsm=self.soft_config,
+                                                       bit_size=1024, alias='testKey', slot_id=0)
+            ]
+
+        if ret != 0:
+            print('\nError generating new keys')
+            print('You can do it later manually by calling')
+
+            for tmpcmd in key_gen_cmds:
+                print('  %s' % self.ejbca.pkcs11_get_user_command(tmpcmd))
+
+            print('\nError from the command:')
+            print(''.join(out))
+            print('\n')
+            print(''.join(err))
+        else:
+            print('\nEnigmaBridge tokens generated successfully')
+            print('You can use these newly generated keys for your CA or generate another ones with:')
+            for tmpcmd in key_gen_cmds:
+                print('  %s' % self.ejbca.pkcs11_get_user_command(tmpcmd))
+
+        ctx['keys_generated'] = ret == 0
+        return ret
+
+    def init_task_token(self, ctx):
+        """
+        Adds SoftHSM crypto token to EJBCA
+        """
+        print('\nAdding an EnigmaBridge crypto token to your PKI instance:')
+        ret, out, err = self.ejbca.ejbca_add_softhsm_token(softhsm=self.soft_config, name='EnigmaBridgeToken')
+        if ret != 0:
+            print('\nError in adding EnigmaBridge token to the PKI instance')
+            print('You can add it manually in the PKI (EJBCA) admin page later')
+            print('Pin for the EnigmaBridge token is 0000')
+        else:
+            print('\nEnigmaBridgeToken added to the PKI instance')
+
+        ctx['token_added'] = ret == 0
+        return ret
+
+    def init_task_le_install(self, ctx):
+        """
+        LetsEncrypt enrollment
+        """
+        ctx['le_code'] = self.le_install(self.ejbca)
+        return ctx['le_code']
+
+    def print_task_report(self, graph):
+        """
+        Prints per-step timings in the verbose mode
+        :param graph:
+        :return:
+        """
+        if self.args.verbose or self.args.debug:
+            print('\nStep timings:')
+            print(graph.format_report())
+
     def init_print_intro(self):
         """
         Prints introduction text before the installation.
@@ -647,34 +829,86 @@ class App(Cmd):
         # Update configuration
         Core.write_configuration(config)
 
-        # If there is no hostname, enrollment probably failed.
-        eb_cfg = Core.get_default_eb_config()
+        # Nothing to do - answered from the certificate index, no network / identity needed
+        if self.renew_precheck(config):
+            print('\nRenewal for %s is not needed now. Run with --force to override this' % config.ejbca_hostname)
+            return self.return_code(0)
 
-        # Registration - for domain updates. Identity should already exist.
-        reg_svc = Registration(email=config.email, eb_config=eb_cfg, config=config, debug=self.args.debug)
+        # Identity, certificate state and port check are independent.
+        # Port check may ask the user, it runs on the main thread.
+        ctx = {'config': config, 'domains': domains}
+        graph = tasks.TaskGraph(name='renew')
+        graph.add('identity', self.renew_task_identity, inputs=['config'], outputs=['reg_svc'])
+        graph.add('cert_check', self.renew_task_cert_check, inputs=['config', 'domains'],
+                  outputs=['ejbca', 'enroll_new_cert'])
+        graph.add('port_check', self.renew_task_port_check, inputs=['config'], outputs=['port_ok'],
+                  interactive=True)
+        graph.add('certificate', self.renew_task_certificate, inputs=['reg_svc', 'ejbca', 'enroll_new_cert', 'port_ok'])
+
+        ret = graph.run(ctx)
+        self.print_task_report(graph)
+        return self.return_code(ret)
+
+    def renew_precheck(self, config):
+        """
+        Decides from the configuration and the certificate index whether the renewal can be skipped.
+        Certificates are not loaded unless changed, no network bound objects are created.
+        :param config:
+        :return: True if there is nothing to do
+        """
+        if self.args.force:
+            return False
+
+        return not precheck.is_renewal_needed(config.ejbca_hostname, domains=config.ejbca_domains,
+                                              renewal_before=self.RENEWAL_BEFORE)
+
+    def renew_task_identity(self, ctx):
+        """
+        Registration - for domain updates. Identity should already exist.
+        """
+        from registration import Registration
+        eb_cfg = Core.get_default_eb_config()
+        reg_svc = Registration(email=ctx['config'].email, eb_config=eb_cfg, config=ctx['config'],
+                               debug=self.args.debug)
         ret = reg_svc.load_identity()
         if ret != 0:
-                print('\nError! Could not load identity (key-pair is missing)')
-                return self.return_code(3)
+            print('\nError! Could not load identity (key-pair is missing)')
+            return self.return_code(3)
+
+        ctx['reg_svc'] = reg_svc
+        return 0
 
-        # EJBCA
+    def renew_task_cert_check(self, ctx):
+        """
+        Determines whether a new certificate has to be enrolled or the current one renewed
+        """
+        from ejbca import Ejbca
+        config = ctx['config']
         ejbca = Ejbca(print_output=True, jks_pass=config.ejbca_jks_password, config=config,
                       staging=self.args.le_staging)
         ejbca.set_domains(config.ejbca_domains)
-        ejbca.reg_svc = reg_svc
 
+        # If there is no hostname, enrollment probably failed.
         ejbca_host = ejbca.hostname
 
         le_test = LetsEncrypt(staging=self.args.le_staging)
         enroll_new_cert = ejbca_host is None or len(ejbca_host) == 0 or ejbca_host == 'localhost'
         if enroll_new_cert:
-            ejbca.set_domains(domains)
+            ejbca.set_domains(ctx['domains'])
             ejbca_host = ejbca.hostname
 
         if not enroll_new_cert:
             enroll_new_cert = le_test.is_certificate_ready(domain=ejbca_host) != 0
 
-        # Test LetsEncrypt port - only if in non-private network
+        ctx['ejbca'] = ejbca
+        ctx['enroll_new_cert'] = enroll_new_cert
+        return 0
+
+    def renew_task_port_check(self, ctx):
+        """
+        Test LetsEncrypt port - only if in non-private network
+        """
+        config = ctx['config']
         require_443_test = True
         if config.is_private_network:
             require_443_test = False
@@ -684,19 +918,75 @@ class App(Cmd):
             require_443_test = False
             print('\nPreferred LetsEncrypt verification method is DNS, skipping TCP port 443 check')
 
+        ctx['port_ok'] = True
         if require_443_test:
-            port_ok = self.le_check_port(critical=True)
-            if not port_ok:
+            ctx['port_ok'] = self.le_check_port(critical=True)
+            if not ctx['port_ok']:
                 return self.return_code(10)
+        return 0
 
-        ret = 0
-        if enroll_new_cert:
-            # Enroll a new certificate
-            ret = self.le_install(ejbca)
+    def renew_task_certificate(self, ctx):
+        """
+        Enrolls a new certificate or renews the current one
+        """
+        ejbca = ctx['ejbca']
+        ejbca.reg_svc = ctx['reg_svc']
+        if ctx['enroll_new_cert']:
+            return self.le_install(ejbca)
         else:
-            # Renew the certs
-            ret = self.le_renew(ejbca)
-        return self.return_code(ret)
+            return self.le_renew(ejbca)
+
+    def do_daemon(self, line):
+        """Resident service replacing the renew cron job and the onboot check, runs until terminated"""
+        if not self.check_root():
+            return self.return_code(1)
+
+        config = Core.read_configuration()
+        if config is None or not config.has_nonempty_config():
+            print('\nError! Enigma config file not found %s' % (Core.get_config_file_path()))
+            print(' Cannot continue. Have you run init already?\n')
+            return self.return_code(1)
+
+        # Actions run in this process, exclusive lock is held only during the action
+        self.noninteractive = True
+        index = certindex.CertIndex().load()
+
+        def locked(action):
+            try:
+                return action('')
+            finally:
+                self.core.pidlock_release()
+
+        daemon_svc = daemon.RenewalDaemon(renew=lambda: locked(self.do_renew),
+                                          onboot=lambda: locked(self.do_onboot),
+                                          get_not_after=lambda: self.daemon_get_not_after(index),
+                                          get_ip=self.daemon_get_ip,
+                                          schedule=daemon.RenewalSchedule(renewal_before=self.RENEWAL_BEFORE))
+        daemon_svc.install_signals()
+        daemon_svc.run()
+        return self.return_code(0)
+
+    def daemon_get_not_after(self, index):
+        """
+        Expiration of the current certificate from the in-memory certificate index
+        :param index:
+        :return: epoch seconds, None if there is no valid certificate
+        """
+        config = precheck.read_config()
+        hostname = config.get('ejbca_hostname') if config is not None else None
+        if hostname is None or precheck.is_renewal_needed(hostname, domains=config.get('ejbca_domains'),
+                                                          renewal_before=0, index=index):
+            return None
+        return index.entries[index.get_cert_file(hostname)]['not_after']
+
+    def daemon_get_ip(self):
+        """
+        Current IP addresses of the host (public, private)
+        """
+        from registration import InfoLoader
+        info = InfoLoader()
+        info.invalidate_ip()
+        return info.ami_public_ip, info.ami_local_ip
 
     def do_onboot(self, line):
         """Command called by the init script/systemd on boot, takes care about IP re-registration"""
@@ -709,83 +999,17 @@ class App(Cmd):
             print(' Cannot continue. Have you run init already?\n')
             return self.return_code(2)
 
-        eb_cfg = Core.get_default_eb_config()
         try:
-            reg_svc = Registration(email=config.email, eb_config=eb_cfg, config=config, debug=self.args.debug)
-            domains = config.domains
-            if domains is not None and isinstance(domains, types.ListType) and len(domains) > 0:
-                print('\nDomains currently registered: ')
-                for dom in config.domains:
-                    print('  - %s' % dom)
-                print('')
-
-            if config.ejbca_hostname is not None:
-                print('Domain used for your PKI system: %s\n' % config.ejbca_hostname)
-
-            # Identity load (keypair)
-            ret = reg_svc.load_identity()
-            if ret != 0:
-                print('\nError! Could not load identity (key-pair is missing)')
-                return self.return_code(3)
-
-            # IP has changed?
-            if config.is_private_network:
-                if config.last_ipv4_private is not None:
-                    print('Last local IPv4 used for domain registration: %s' % config.last_ipv4_private)
-                print('Current local IPv4: %s' % reg_svc.info_loader.ami_local_ip)
-            else:
-                if config.last_ipv4 is not None:
-                    print('Last IPv4 used for domain registration: %s' % config.last_ipv4)
-                print('Current IPv4: %s' % reg_svc.info_loader.ami_public_ip)
-
-            # Assign a new dynamic domain for the host
-            domain_is_ok = False
-            domain_ctr = 0
-            new_config = config
-            while not domain_is_ok:
-                try:
-                    new_config = reg_svc.refresh_domain()
-
-                    if new_config.domains is not None and len(new_config.domains) > 0:
-                        domain_is_ok = True
-                        print('\nNew domains registered for this host: ')
-                        for domain in new_config.domains:
-                            print('  - %s' % domain)
-                        print('')
-
-                except Exception as e:
-                    domain_ctr += 1
-                    if self.args.debug:
-                        traceback.print_exc()
-
-                    print('\nError during domain registration, no dynamic domain will be assigned')
-                    if self.noninteractive:
-                        if domain_ctr >= self.args.attempts:
-                            break
-                    else:
-                        should_continue = self.ask_proceed('Do you want to try again? (Y/n): ')
-                        if not should_continue:
-                            break
-
-            # Is it OK if domain assignment failed?
-            if not domain_is_ok:
-                print('\nDomain could not be assigned. You can try domain reassign later.')
-                return self.return_code(1)
-
-            new_config.last_ipv4 = reg_svc.info_loader.ami_public_ip
-            new_config.last_ipv4_private = reg_svc.info_loader.ami_local_ip
-
-            # Is original hostname used in the EJBCA in domains?
-            if new_config.ejbca_hostname is not None \
-                    and not new_config.ejbca_hostname_custom \
-                    and new_config.ejbca_hostname not in new_config.domains:
-                print('\nWarning! Returned domains do not correspond to the domain used during EJBCA installation %s'
-                      % new_config.ejbca_hostname)
-                print('\nThe PKI instance must be redeployed. This operations is not yet supported, please email '
-                      'to support@enigmabridge.com')
+            ctx = {'config': config}
+            graph = tasks.TaskGraph(name='onboot')
+            graph.add('identity', self.onboot_task_identity, inputs=['config'], outputs=['reg_svc'])
+            graph.add('domains', self.onboot_task_domains, inputs=['config', 'reg_svc'], outputs=['new_config'],
+                      interactive=True)
+            graph.add('save_config', self.onboot_task_save_config, inputs=['reg_svc', 'new_config'])
 
-            Core.write_configuration(new_config)
-            return self.return_code(0)
+            ret = graph.run(ctx)
+            self.print_task_report(graph)
+            return self.return_code(ret)
 
         except Exception as ex:
             traceback.print_exc()
@@ -793,6 +1017,104 @@ class App(Cmd):
 
         return self.return_code(1)
 
+    def onboot_task_identity(self, ctx):
+        """
+        Loads the identity (keypair), reports IP change
+        """
+        from registration import Registration
+        config = ctx['config']
+        eb_cfg = Core.get_default_eb_config()
+        reg_svc = Registration(email=config.email, eb_config=eb_cfg, config=config, debug=self.args.debug)
+        domains = config.domains
+        if domains is not None and isinstance(domains, types.ListType) and len(domains) > 0:
+            print('\nDomains currently registered: ')
+            for dom in config.domains:
+                print('  - %s' % dom)
+            print('')
+
+        if config.ejbca_hostname is not None:
+            print('Domain used for your PKI system: %s\n' % config.ejbca_hostname)
+
+        # Identity load (keypair)
+        ret = reg_svc.load_identity()
+        if ret != 0:
+            print('\nError! Could not load identity (key-pair is missing)')
+            return self.return_code(3)
+
+        # IP has changed?
+        if config.is_private_network:
+            if config.last_ipv4_private is not None:
+                print('Last local IPv4 used for domain registration: %s' % config.last_ipv4_private)
+            print('Current local IPv4: %s' % reg_svc.info_loader.ami_local_ip)
+        else:
+            if config.last_ipv4 is not None:
+                print('Last IPv4 used for domain registration: %s' % config.last_ipv4)
+            print('Current IPv4: %s' % reg_svc.info_loader.ami_public_ip)
+
+        ctx['reg_svc'] = reg_svc
+        return 0
+
+    def onboot_task_domains(self, ctx):
+        """
+        Refreshes the dynamic domain for the host
+        """
+        reg_svc = ctx['reg_svc']
+        domain_is_ok = False
+        domain_ctr = 0
+        new_config = ctx['config']
+        while not domain_is_ok:
+            try:
+                new_config = reg_svc.refresh_domain()
+
+                if new_config.domains is not None and len(new_config.domains) > 0:
+                    domain_is_ok = True
+                    print('\nNew domains registered for this host: ')
+                    for domain in new_config.domains:
+                        print('  - %s' % domain)
+                    print('')
+
+            except Exception as e:
+                domain_ctr += 1
+                if self.args.debug:
+                    traceback.print_exc()
+
+                print('\nError during domain registration, no dynamic domain will be assigned')
+                if self.noninteractive:
+                    if domain_ctr >= self.args.attempts:
+                        break
+                else:
+                    should_continue = self.ask_proceed('Do you want to try again? (Y/n): ')
+                    if not should_continue:
+                        break
+
+        # Is it OK if domain assignment failed?
+        if not domain_is_ok:
+            print('\nDomain could not be assigned. You can try domain reassign later.')
+            return self.return_code(1)
+
+        ctx['new_config'] = new_config
+        return 0
+
+    def onboot_task_save_config(self, ctx):
+        """
+        Stores the registered IP addresses, checks the EJBCA hostname
+        """
+        reg_svc, new_config = ctx['reg_svc'], ctx['new_config']
+        new_config.last_ipv4 = reg_svc.info_loader.ami_public_ip
+        new_config.last_ipv4_private = reg_svc.info_loader.ami_local_ip
+
+        # Is original hostname used in the EJBCA in domains?
+        if new_config.ejbca_hostname is not None \
+                and not new_config.ejbca_hostname_custom \
+                and new_config.ejbca_hostname not in new_config.domains:
+            print('\nWarning! Returned domains do not correspond to the domain used during EJBCA installation %s'
+                  % new_config.ejbca_hostname)
+            print('\nThe PKI instance must be redeployed. This operations is not yet supported, please email '
+                  'to support@enigmabridge.com')
+
+        Core.write_configuration(new_config)
+        return 0
+
     def do_change_hostname(self, line):
         """Changes hostname of the EJBCA installation"""
         print('This functionality is not yet implemented')
@@ -806,6 +1128,7 @@ class App(Cmd):
 
     def do_undeploy_ejbca(self, line):
         """Undeploys EJBCA without any backup left"""
+        from ejbca import Ejbca
         if not self.check_root() or not self.check_pid():
             return self.return_code(1)
 
@@ -836,17 +1159,18 @@ class App(Cmd):
         return self.return_code(0 if port_ok else 1)
 
     def le_check_port(self, ip=None, letsencrypt=None, critical=False, one_attempt=False):
+        from registration import InfoLoader
+        info = InfoLoader()
         if ip is None:
-            info = InfoLoader()
-            info.load()
             ip = info.ami_public_ip
+        private_ip = info.ami_local_ip if ip != info.ami_local_ip else None
 
         self.last_le_port_open = False
         if letsencrypt is None:
             letsencrypt = LetsEncrypt(staging=self.args.le_staging)
 
         print('\nChecking if port %d is open for LetsEncrypt, ip: %s' % (letsencrypt.PORT, ip))
-        ok = letsencrypt.test_port_open(ip=ip)
+        ok = letsencrypt.test_port_open(ip=ip, private_ip=private_ip)
 
         # This is the place to simulate VPC during install
         if self.debug_simulate_vpc:
@@ -858,6 +1182,8 @@ class App(Cmd):
 
         print('\nLetsEncrypt port %d is firewalled, please make sure it is reachable on the public interface %s'
               % (letsencrypt.PORT, ip))
+        if letsencrypt.is_private_port_open(private_ip):
+            print('The port is reachable on the private IP %s, the public IP is NATed or firewalled' % private_ip)
         print('Please check AWS Security Groups - Inbound firewall rules for TCP port %d' % letsencrypt.PORT)
 
         if self.noninteractive or one_attempt:
@@ -877,7 +1203,7 @@ class App(Cmd):
                     return False
 
                 # Test again
-                ok = letsencrypt.test_port_open(ip=ip)
+                ok = letsencrypt.test_port_open(ip=ip, private_ip=private_ip)
                 if self.debug_simulate_vpc:
                     ok = False
                 if ok:
@@ -904,7 +1230,7 @@ class App(Cmd):
         le_test = LetsEncrypt(staging=self.args.le_staging)
 
         renew_needed = self.args.force or le_test.test_certificate_for_renew(domain=ejbca.hostname,
-                                                                             renewal_before=60*60*24*20) != 0
+                                                                             renewal_before=self.RENEWAL_BEFORE) != 0
         if not renew_needed:
             print('\nRenewal for %s is not needed now. Run with --force to override this' % ejbca.hostname)
             return 0
@@ -1199,7 +1525,7 @@ class App(Cmd):
                     return False
 
                 print('Next check will be performed in few seconds. Waiting...')
-                time.sleep(3)
+                util.wait_until(lambda: pidnum is not None and not util.pid_running(pidnum), timeout=3)
         pass
 
     def get_term_width(self):
@@ -1237,6 +1563,8 @@ class App(Cmd):
                             help='enables debug mode')
         parser.add_argument('--verbose', dest='verbose', action='store_const', const=True,
                             help='enables verbose mode')
+        parser.add_argument('--stats-log', dest='stats_log', default=None,
+                            help='appends resource usage of each executed command to the file (JSON lines)')
         parser.add_argument('--force', dest='force', action='store_const', const=True, default=False,
                             help='forces some action (e.g., certificate renewal)')
         parser.add_argument('--email', dest='email', default=None,
@@ -1263,6 +1591,9 @@ class App(Cmd):
         parser.add_argument('--le-staging', dest='le_staging', action='store_const', const=True, default=False,
                             help='Uses staging CA without rate limiting')
 
+        parser.add_argument('--daemon', dest='daemon', action='store_const', const=True, default=False,
+                            help='init installs the resident renewal daemon instead of the cron job and onboot check')
+
         parser.add_argument('--yes', dest='yes', action='store_const', const=True,
                             help='answers yes to the questions in the non-interactive mode, mainly for init')
 
@@ -1292,9 +1623,13 @@ class App(Cmd):
         if self.noninteractive:
             sys.argv.append('quit')
 
-        if self.args.debug:
-            coloredlogs.install(level=logging.DEBUG)
+        import coloredlogs
+        coloredlogs.install(level=logging.DEBUG if self.args.debug else logging.ERROR)
+
+        if self.args.stats_log is not None:
+            process.collector.set_sink(self.args.stats_log)
 
+        self.update_intro()
         self.cmdloop()
         sys.argv = args_src
 
@@ -246,6 +246,15 @@ class Config(object):
     def ejbca_jks_password(self, val):
         self.set_config('ejbca_jks_password', val)
 
+    # JBoss management interface password
+    @property
+    def jboss_mgmt_password(self):
+        return self.get_config('jboss_mgmt_password')
+
+    @jboss_mgmt_password.setter
+    def jboss_mgmt_password(self, val):
+        self.set_config('jboss_mgmt_password', val)
+
     # EJBCA custom hostname flag
     @property
     def ejbca_hostname_custom(self):
@@ -378,5 +387,3 @@ class EBSettings(object):
     @env.setter
     def env(self, val):
         self.set_config('env', val)
-
-
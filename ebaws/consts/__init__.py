@@ -5,6 +5,8 @@ CONFIG_FILE = 'config.json'
 IDENTITY_KEY = 'key.pem'
 IDENTITY_CRT = 'crt.pem'
 IDENTITY_NONCE = 'nonce.data'
+JOURNAL_FILE = 'journal-%s.json'
+CERT_INDEX_FILE = 'cert-index.json'
 
 SERVER_PROCESS_DATA = 'process_data'
 SERVER_ENROLLMENT = 'enrollment'
@@ -77,3 +79,9 @@ case "$1" in
 esac
 """
 
+# Resident renewal daemon - same init script, long running command
+DAEMON_INIT_SCRIPT = ONBOOT_INIT_SCRIPT\
+    .replace('ebaws-onboot', 'ebaws-daemon')\
+    .replace('EnigmaBridge on boot', 'EnigmaBridge renewal daemon')\
+    .replace('ebaws-cli -n onboot', 'ebaws-cli -n daemon')
+
@@ -1,6 +1,5 @@
 from config import Config, EBSettings
 from consts import *
-from ebclient import eb_configuration
 import json
 import os.path
 import util
@@ -19,6 +18,11 @@ class Core(object):
             self.pidlock.create()
             self.pidlock_created = True
 
+    def pidlock_release(self):
+        if self.pidlock_created:
+            self.pidlock.close()
+            self.pidlock_created = False
+
     def pidlock_check(self):
         return self.pidlock.check()
 
@@ -40,6 +44,11 @@ class Core(object):
         """Returns basic configuration file"""
         return CONFIG_DIR + '/' + CONFIG_FILE
 
+    @staticmethod
+    def get_journal_path(workflow):
+        """Returns the step journal file of the workflow"""
+        return CONFIG_DIR + '/' + (JOURNAL_FILE % workflow)
+
     @staticmethod
     def config_file_exists():
         conf_name = Core.get_config_file_path()
@@ -89,6 +98,7 @@ class Core(object):
         Returns default configuration for the EB client
         :return:
         """
+        from ebclient import eb_configuration
         cfg = eb_configuration.Configuration()
         cfg.endpoint_register = eb_configuration.Endpoint.url('https://hut6.enigmabridge.com:8445')
         return cfg
@@ -0,0 +1,191 @@
+import logging
+import random
+import signal
+import sys
+import threading
+import time
+from datetime import datetime
+
+
+__author__ = 'dusanklinec'
+logger = logging.getLogger(__name__)
+
+
+class RenewalSchedule(object):
+    """
+    Computes the renewal times from the certificate expiration.
+    Renewal is scheduled after the renewal threshold (so the renew command precheck lets it through)
+    with a random jitter spreading the fleet load on the registration API and LetsEncrypt.
+    """
+
+    def __init__(self, renewal_before=60*60*24*20, jitter=60*60*6, min_delay=60*5, retry_delay=60*15,
+                 retry_max=60*60*12, rand=None, *args, **kwargs):
+        self.renewal_before = renewal_before
+        self.jitter = jitter
+        self.min_delay = min_delay
+        self.retry_delay = retry_delay
+        self.retry_max = retry_max
+        self.rand = rand if rand is not None else random.SystemRandom()
+
+    def next_renewal(self, not_after, now):
+        """
+        Next renewal time for the certificate
+        :param not_after: certificate expiration, epoch seconds, None if there is no valid certificate
+        :param now:
+        :return: epoch seconds
+        """
+        if not_after is None:
+            return now
+        due = not_after - self.renewal_before + self.rand.uniform(0, self.jitter)
+        return max(due, now + self.min_delay) if due > now else now
+
+    def next_retry(self, failures, now):
+        """
+        Retry time after the failed attempt, exponential backoff with jitter
+        :param failures: number of consecutive failures
+        :param now:
+        :return: epoch seconds
+        """
+        delay = min(self.retry_max, self.retry_delay * (2 ** max(0, failures - 1)))
+        return now + delay * self.rand.uniform(0.75, 1.25)
+
+
+class RenewalDaemon(object):
+    """
+    Resident replacement of the renew cron job and the onboot init script.
+    Domain is refreshed on the start and on the IP change, the certificate renewal is scheduled
+    from its expiration. Actions are callables returning the command exit code.
+    """
+
+    def __init__(self, renew, onboot, get_not_after, get_ip=None, schedule=None, ip_check_interval=60*5,
+                 clock=None, *args, **kwargs):
+        """
+        :param renew: renews the certificate
+        :param onboot: refreshes the domain registration
+        :param get_not_after: current certificate expiration, epoch seconds or None
+        :param get_ip: current IP address(es) of the host, None if unknown
+        :param schedule: RenewalSchedule
+        :param ip_check_interval: seconds between IP checks
+        :param clock: time source
+        """
+        self.renew = renew
+        self.onboot = onboot
+        self.get_not_after = get_not_after
+        self.get_ip = get_ip
+        self.schedule = schedule if schedule is not None else RenewalSchedule()
+        self.ip_check_interval = ip_check_interval
+        self.clock = clock if clock is not None else time.time
+
+        self.stop_event = threading.Event()
+        self.last_ip = None
+        self.onboot_due = None
+        self.onboot_failures = 0
+        self.renew_due = None
+        self.renew_failures = 0
+        self.ip_check_due = None
+
+    def log(self, msg):
+        print('[%s] %s' % (datetime.now().strftime('%Y-%m-%d %H:%M:%S'), msg))
+        sys.stdout.flush()
+
+    @staticmethod
+    def fmt_time(tstamp):
+        return datetime.fromtimestamp(tstamp).strftime('%Y-%m-%d %H:%M:%S')
+
+    def safe_call(self, name, fnc, *args):
+        try:
+            return fnc(*args)
+        except Exception as e:
+            logger.debug('Exception in %s' % name, exc_info=True)
+            self.log('Error in %s: %s' % (name, e))
+            return None
+
+    def start(self, now=None):
+        """
+        Initial schedule - domain refresh and renewal check right away
+        :param now:
+        :return:
+        """
+        now = now if now is not None else self.clock()
+        self.onboot_due = now
+        self.renew_due = now
+        self.ip_check_due = now if self.get_ip is not None else None
+        self.onboot_failures = 0
+        self.renew_failures = 0
+
+    def reschedule_renewal(self, now):
+        not_after = self.safe_call('certificate check', self.get_not_after)
+        self.renew_due = max(self.schedule.next_renewal(not_after, now), now + self.schedule.min_delay)
+        self.log('Certificate renewal scheduled at %s' % self.fmt_time(self.renew_due))
+
+    def check_ip(self, now):
+        self.ip_check_due = now + self.ip_check_interval
+        ip = self.safe_call('IP check', self.get_ip)
+        if ip is None:
+            return
+
+        if self.last_ip is not None and ip != self.last_ip and self.onboot_due is None:
+            self.log('IP address changed %s -> %s, refreshing the domain' % (self.last_ip, ip))
+            self.onboot_due = now
+        self.last_ip = ip
+
+    def run_onboot(self, now):
+        ret = self.safe_call('domain refresh', self.onboot)
+        if ret == 0:
+            self.onboot_failures = 0
+            self.onboot_due = None
+            return
+
+        self.onboot_failures += 1
+        self.onboot_due = self.schedule.next_retry(self.onboot_failures, now)
+        self.log('Domain refresh failed (%s), next attempt at %s' % (ret, self.fmt_time(self.onboot_due)))
+
+    def run_renew(self, now):
+        not_after = self.safe_call('certificate check', self.get_not_after)
+        if self.schedule.next_renewal(not_after, now) > now:
+            self.reschedule_renewal(now)
+            return
+
+        ret = self.safe_call('certificate renewal', self.renew)
+        if ret == 0:
+            self.renew_failures = 0
+            self.reschedule_renewal(self.clock())
+            return
+
+        self.renew_failures += 1
+        self.renew_due = self.schedule.next_retry(self.renew_failures, now)
+        self.log('Certificate renewal failed (%s), next attempt at %s' % (ret, self.fmt_time(self.renew_due)))
+
+    def step(self, now=None):
+        """
+        Runs all due actions
+        :param now:
+        :return: time of the next action
+        """
+        now = now if now is not None else self.clock()
+        if self.ip_check_due is not None and now >= self.ip_check_due:
+            self.check_ip(now)
+        if self.onboot_due is not None and now >= self.onboot_due:
+            self.run_onboot(now)
+        if self.renew_due is not None and now >= self.renew_due:
+            self.run_renew(now)
+        return min(x for x in [self.onboot_due, self.renew_due, self.ip_check_due] if x is not None)
+
+    def stop(self, *args):
+        self.stop_event.set()
+
+    def install_signals(self):
+        for sig in [signal.SIGTERM, signal.SIGINT]:
+            signal.signal(sig, self.stop)
+
+    def run(self):
+        """
+        Main loop, until stopped
+        :return:
+        """
+        self.log('Daemon started')
+        self.start()
+        while not self.stop_event.is_set():
+            wake = self.step()
+            self.stop_event.wait(max(0.0, wake - self.clock()))
+        self.log('Daemon stopped')
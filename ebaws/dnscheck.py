@@ -0,0 +1,361 @@
+import logging
+import random
+import socket
+import struct
+import time
+import errors
+
+
+__author__ = 'dusanklinec'
+logger = logging.getLogger(__name__)
+
+
+class DnsRecord(object):
+    """
+    Resource record, data is parsed for A, NS, CNAME, SOA (primary NS) and TXT (joined strings)
+    """
+    def __init__(self, name=None, rtype=None, ttl=None, data=None, *args, **kwargs):
+        self.name = name
+        self.rtype = rtype
+        self.ttl = ttl
+        self.data = data
+
+    def __repr__(self):
+        return 'DnsRecord(%s, %s, %s)' % (self.name, self.rtype, self.data)
+
+
+class DnsResponse(object):
+    def __init__(self, *args, **kwargs):
+        self.id = None
+        self.flags = 0
+        self.rcode = None
+        self.answers = []
+        self.authority = []
+        self.additional = []
+
+    @property
+    def is_authoritative(self):
+        return (self.flags & DnsClient.FLAG_AA) != 0
+
+    @property
+    def is_truncated(self):
+        return (self.flags & DnsClient.FLAG_TC) != 0
+
+    def get_records(self, rtype, name=None, section=None):
+        section = section if section is not None else self.answers
+        return [x for x in section if x.rtype == rtype and (name is None or x.name == normalize_name(name))]
+
+
+def normalize_name(name):
+    return name.lower().rstrip('.')
+
+
+class DnsClient(object):
+    """
+    Minimal DNS client over UDP, enough to query the authoritative servers directly
+    """
+    TYPE_A = 1
+    TYPE_NS = 2
+    TYPE_CNAME = 5
+    TYPE_SOA = 6
+    TYPE_TXT = 16
+    CLASS_IN = 1
+
+    FLAG_QR = 0x8000
+    FLAG_AA = 0x0400
+    FLAG_TC = 0x0200
+    FLAG_RD = 0x0100
+
+    RCODE_OK = 0
+    RCODE_NXDOMAIN = 3
+
+    def __init__(self, timeout=2.0, retries=2, port=53, rand=None, *args, **kwargs):
+        self.timeout = timeout
+        self.retries = retries
+        self.port = port
+        self.rand = rand if rand is not None else random.SystemRandom()
+
+    @staticmethod
+    def encode_name(name):
+        res = ''
+        for label in normalize_name(name).split('.'):
+            if len(label) == 0:
+                continue
+            if len(label) > 63:
+                raise ValueError('DNS label too long: %s' % label)
+            res += chr(len(label)) + label
+        return res + '\0'
+
+    def build_query(self, qid, name, qtype, recursive=True):
+        flags = self.FLAG_RD if recursive else 0
+        header = struct.pack('!HHHHHH', qid, flags, 1, 0, 0, 0)
+        return header + self.encode_name(name) + struct.pack('!HH', qtype, self.CLASS_IN)
+
+    @staticmethod
+    def parse_name(data, offset):
+        """
+        Reads the (possibly compressed) name
+        :param data:
+        :param offset:
+        :return: (name, offset after the name)
+        """
+        labels = []
+        end = None
+        jumps = 0
+        while True:
+            if offset >= len(data):
+                raise errors.InvalidResponse('DNS name out of bounds')
+            length = ord(data[offset])
+            if length & 0xc0 == 0xc0:
+                if end is None:
+                    end = offset + 2
+                jumps += 1
+                if jumps > 64:
+                    raise errors.InvalidResponse('DNS name compression loop')
+                offset = struct.unpack('!H', data[offset:offset + 2])[0] & 0x3fff
+                continue
+            offset += 1
+            if length == 0:
+                break
+            labels.append(data[offset:offset + length])
+            offset += length
+        return '.'.join(labels).lower(), end if end is not None else offset
+
+    def parse_record(self, data, offset):
+        name, offset = self.parse_name(data, offset)
+        rtype, rclass, ttl, rdlength = struct.unpack('!HHIH', data[offset:offset + 10])
+        offset += 10
+        rdata_offset, offset = offset, offset + rdlength
+        if offset > len(data):
+            raise errors.InvalidResponse('DNS record out of bounds')
+
+        rec = DnsRecord(name=name, rtype=rtype, ttl=ttl)
+        if rtype == self.TYPE_A and rdlength == 4:
+            rec.data = socket.inet_ntoa(data[rdata_offset:offset])
+        elif rtype in [self.TYPE_NS, self.TYPE_CNAME, self.TYPE_SOA]:
+            rec.data = self.parse_name(data, rdata_offset)[0]
+        elif rtype == self.TYPE_TXT:
+            parts, pos = [], rdata_offset
+            while pos < offset:
+                length = ord(data[pos])
+                parts.append(data[pos + 1:pos + 1 + length])
+                pos += 1 + length
+            rec.data = ''.join(parts)
+        else:
+            rec.data = data[rdata_offset:offset]
+        return rec, offset
+
+    def parse_response(self, data):
+        if len(data) < 12:
+            raise errors.InvalidResponse('DNS response too short')
+
+        resp = DnsResponse()
+        resp.id, resp.flags, qdcount, ancount, nscount, arcount = struct.unpack('!HHHHHH', data[:12])
+        resp.rcode = resp.flags & 0xf
+
+        offset = 12
+        try:
+            for _ in range(qdcount):
+                offset = self.parse_name(data, offset)[1] + 4
+            for section, count in [(resp.answers, ancount), (resp.authority, nscount), (resp.additional, arcount)]:
+                for _ in range(count):
+                    rec, offset = self.parse_record(data, offset)
+                    section.append(rec)
+        except (struct.error, IndexError) as e:
+            raise errors.InvalidResponse('Malformed DNS response: %s' % e)
+        return resp
+
+    def query(self, server, name, qtype, recursive=True):
+        """
+        Sends the query, retries on timeout
+        :param server: IP address
+        :param name:
+        :param qtype:
+        :param recursive: recursion desired, False for the authoritative servers
+        :return: DnsResponse
+        """
+        qid = self.rand.randint(0, 0xffff)
+        packet = self.build_query(qid, name, qtype, recursive=recursive)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.settimeout(self.timeout)
+            for attempt in range(self.retries + 1):
+                try:
+                    sock.sendto(packet, (server, self.port))
+                    deadline = time.time() + self.timeout
+                    while True:
+                        sock.settimeout(max(0.001, deadline - time.time()))
+                        data, addr = sock.recvfrom(4096)
+                        if addr[0] != server or len(data) < 2 or struct.unpack('!H', data[:2])[0] != qid:
+                            continue
+                        return self.parse_response(data)
+
+                except socket.timeout:
+                    logger.debug('DNS query %s %s @%s timed out, attempt %d' % (name, qtype, server, attempt))
+
+        except socket.error as e:
+            raise errors.RequestFailed('DNS query %s @%s failed: %s' % (name, server, e))
+        finally:
+            sock.close()
+        raise errors.RequestFailed('DNS query %s @%s timed out' % (name, server))
+
+
+class PropagationChecker(object):
+    """
+    Waits until the TXT records are served by all authoritative nameservers of the zone.
+    The zone and its nameservers are found via the system resolvers, the nameservers are then polled directly
+    (no recursion, no caches in between) with a backoff until the deadline.
+    """
+    RESOLV_CONF = '/etc/resolv.conf'
+    FALLBACK_RESOLVERS = ['8.8.8.8']
+
+    def __init__(self, resolvers=None, client=None, deadline=60*3, backoff=2.0, backoff_max=20.0,
+                 clock=None, sleep=None, *args, **kwargs):
+        """
+        :param resolvers: recursive resolvers used to find the zone nameservers, system ones by default
+        :param client: DnsClient
+        :param deadline: seconds to wait for the propagation
+        :param backoff: first poll delay, doubled after each unsuccessful round
+        :param backoff_max:
+        :param clock:
+        :param sleep:
+        """
+        self.resolvers = resolvers if resolvers is not None else self.read_resolvers()
+        self.client = client if client is not None else DnsClient()
+        self.deadline = deadline
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.clock = clock if clock is not None else time.time
+        self.sleep = sleep if sleep is not None else time.sleep
+        self.zones = {}
+
+    @classmethod
+    def read_resolvers(cls, path=None):
+        path = path if path is not None else cls.RESOLV_CONF
+        resolvers = []
+        try:
+            with open(path, 'r') as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) >= 2 and parts[0] == 'nameserver' and ':' not in parts[1]:
+                        resolvers.append(parts[1])
+        except (IOError, OSError) as e:
+            logger.debug('Could not read resolvers from %s: %s' % (path, e))
+        return resolvers if len(resolvers) > 0 else list(cls.FALLBACK_RESOLVERS)
+
+    def resolve(self, name, qtype):
+        """
+        Recursive query via the first responding resolver
+        :param name:
+        :param qtype:
+        :return: DnsResponse
+        """
+        last_error = None
+        for resolver in self.resolvers:
+            try:
+                return self.client.query(resolver, name, qtype, recursive=True)
+            except errors.Error as e:
+                last_error = e
+        raise errors.RequestFailed('No resolver answered %s: %s' % (name, last_error))
+
+    def get_ns_addresses(self, resp, zone):
+        """
+        Nameserver addresses, glue records preferred
+        :param resp: NS query response
+        :param zone:
+        :return: list of IP addresses
+        """
+        addresses = []
+        for ns in resp.get_records(DnsClient.TYPE_NS, name=zone):
+            glue = [x.data for x in resp.get_records(DnsClient.TYPE_A, name=ns.data, section=resp.additional)]
+            if len(glue) == 0:
+                try:
+                    glue = [x.data for x in self.resolve(ns.data, DnsClient.TYPE_A).get_records(DnsClient.TYPE_A)]
+                except errors.Error as e:
+                    logger.debug('Could not resolve nameserver %s: %s' % (ns.data, e))
+            addresses.extend(x for x in glue if x not in addresses)
+        return addresses
+
+    def find_zone(self, name):
+        """
+        Finds the zone of the name and addresses of its authoritative nameservers
+        :param name:
+        :return: (zone, list of nameserver addresses)
+        """
+        name = normalize_name(name)
+        if name in self.zones:
+            return self.zones[name]
+
+        candidate = name
+        while len(candidate) > 0:
+            resp = self.resolve(candidate, DnsClient.TYPE_NS)
+            zone = None
+            if len(resp.get_records(DnsClient.TYPE_NS, name=candidate)) > 0:
+                zone = candidate
+            else:
+                soa = resp.get_records(DnsClient.TYPE_SOA, section=resp.authority)
+                if len(soa) > 0 and (name == soa[0].name or name.endswith('.' + soa[0].name)):
+                    zone = soa[0].name
+                    if zone != candidate:
+                        resp = self.resolve(zone, DnsClient.TYPE_NS)
+
+            if zone is not None:
+                addresses = self.get_ns_addresses(resp, zone)
+                if len(addresses) == 0:
+                    raise errors.RequestFailed('No nameserver addresses for the zone %s' % zone)
+                self.zones[name] = zone, addresses
+                return self.zones[name]
+
+            candidate = candidate.split('.', 1)[1] if '.' in candidate else ''
+        raise errors.RequestFailed('Zone of %s not found' % name)
+
+    def has_txt(self, server, name, values):
+        """
+        Checks the nameserver serves all the TXT values
+        :param server:
+        :param name:
+        :param values:
+        :return:
+        """
+        try:
+            resp = self.client.query(server, name, DnsClient.TYPE_TXT, recursive=False)
+        except errors.Error as e:
+            logger.debug('TXT query %s @%s failed: %s' % (name, server, e))
+            return False
+        served = set(x.data for x in resp.get_records(DnsClient.TYPE_TXT, name=name))
+        return all(x in served for x in values)
+
+    def wait_for_txt(self, records, deadline=None):
+        """
+        Polls the authoritative nameservers until all of them serve the TXT records
+        :param records: list of (name, value) pairs
+        :param deadline: seconds, default deadline if None
+        :return: True if propagated, False on timeout
+        """
+        deadline = self.clock() + (deadline if deadline is not None else self.deadline)
+        expected = {}
+        for name, value in records:
+            expected.setdefault(normalize_name(name), []).append(value)
+
+        # name -> nameservers not serving the records yet
+        pending = {}
+        for name in expected:
+            pending[name] = list(self.find_zone(name)[1])
+
+        delay = self.backoff
+        while True:
+            for name in list(pending.keys()):
+                pending[name] = [x for x in pending[name] if not self.has_txt(x, name, expected[name])]
+                if len(pending[name]) == 0:
+                    del pending[name]
+
+            if len(pending) == 0:
+                return True
+
+            now = self.clock()
+            if now >= deadline:
+                logger.info('TXT records not propagated to: %s' % pending)
+                return False
+
+            self.sleep(min(delay, deadline - now))
+            delay = min(delay * 2, self.backoff_max)
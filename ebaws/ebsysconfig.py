@@ -1,7 +1,5 @@
 import os
 import util
-from sarge import run, Capture, Feeder
-from ebclient.eb_utils import EBUtils
 from datetime import datetime
 import time
 import sys
@@ -9,9 +7,9 @@ import types
 import subprocess
 import shutil
 import re
-import psutil
 import math
 import consts
+import hostfacts
 
 
 __author__ = 'dusanklinec'
@@ -25,10 +23,19 @@ class SysConfig(object):
         pass
 
     def get_virt_mem(self):
-        return psutil.virtual_memory().total
+        def load():
+            import psutil
+            return psutil.virtual_memory().total
+        return hostfacts.facts.get('mem_virt', load)
 
     def get_swap_mem(self):
-        return psutil.swap_memory().total
+        def load():
+            import psutil
+            return psutil.swap_memory().total
+        return hostfacts.facts.get('mem_swap', load)
+
+    def get_os_info(self):
+        return tuple(hostfacts.facts.get('os_info', lambda: list(util.get_os_info())))
 
     def get_total_usable_mem(self):
         """
@@ -81,6 +88,7 @@ class SysConfig(object):
         fhnd.close()
 
         # Check if there is enough free space + 128MB extra
+        import psutil
         fs_stats = psutil.disk_usage(path)
         size_required = desired_size+1024*1024*128
 
@@ -89,18 +97,24 @@ class SysConfig(object):
             return -1
 
         # Create swap file
-        cmd = '/bin/rm "%s" && ' % fname
-        cmd += ' dd if=/dev/zero of="%s" bs=1M count=%d >/dev/null && ' % (fname, size_in_mb)
-        cmd += ' chmod 600 %s >/dev/null && ' % fname
-        cmd += ' mkswap %s >/dev/null && ' % fname
-        cmd += ' swapon %s >/dev/null && ' % fname
-        cmd += ' echo "%s swap swap defaults 0 0" >> /etc/fstab ' % fname
-        cmd_exec = 'sudo -E -H /bin/bash -c \'%s\'' % cmd
-
-        # Swap create
-        p = subprocess.Popen(cmd_exec, shell=True)
-        p.communicate()
-        return p.returncode, fname, desired_size
+        os.remove(fname)
+        steps = [
+            ['dd', 'if=/dev/zero', 'of=%s' % fname, 'bs=1M', 'count=%d' % size_in_mb],
+            ['chmod', '600', fname],
+            ['mkswap', fname],
+            ['swapon', fname],
+        ]
+
+        for cmd in steps:
+            ret, out, err = util.cli_cmd_sync(cmd, label='swap')
+            if ret != 0:
+                return ret, fname, desired_size
+
+        with open('/etc/fstab', 'a') as fstab:
+            fstab.write('%s swap swap defaults 0 0\n' % fname)
+
+        hostfacts.facts.invalidate('mem_swap')
+        return 0, fname, desired_size
 
     def print_error(self, msg):
         if self.print_output:
@@ -125,7 +139,7 @@ class SysConfig(object):
         Installs a service invocation after boot to reclaim domain again
         :return:
         """
-        os_name, os_version = util.get_os_info()
+        os_name, os_version = self.get_os_info()
         os_name = os_name.lower()
 
         if os_name in ['rhel', 'centos'] and os_version.startswith('7'):
@@ -150,6 +164,53 @@ class SysConfig(object):
 
         return 0
 
+    def install_daemon(self):
+        """
+        Installs and starts the resident renewal daemon, replaces the renew cron job and the onboot check.
+        The cron job and the onboot check are kept if the daemon could not be started.
+        :return:
+        """
+        os_name, os_version = self.get_os_info()
+        os_name = os_name.lower()
+
+        if os_name in ['rhel', 'centos'] and os_version.startswith('7'):
+            self.print_error('CentOS/RHEL version 7 is not supported yet')
+            return 1
+
+        initd_path = '/etc/init.d/ebaws-daemon'
+        if os.path.exists(initd_path):
+            os.remove(initd_path)
+
+        with util.safe_open(initd_path, mode='w', chmod=0o755) as handle:
+            handle.write(consts.DAEMON_INIT_SCRIPT)
+            handle.write('\n')
+
+        p = subprocess.Popen('chkconfig --level=345 ebaws-daemon on', shell=True)
+        p.communicate()
+        if p.returncode != 0:
+            self.print_error('Error: Could not install the daemon system service\n')
+            return 2
+
+        p = subprocess.Popen('service ebaws-daemon start', shell=True)
+        p.communicate()
+        if p.returncode != 0:
+            self.print_error('Error: Could not start the daemon system service\n')
+            p = subprocess.Popen('chkconfig ebaws-daemon off', shell=True)
+            p.communicate()
+            return 3
+
+        # Daemon does the periodic and on boot work
+        cron_path = '/etc/cron.d/ebaws-renew'
+        if os.path.exists(cron_path):
+            os.remove(cron_path)
+
+        if os.path.exists('/etc/init.d/ebaws-onboot'):
+            p = subprocess.Popen('chkconfig ebaws-onboot off', shell=True)
+            p.communicate()
+            os.remove('/etc/init.d/ebaws-onboot')
+
+        return 0
+
     def get_onboot_init_script(self):
         return consts.ONBOOT_INIT_SCRIPT
 
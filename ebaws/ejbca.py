@@ -1,7 +1,11 @@
 import os
 import util
-from sarge import run, Capture, Feeder
-from ebclient.eb_utils import EBUtils
+import errors
+import process
+import jboss
+import buildcache
+import jvmsession
+import shlex
 from softhsm import SoftHsmV1Config
 from datetime import datetime
 import time
@@ -9,8 +13,10 @@ import sys
 import types
 import subprocess
 import shutil
+import hashlib
 import re
 import letsencrypt
+import dnscheck
 import logging
 from consts import LE_VERIFY_DNS, LE_VERIFY_TLSSNI, LE_VERIFY_DEFAULT
 
@@ -31,6 +37,13 @@ class Ejbca(object):
     EJBCA_HOME = '/opt/ejbca_ce_6_3_1_1'
     JBOSS_HOME = '/opt/jboss-eap-6.4.0'
     JBOSS_USER = 'jboss'
+    JBOSS_CLI_SCRIPT = '/tmp/jboss-cli-script.cli'
+    JBOSS_MGMT_USER = 'ebaws-mgmt'
+    JBOSS_MGMT_REALM = 'ManagementRealm'
+    JBOSS_MGMT_USERS = ['standalone/configuration/mgmt-users.properties',
+                        'domain/configuration/mgmt-users.properties']
+    JBOSS_MGMT_PORT = 9990
+    JBOSS_WAIT_TIMEOUT = 120
     USER_HOME = '/home/ec2-user'
     SSH_USER = 'ec2-user'
 
@@ -38,6 +51,30 @@ class Ejbca(object):
     INSTALL_PROPERTIES_FILE = 'conf/install.properties'
     WEB_PROPERTIES_FILE = 'conf/web.properties'
     P12_FILE = 'p12/superadmin.p12'
+    DIST_EAR = 'dist/ejbca.ear'
+    DIST_CLIENT_TOOLS = 'dist/clientToolBox'
+    EJBCA_CLI_JAR = 'dist/ejbca-ejb-cli/ejbca-ejb-cli.jar'
+    CLIENT_TOOLBOX_JAR = 'dist/clientToolBox/clientToolBox.jar'
+    PKCS11_TOOL = 'PKCS11HSMKeyTool'
+    PKCS11_PIN_INPUT = '0000\n'
+
+    # Default key set generated in the EnigmaBridge token, (alias, bit size)
+    PKCS11_DEFAULT_KEY_SET = [('signKey', 2048), ('defaultKey', 2048), ('testKey', 1024)]
+    # SoftHSM v1 token does not support concurrent writers, concurrent key generation is opt-in
+    PKCS11_KEYGEN_WORKERS = 1
+    PKCS11_KEYGEN_TIMEOUT = 300
+
+    # Build artifacts cache, keyed by the fingerprint of the build inputs.
+    # Build outputs and generated files are not build inputs.
+    BUILD_CACHE_DIR = '/var/cache/ebaws/ejbca'
+    BUILD_EXCLUDE = ['dist', 'tmp', 'p12', INSTALL_PROPERTIES_FILE, WEB_PROPERTIES_FILE]
+    JBOSS_VERSION_FILE = 'version.txt'
+
+    # Targets of 'ant deploy' creating the datasource and the mail service, removed by undeploy.
+    # The cached EAR is deployed without them.
+    ANT_DEPLOY_SERVICES = 'jee:deployDS jee:deployServices'
+    ANT_MISSING_TARGET = r'Target\s+["\']?[\w:.-]+["\']?\s+does not exist in the project'
+    JBOSS_DATASOURCE = 'ejbcads'
 
     # Storage paths
     PASSWORDS_FILE = '/root/ejbca.passwords'
@@ -48,6 +85,16 @@ class Ejbca(object):
     JBOSS_CLI = 'bin/jboss-cli.sh'
     JBOSS_KEYSTORE = 'standalone/configuration/keystore/keystore.jks'
 
+    # Output budget kept in memory for long running commands (full output goes to the log file)
+    CAPTURE_MAX_LINES = 500
+    CAPTURE_MAX_BYTES = 64*1024
+
+    # Ant input prompts answered with the default value
+    ANT_DEFAULT_PROMPTS = [
+        process.PromptRule(prefix='Please enter', response='\n'),
+        process.PromptRule(prefix='[input] Please enter', response='\n'),
+    ]
+
     # Default installation settings
     INSTALL_PROPERTIES = {
         'ca.name': 'ManagementCA',
@@ -99,6 +146,11 @@ class Ejbca(object):
         self.reg_svc = None
 
         self.ejbca_install_result = 1
+        self.mgmt_client = None
+        self.jboss_mgmt_password = None
+        self.mgmt_client_warned = False
+        self.jvm_session = None
+        self.use_jvm_session = True
         pass
 
     def get_ejbca_home(self):
@@ -140,6 +192,7 @@ class Ejbca(object):
 
     def set_config(self, config):
         self.config = config
+        self.mgmt_client = None
 
     def set_domains(self, domains, primary=None, set_hostname=True):
         """
@@ -223,23 +276,138 @@ class Ejbca(object):
             if file_ins_hnd is not None:
                 file_ins_hnd.close()
 
-    def cli_cmd(self, cmd, log_obj=None, write_dots=False, on_out=None, on_err=None, ant_answer=True, cwd=None):
+    def get_build_fingerprint(self):
+        """
+        Fingerprint of the EJBCA build inputs - generated properties, EJBCA tree, JBoss version
+        :return:
+        """
+        fp = buildcache.BuildFingerprint()
+        fp.add_data('web.properties', self.properties_to_string(util.merge(self.WEB_PROPERTIES, self.web_props)))
+        fp.add_data('install.properties',
+                    self.properties_to_string(util.merge(self.INSTALL_PROPERTIES, self.install_props)))
+        fp.add_file(os.path.join(self.get_jboss_home(), self.JBOSS_VERSION_FILE))
+        fp.add_tree(self.get_ejbca_home(), exclude=self.BUILD_EXCLUDE)
+        return fp.hexdigest()
+
+    def get_build_cache(self):
+        return buildcache.BuildCache(self.BUILD_CACHE_DIR)
+
+    def build_cache_store(self, fingerprint):
+        """
+        Stores the built EAR and client tools to the cache
+        :param fingerprint:
+        :return:
+        """
+        try:
+            self.get_build_cache().store(fingerprint, {
+                'ejbca.ear': os.path.join(self.get_ejbca_home(), self.DIST_EAR),
+                'clientToolBox': os.path.join(self.get_ejbca_home(), self.DIST_CLIENT_TOOLS),
+            })
+        except (IOError, OSError, shutil.Error) as e:
+            logger.warning('Could not store the build to the cache: %s' % e)
+
+    def deploy_cached(self, fingerprint):
+        """
+        Deploys the cached EAR built from the same inputs, restores the client tools.
+        On failure the partial deployment is removed so the regular build can proceed.
+        :param fingerprint:
+        :return: True if deployed
+        """
+        cache = self.get_build_cache()
+        if not cache.has(fingerprint, ['ejbca.ear', 'clientToolBox']):
+            return False
+
+        if self.print_output:
+            print "\n - Deploying the cached PKI system build"
+
+        ear = os.path.join(self.get_ejbca_home(), self.DIST_EAR)
+        try:
+            cache.restore(fingerprint, 'ejbca.ear', ear)
+            cache.restore(fingerprint, 'clientToolBox', os.path.join(self.get_ejbca_home(), self.DIST_CLIENT_TOOLS))
+        except (IOError, OSError, shutil.Error) as e:
+            logger.warning('Could not restore the build from the cache: %s' % e)
+            return False
+
+        # Undeploy removed the datasource and the mail service, the EAR does not start without them
+        out_capture = self.get_capture().watch(self.ANT_MISSING_TARGET, name='missing')
+        err_capture = self.get_capture().watch(self.ANT_MISSING_TARGET, name='missing')
+        ret, out, err = self.ant_deploy_services(out_capture=out_capture, err_capture=err_capture)
+        if ret != 0 and (out_capture.matched('missing') or err_capture.matched('missing')):
+            # EJBCA tree without the split targets, the full deploy recreates the services with the EAR
+            logger.info('Ant targets %s not defined, using the full deploy' % self.ANT_DEPLOY_SERVICES)
+            ret, out, err = self.ant_deploy()
+            return ret == 0
+
+        if ret != 0 or not self.jboss_has_datasource():
+            logger.info('Datasource could not be recreated, cached build skipped, code: %s' % ret)
+            return False
+
+        self.jboss_fix_privileges()
+        ret, out, err = self.jboss_cmd('deploy %s --force' % ear)
+        if ret == 0 and self.jboss_wait_after_deploy():
+            return True
+
+        logger.debug('Cached build deployment failed, code: %s' % ret)
+        self.jboss_undeploy()
+        return False
+
+    def cli_cmd(self, cmd, log_obj=None, write_dots=False, on_out=None, on_err=None, ant_answer=True, cwd=None,
+                out_capture=None, err_capture=None, responder=None, label=None, run_as=None):
         """
         Runs command line task
         Used for ant and jboss-cli.sh
         :return:
         """
         default_cwd = self.get_ejbca_home()
-        if on_out is None and ant_answer is not None:
-            on_out = self.ant_answer
+        if on_out is None and responder is None and ant_answer:
+            responder = self.get_ant_responder()
+        cwd = cwd if cwd is not None else default_cwd
+
+        return util.cli_cmd_sync(cmd, log_obj=log_obj, write_dots=write_dots, on_out=on_out, on_err=on_err, cwd=cwd,
+                                 out_capture=out_capture, err_capture=err_capture, responder=responder,
+                                 label=label, run_as=run_as)
+
+    def get_capture(self):
+        """
+        Bounded output capture for long running commands
+        :return:
+        """
+        return process.OutputCapture(max_lines=self.CAPTURE_MAX_LINES, max_bytes=self.CAPTURE_MAX_BYTES)
+
+    def cli_cmd_async(self, cmd, loop=None, log_obj=None, write_dots=False, on_out=None, on_err=None,
+                      ant_answer=True, cwd=None, timeout=None, out_capture=None, err_capture=None, responder=None,
+                      label=None, run_as=None):
+        """
+        Schedules command line task to the event loop, returns the job immediately.
+        Asynchronous variant of cli_cmd, see util.cli_cmd_async
+        :return: CmdJob
+        """
+        default_cwd = self.get_ejbca_home()
+        if on_out is None and responder is None and ant_answer:
+            responder = self.get_ant_responder()
         cwd = cwd if cwd is not None else default_cwd
 
-        return util.cli_cmd_sync(cmd, log_obj=log_obj, write_dots=write_dots, on_out=on_out, on_err=on_err, cwd=cwd)
+        return util.cli_cmd_async(cmd, loop=loop, log_obj=log_obj, write_dots=write_dots,
+                                  on_out=on_out, on_err=on_err, cwd=cwd, timeout=timeout,
+                                  out_capture=out_capture, err_capture=err_capture, responder=responder,
+                                  label=label, run_as=run_as)
 
-    def ant_cmd(self, cmd, log_obj=None, write_dots=False, on_out=None, on_err=None):
-        ret, out, err = self.cli_cmd('sudo -E -H -u %s ant %s' % (self.JBOSS_USER, cmd),
+    def ant_get_command(self, cmd):
+        return ['ant'] + cmd.split(' ')
+
+    def ant_cmd(self, cmd, log_obj=None, write_dots=False, on_out=None, on_err=None, responder=None,
+                out_capture=None, err_capture=None):
+        """
+        Runs ant task. Only the tail of the output is returned, the whole output is in the log.
+        :return:
+        """
+        out_capture = out_capture if out_capture is not None else self.get_capture()
+        err_capture = err_capture if err_capture is not None else self.get_capture()
+        ret, out, err = self.cli_cmd(self.ant_get_command(cmd),
                                      log_obj=log_obj, write_dots=write_dots,
-                                     on_out=on_out, on_err=on_err, ant_answer=True)
+                                     on_out=on_out, on_err=on_err, ant_answer=True, responder=responder,
+                                     run_as=self.get_jboss_run_as(),
+                                     label='ant %s' % cmd, out_capture=out_capture, err_capture=err_capture)
         if ret != 0:
             sys.stderr.write('\nError, process returned with invalid result code: %s\n' % ret)
             if isinstance(log_obj, types.StringTypes):
@@ -254,51 +422,220 @@ class Ejbca(object):
     def ant_deployear(self):
         return self.ant_cmd('deployear', log_obj='/tmp/ant-deployear.log', write_dots=self.print_output)
 
+    def ant_deploy_services(self, out_capture=None, err_capture=None):
+        return self.ant_cmd(self.ANT_DEPLOY_SERVICES, log_obj='/tmp/ant-deploy-services.log',
+                            write_dots=self.print_output, out_capture=out_capture, err_capture=err_capture)
+
+    def get_ant_responder(self):
+        """
+        Ant prompts - use default values, no starving
+        :return:
+        """
+        return process.PromptResponder(self.ANT_DEFAULT_PROMPTS)
+
+    def get_ant_install_responder(self):
+        """
+        Ant install prompts, first matching rule wins
+        :return:
+        """
+        return process.PromptResponder([
+            process.PromptRule(text='truststore with the CA certificate for https', response=self.java_pass + '\n'),
+            process.PromptRule(text='keystore with the TLS key for https', response=self.http_pass + '\n'),
+            process.PromptRule(text='the superadmin password', response=self.superadmin_pass + '\n'),
+            process.PromptRule(text='password CA token password', response='\n'),
+        ] + self.ANT_DEFAULT_PROMPTS)
+
     def ant_answer(self, out, feeder, p=None, *args, **kwargs):
-        out = out.strip()
-        if out.startswith('Please enter'):            # default - use default value, no starving
-            feeder.feed('\n')
-        elif out.startswith('[input] Please enter'):  # default - use default value, no starving
-            feeder.feed('\n')
+        self.get_ant_responder().answer(out, feeder, p)
 
     def ant_install_answer(self, out, feeder, p=None, *args, **kwargs):
-        out = out.strip()
-        if 'truststore with the CA certificate for https' in out:
-            feeder.feed(self.java_pass + '\n')
-        elif 'keystore with the TLS key for https' in out:
-            feeder.feed(self.http_pass + '\n')
-        elif 'the superadmin password' in out:
-            feeder.feed(self.superadmin_pass + '\n')
-        elif 'password CA token password' in out:
-            feeder.feed('\n')
-        elif out.startswith('Please enter'):          # default - use default value, no starving
-            feeder.feed('\n')
-        elif out.startswith('[input] Please enter'):  # default - use default value, no starving
-            feeder.feed('\n')
+        self.get_ant_install_responder().answer(out, feeder, p)
 
     def ant_install(self):
         """
         Installation
         :return:
         """
-        return self.ant_cmd('install', log_obj='/tmp/ant-install.log', write_dots=self.print_output, on_out=self.ant_install_answer)
+        return self.ant_cmd('install', log_obj='/tmp/ant-install.log', write_dots=self.print_output,
+                            responder=self.get_ant_install_responder())
 
     def ant_client_tools(self):
         return self.ant_cmd('clientToolBox', log_obj='/tmp/ant-clientToolBox.log', write_dots=self.print_output)
 
-    def jboss_cmd(self, cmd):
+    def get_jboss_run_as(self):
+        """
+        JBoss user identity for ant and jboss-cli commands
+        :return:
+        """
+        return process.RunAs(self.JBOSS_USER)
+
+    def jboss_get_command(self, cmd):
         cli = os.path.abspath(os.path.join(self.get_jboss_home(), self.JBOSS_CLI))
-        cli_cmd = 'sudo -E -H -u %s %s -c \'%s\'' % (self.JBOSS_USER, cli, cmd)
+        return [cli, '-c', cmd]
 
+    def jboss_cmd(self, cmd, out_capture=None):
         with open('/tmp/jboss-cli.log', 'a+') as logger:
-            ret, out, err = self.cli_cmd(cli_cmd, log_obj=logger,
+            ret, out, err = self.cli_cmd(self.jboss_get_command(cmd), log_obj=logger,
                                          write_dots=self.print_output, ant_answer=False,
-                                         cwd=self.get_jboss_home())
+                                         cwd=self.get_jboss_home(), out_capture=out_capture, label='jboss-cli',
+                                         run_as=self.get_jboss_run_as())
             return ret, out, err
 
+    def jboss_batch(self, cmds):
+        """
+        Runs several jboss-cli operations in one jboss-cli invocation (single JVM start).
+        If the script output cannot be parsed (e.g., CLI without try/catch support),
+        operations are executed one by one.
+
+        :param cmds: list of jboss-cli commands
+        :return: JBossCliScript with per-operation results
+        """
+        script = jboss.JBossCliScript(cmds)
+        if len(script) == 0:
+            return script
+
+        fhnd, fname = util.unique_file(self.JBOSS_CLI_SCRIPT, mode=0o644)
+        try:
+            fhnd.write(script.build())
+            fhnd.close()
+
+            cli = os.path.abspath(os.path.join(self.get_jboss_home(), self.JBOSS_CLI))
+            with open('/tmp/jboss-cli.log', 'a+') as logger:
+                ret, out, err = self.cli_cmd([cli, '-c', '--file=%s' % fname], log_obj=logger,
+                                             write_dots=self.print_output, ant_answer=False,
+                                             cwd=self.get_jboss_home(), label='jboss-cli',
+                                             run_as=self.get_jboss_run_as())
+        finally:
+            if os.path.exists(fname):
+                os.remove(fname)
+
+        script.parse(out)
+        if script.is_parsed():
+            return script
+
+        for op in script.ops:
+            ret, out, err = self.jboss_cmd(op.cmd)
+            op.executed = True
+            op.failed = ret != 0
+            op.out = out
+        return script
+
+    def jboss_cmd_async(self, cmd, loop=None, timeout=None):
+        """
+        Schedules jboss-cli command to the event loop
+        :return: CmdJob
+        """
+        return self.cli_cmd_async(self.jboss_get_command(cmd), loop=loop, log_obj=None, write_dots=self.print_output,
+                                  ant_answer=False, cwd=self.get_jboss_home(), timeout=timeout, label='jboss-cli',
+                                  run_as=self.get_jboss_run_as())
+
+    def jboss_add_mgmt_user(self, password=None):
+        """
+        Creates the management user for the HTTP management API client.
+        The user is written to mgmt-users.properties the same way add-user.sh does it,
+        so the password does not appear on any command line.
+        The password is kept in jboss_mgmt_password and stored to the config, if any.
+        :param password: password to set, the configured one or random if None
+        :return: 0 on success
+        """
+        if password is None:
+            password = self.get_jboss_mgmt_password()
+        if password is None:
+            password = util.random_password(16) + '.1'
+
+        digest = hashlib.md5('%s:%s:%s' % (self.JBOSS_MGMT_USER, self.JBOSS_MGMT_REALM, password)).hexdigest()
+        entry = '%s=%s\n' % (self.JBOSS_MGMT_USER, digest)
+        paths = [os.path.join(self.get_jboss_home(), x) for x in self.JBOSS_MGMT_USERS]
+        try:
+            written = 0
+            for path in [x for x in paths if os.path.exists(x)]:
+                self.jboss_write_mgmt_user(path, entry)
+                written += 1
+            if written == 0:
+                raise IOError('No management users file in %s' % self.get_jboss_home())
+
+        except (IOError, OSError) as e:
+            logger.warning('Could not add the JBoss management user, management API client disabled: %s' % e)
+            return 1
+
+        self.jboss_mgmt_password = password
+        self.mgmt_client = None
+        if self.config is not None:
+            self.config.jboss_mgmt_password = password
+        return 0
+
+    def jboss_write_mgmt_user(self, path, entry):
+        """
+        Replaces the management user entry in the properties file, owner and permissions are kept
+        :param path:
+        :param entry: user=hash line
+        :return:
+        """
+        with open(path, 'r') as f:
+            lines = f.readlines()
+
+        prefixes = [self.JBOSS_MGMT_USER + '=', '#' + self.JBOSS_MGMT_USER + '=']
+        lines = [x for x in lines if not any(x.lstrip().startswith(p) for p in prefixes)]
+        if len(lines) > 0 and not lines[-1].endswith('\n'):
+            lines[-1] += '\n'
+        lines.append(entry)
+
+        stat = os.stat(path)
+        tmp_path = path + '.tmp'
+        with os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, stat.st_mode & 0o777), 'w') as f:
+            f.write(''.join(lines))
+        os.chown(tmp_path, stat.st_uid, stat.st_gid)
+        os.rename(tmp_path, path)
+
+    def get_jboss_mgmt_password(self):
+        """
+        Password of the management user, set by jboss_add_mgmt_user() or loaded from the config
+        :return:
+        """
+        if self.jboss_mgmt_password is not None:
+            return self.jboss_mgmt_password
+        return self.config.jboss_mgmt_password if self.config is not None else None
+
+    def get_mgmt_client(self):
+        """
+        HTTP management API client, None if the management user is not configured
+        :return: JBossManagementClient
+        """
+        if self.mgmt_client is not None:
+            return self.mgmt_client
+        password = self.get_jboss_mgmt_password()
+        if password is None:
+            if not self.mgmt_client_warned:
+                logger.warning('JBoss management user is not configured, management API client disabled')
+                self.mgmt_client_warned = True
+            return None
+
+        self.mgmt_client = jboss.JBossManagementClient(user=self.JBOSS_MGMT_USER, password=password)
+        return self.mgmt_client
+
+    def jboss_mgmt_call(self, fnc):
+        """
+        Calls fnc(client) with the management API client.
+        :return: fnc result, False if the server is not reachable, None if the API cannot be used (use jboss-cli)
+        """
+        client = self.get_mgmt_client()
+        if client is None:
+            return None
+
+        try:
+            return fnc(client)
+        except errors.RequestFailed as e:
+            logger.debug('Management API request failed: %s' % e)
+            return False
+        except (errors.AccessDenied, errors.InvalidResponse) as e:
+            logger.info('Management API not usable, using jboss-cli: %s' % e)
+            self.mgmt_client = None
+            return None
+
     def jboss_reload(self):
-        ret = self.jboss_cmd(':reload')
-        time.sleep(3)
+        res = self.jboss_mgmt_call(lambda x: x.reload())
+        ret = self.jboss_cmd(':reload') if res is None else (0 if res else 1, [], [])
+        self.jboss_wait_stopped(timeout=3)
         self.jboss_wait_after_start()
         return ret
 
@@ -306,10 +643,22 @@ class Ejbca(object):
         return self.jboss_cmd('undeploy ejbca.ear')
 
     def jboss_remove_datasource(self):
-        return self.jboss_cmd('data-source remove --name=ejbcads')
+        return self.jboss_cmd('data-source remove --name=%s' % self.JBOSS_DATASOURCE)
+
+    def jboss_has_datasource(self):
+        """
+        Checks the EJBCA datasource is defined
+        :return:
+        """
+        ret, out, err = self.jboss_cmd('/subsystem=datasources/data-source=%s:read-resource' % self.JBOSS_DATASOURCE)
+        return ret == 0 and '"outcome" => "success"' in ''.join(out)
 
     def jboss_rollback_ejbca(self):
-        cmds = ['/core-service=management/security-realm=SSLRealm/authentication=truststore:remove',
+        self.jboss_batch(self.jboss_get_rollback_cmds())
+        self.jboss_reload()
+
+    def jboss_get_rollback_cmds(self):
+        return ['/core-service=management/security-realm=SSLRealm/authentication=truststore:remove',
                 '/core-service=management/security-realm=SSLRealm/server-identity=ssl:remove',
                 '/core-service=management/security-realm=SSLRealm:remove',
 
@@ -333,9 +682,6 @@ class Ejbca(object):
                 '/interface=http:remove',
                 '/interface=httpspub:remove',
                 '/interface=httpspriv:remove']
-        for cmd in cmds:
-            self.jboss_cmd(cmd)
-        self.jboss_reload()
 
     def jboss_backup_database(self):
         """
@@ -355,71 +701,93 @@ class Ejbca(object):
         return backup1, backup2, backup3
 
     def jboss_fix_privileges(self):
-        p = subprocess.Popen('sudo chown -R %s:%s %s' % (self.JBOSS_USER, self.JBOSS_USER, self.get_jboss_home()), shell=True)
-        p.wait()
-        p = subprocess.Popen('sudo chown -R %s:%s %s' % (self.JBOSS_USER, self.JBOSS_USER, self.get_ejbca_home()), shell=True)
-        p.wait()
+        owner = '%s:%s' % (self.JBOSS_USER, self.JBOSS_USER)
+        for path in [self.get_jboss_home(), self.get_ejbca_home()]:
+            p = subprocess.Popen(['chown', '-R', owner, path])
+            p.wait()
 
-    def jboss_wait_after_start(self):
+    def jboss_is_running(self):
         """
-        Waits until JBoss responds with success after start
+        Returns True if JBoss server state is running
         :return:
         """
-        jboss_works = False
-        max_attempts = 30
+        res = self.jboss_mgmt_call(lambda x: x.is_running())
+        if res is not None:
+            return res
 
-        for i in range(0, max_attempts):
-            if i > 0:
-                if self.print_output:
-                    sys.stderr.write('.')
-                time.sleep(3)
+        try:
+            capture = self.get_capture()
+            capture.watch(r'["\']?outcome["\']?\s*=>\s*["\']?success["\']?', name='success')
+            capture.watch(r'["\']?result["\']?\s*=>\s*["\']?running["\']?', name='running')
 
-            try:
-                ret, out, err = self.jboss_cmd(':read-attribute(name=server-state)')
-                if out is None or len(out) == 0:
-                    continue
+            self.jboss_cmd(':read-attribute(name=server-state)', out_capture=capture)
+            return capture.matched('success') and capture.matched('running')
 
-                out_total = '\n'.join(out)
+        except Exception as ex:
+            return False
 
-                if re.search(r'["\']?outcome["\']?\s*=>\s*["\']?success["\']?', out_total) and \
-                        re.search(r'["\']?result["\']?\s*=>\s*["\']?running["\']?', out_total):
-                    jboss_works = True
-                    break
+    def jboss_is_deployed(self):
+        """
+        Returns True if EJBCA is deployed
+        :return:
+        """
+        res = self.jboss_mgmt_call(lambda x: x.is_deployed('ejbca.ear'))
+        if res is not None:
+            return res
 
-            except Exception as ex:
-                continue
+        try:
+            capture = self.get_capture()
+            capture.watch(r'ejbca.ear.+?\sOK', name='deployed')
 
-        return jboss_works
+            self.jboss_cmd('deploy -l', out_capture=capture)
+            return capture.matched('deployed')
 
-    def jboss_wait_after_deploy(self):
+        except Exception as ex:
+            return False
+
+    def jboss_wait(self, predicate, timeout=None):
         """
-        Waits for JBoss to finish initial deployment.
+        Polls the predicate with backoff until it holds or the timeout elapses
+        :param predicate:
+        :param timeout:
         :return:
         """
-        jboss_works = False
-        max_attempts = 30
-
-        for i in range(0, max_attempts):
-            if i > 0:
-                if self.print_output:
-                    sys.stderr.write('.')
-                time.sleep(3)
+        def check():
+            res = predicate()
+            if not res and self.print_output:
+                sys.stderr.write('.')
+            return res
 
-            try:
-                ret, out, err = self.jboss_cmd('deploy -l')
-                if out is None or len(out) == 0:
-                    continue
+        timeout = timeout if timeout is not None else self.JBOSS_WAIT_TIMEOUT
+        return bool(util.wait_until(check, timeout=timeout, interval=0.5, max_interval=3))
 
-                out_total = '\n'.join(out)
+    def jboss_wait_stopped(self, timeout=10):
+        """
+        Waits until the running server goes down - restart / reload is in progress
+        :param timeout:
+        :return:
+        """
+        def stopped():
+            res = self.jboss_mgmt_call(lambda x: x.is_running())
+            if res is not None:
+                return not res
+            return not util.is_port_listening('127.0.0.1', self.JBOSS_MGMT_PORT)
 
-                if re.search(r'ejbca.ear.+?\sOK', out_total):
-                    jboss_works = True
-                    break
+        return util.wait_until(stopped, timeout=timeout, interval=0.2, max_interval=1)
 
-            except Exception as ex:
-                continue
+    def jboss_wait_after_start(self):
+        """
+        Waits until JBoss responds with success after start
+        :return:
+        """
+        return self.jboss_wait(self.jboss_is_running)
 
-        return jboss_works
+    def jboss_wait_after_deploy(self):
+        """
+        Waits for JBoss to finish initial deployment.
+        :return:
+        """
+        return self.jboss_wait(self.jboss_is_deployed)
 
     def jboss_restart(self):
         """
@@ -428,9 +796,9 @@ class Ejbca(object):
         Otherwise Jboss would have been killed in case python terminates.
         :return:
         """
-        os.spawnlp(os.P_NOWAIT, "sudo", "bash", "bash", "-c",
+        os.spawnlp(os.P_NOWAIT, "bash", "bash", "-c",
                    "setsid /etc/init.d/jboss-eap-6.4.0 restart 2>/dev/null >/dev/null </dev/null &")
-        time.sleep(10)
+        self.jboss_wait_stopped(timeout=10)
         return self.jboss_wait_after_start()
 
     def backup_passwords(self):
@@ -446,6 +814,28 @@ class Ejbca(object):
             f.write('superadmin.password=%s\n' % self.superadmin_pass)
             f.flush()
 
+    def load_passwords(self):
+        """
+        Loads the generated passwords from the backup file, e.g., when the installation is resumed
+        :return: 0 on success, None if there is no backup
+        """
+        if not os.path.exists(self.PASSWORDS_FILE):
+            return None
+
+        props = {}
+        with open(self.PASSWORDS_FILE, 'r') as f:
+            for line in f:
+                if '=' in line:
+                    k, v = line.strip().split('=', 1)
+                    props[k] = v
+
+        if 'httpsserver.password' not in props or 'superadmin.password' not in props:
+            return None
+
+        self.http_pass = props['httpsserver.password']
+        self.superadmin_pass = props['superadmin.password']
+        return 0
+
     def get_p12_file(self):
         return os.path.abspath(os.path.join(self.get_ejbca_home(), self.P12_FILE))
 
@@ -464,7 +854,7 @@ class Ejbca(object):
             with util.safe_open(new_p12, mode='w', chmod=0o600) as dst_p12:
                 shutil.copyfileobj(src_p12, dst_p12)
 
-        p = subprocess.Popen('sudo chown %s:%s %s' % (self.SSH_USER, self.SSH_USER, new_p12), shell=True)
+        p = subprocess.Popen(['chown', '%s:%s' % (self.SSH_USER, self.SSH_USER), new_p12])
         p.wait()
 
         return new_p12
@@ -473,13 +863,71 @@ class Ejbca(object):
         return os.path.join(self.get_ejbca_home(), 'bin')
 
     def ejbca_get_command(self, cmd):
-        return 'sudo -E -H -u %s %s/ejbca.sh %s' % (self.JBOSS_USER, self.ejbca_get_cwd(), cmd)
+        return '%s/ejbca.sh %s' % (self.ejbca_get_cwd(), cmd)
+
+    def get_jvm_session(self):
+        """
+        Returns the started JVM session for the EJBCA tools, None if the session cannot be used
+        :return:
+        """
+        if not self.use_jvm_session:
+            return None
+
+        if self.jvm_session is None:
+            session = jvmsession.JvmSession(run_as=self.get_jboss_run_as(), cwd=self.ejbca_get_cwd())
+            if not session.is_available():
+                self.use_jvm_session = False
+                return None
+            self.jvm_session = session
+        return self.jvm_session
+
+    def jvm_session_cmd(self, jar, cmd, stdin='', write_dots=False, on_out=None, on_err=None):
+        """
+        Executes the tool command in the JVM session.
+        Session failure disables the session, commands then start their own JVM.
+        Output callbacks are called once the command finished, without the feeder and the process.
+        :param jar: jar relative to the EJBCA home
+        :param cmd: list of arguments
+        :param stdin: data for the standard input
+        :param write_dots:
+        :param on_out:
+        :param on_err:
+        :return: (ret, out, err), None if the command was not executed in the session
+        """
+        jar = os.path.join(self.get_ejbca_home(), jar)
+        session = self.get_jvm_session()
+        if session is None or not os.path.exists(jar):
+            return None
+
+        try:
+            ret, out, err = session.execute(jar, cmd, stdin=stdin)
+        except (errors.Error, IOError, OSError) as e:
+            logger.warning('JVM session failed, falling back to per-command execution: %s' % e)
+            self.jvm_session_close()
+            self.use_jvm_session = False
+            return None
+
+        for lines, callback in [(out, on_out), (err, on_err)]:
+            for line in lines:
+                if write_dots:
+                    sys.stderr.write('.')
+                if callback is not None:
+                    callback(line, None, None)
+        return ret, out, err
+
+    def jvm_session_close(self):
+        if self.jvm_session is not None:
+            self.jvm_session.close()
+            self.jvm_session = None
 
     def ejbca_cmd(self, cmd, retry_attempts=3, write_dots=False, on_out=None, on_err=None):
         """
         Executes cd $EJBCA_HOME/bin
         ./ejbca.sh $*
 
+        Executed in the JVM session if possible, the remaining attempts after a failure in the session
+        run the script.
+
         :param cmd:
         :param retry_attempts:
         :return:
@@ -487,19 +935,39 @@ class Ejbca(object):
         cwd = self.ejbca_get_cwd()
         ret, out, err = -1, None, None
         cmd_exec = self.ejbca_get_command(cmd)
+        use_session = True
 
         for i in range(0, retry_attempts):
+            res = self.jvm_session_cmd(self.EJBCA_CLI_JAR, shlex.split(cmd), write_dots=write_dots,
+                                       on_out=on_out, on_err=on_err) if use_session else None
+            if res is not None:
+                ret, out, err = res
+                if ret == 0:
+                    return ret, out, err
+                use_session = False
+                continue
+
             ret, out, err = self.cli_cmd(
                 cmd_exec,
                 log_obj=None, write_dots=write_dots,
                 on_out=on_out, on_err=on_err,
-                ant_answer=False, cwd=cwd)
+                ant_answer=False, cwd=cwd, label='ejbca', run_as=self.get_jboss_run_as())
 
             if ret == 0:
                 return ret, out, err
 
         return ret, out, err
 
+    def ejbca_cmd_async(self, cmd, loop=None, write_dots=False, on_out=None, on_err=None, timeout=None):
+        """
+        Schedules ejbca.sh command to the event loop, single attempt.
+        :return: CmdJob
+        """
+        return self.cli_cmd_async(self.ejbca_get_command(cmd), loop=loop, write_dots=write_dots,
+                                  on_out=on_out, on_err=on_err, ant_answer=False,
+                                  cwd=self.ejbca_get_cwd(), timeout=timeout, label='ejbca',
+                                  run_as=self.get_jboss_run_as())
+
     def ejbca_add_softhsm_token(self, softhsm=None, name='EnigmaBridge', slot_id=0):
         """
         Adds a new crypto token to the EJBCA using CLI
@@ -525,38 +993,82 @@ class Ejbca(object):
         return os.path.join(self.get_ejbca_home(), 'bin')
 
     def pkcs11_get_command(self, cmd):
-        return 'sudo -E -H -u %s %s/pkcs11HSM.sh %s' % (self.JBOSS_USER, self.pkcs11_get_cwd(), cmd)
+        return '%s/pkcs11HSM.sh %s' % (self.pkcs11_get_cwd(), cmd)
+
+    def pkcs11_get_user_command(self, cmd):
+        """
+        Command for the user to run manually, under the JBoss user
+        :param cmd:
+        :return:
+        """
+        return 'sudo -E -H -u %s %s' % (self.JBOSS_USER, self.pkcs11_get_command(cmd))
 
-    def pkcs11_cmd(self, cmd, retry_attempts=3, write_dots=False, on_out=None, on_err=None):
+    def pkcs11_cmd(self, cmd, retry_attempts=3, write_dots=False, on_out=None, on_err=None, responder=None,
+                   session_input=None):
         """
         Executes cd $EJBCA_HOME/bin
         ./pkcs11HSM.sh $*
 
+        Executed in the JVM session if possible - only if the command does not need
+        the interactive responder, or the answers are given upfront in session_input.
+        The remaining attempts after a failure in the session run the script.
+
         :param cmd:
         :param retry_attempts:
+        :param session_input: standard input for the command in the JVM session
         :return:
         """
         cwd = self.pkcs11_get_cwd()
         ret, out, err = -1, None, None
         cmd_exec = self.pkcs11_get_command(cmd)
+        use_session = responder is None or session_input is not None
 
         for i in range(0, retry_attempts):
+            res = self.jvm_session_cmd(self.CLIENT_TOOLBOX_JAR, [self.PKCS11_TOOL] + shlex.split(cmd),
+                                       stdin=session_input if session_input is not None else '',
+                                       write_dots=write_dots, on_out=on_out, on_err=on_err) \
+                if use_session else None
+            if res is not None:
+                ret, out, err = res
+                if ret == 0:
+                    return ret, out, err
+                use_session = False
+                continue
+
             ret, out, err = self.cli_cmd(
                 cmd_exec,
                 log_obj=None, write_dots=write_dots,
                 on_out=on_out, on_err=on_err,
-                ant_answer=False, cwd=cwd)
+                ant_answer=False, cwd=cwd, responder=responder, label='pkcs11',
+                run_as=self.get_jboss_run_as())
 
             if ret == 0:
                 return ret, out, err
 
         return ret, out, err
 
+    def pkcs11_cmd_async(self, cmd, loop=None, write_dots=False, on_out=None, on_err=None, timeout=None,
+                         responder=None):
+        """
+        Schedules pkcs11HSM.sh command to the event loop, single attempt.
+        :return: CmdJob
+        """
+        return self.cli_cmd_async(self.pkcs11_get_command(cmd), loop=loop, write_dots=write_dots,
+                                  on_out=on_out, on_err=on_err, ant_answer=False,
+                                  cwd=self.pkcs11_get_cwd(), timeout=timeout, responder=responder,
+                                  label='pkcs11', run_as=self.get_jboss_run_as())
+
+    def get_pkcs11_responder(self):
+        """
+        Token password prompt, printed without a newline
+        :return:
+        """
+        return process.PromptResponder([
+            process.PromptRule(text='Password:', response='0000\n'),
+        ])
+
     def pkcs11_answer(self, out, feeder, p=None, *args, **kwargs):
-        out = out.strip()
-        if 'Password:' in out:
-            feeder.feed('0000')
-            feeder.feed('\n')
+        self.get_pkcs11_responder().answer(out, feeder, p)
 
     def pkcs11_get_generate_key_cmd(self, softhsm=None, bit_size=2048, alias=None, slot_id=0):
         so_path = softhsm.get_so_path() if softhsm is not None else SoftHsmV1Config.SOFTHSM_SO_PATH
@@ -577,32 +1089,108 @@ class Ejbca(object):
         """
         cmd = self.pkcs11_get_generate_key_cmd(softhsm=softhsm, bit_size=bit_size, alias=alias, slot_id=slot_id)
         return self.pkcs11_cmd(cmd=cmd, retry_attempts=retry_attempts, write_dots=self.print_output,
-                               on_out=self.pkcs11_answer, on_err=self.pkcs11_answer)
+                               responder=self.get_pkcs11_responder(), session_input=self.PKCS11_PIN_INPUT * 3)
+
+    def pkcs11_get_key_set(self, prefix='key', count=1, bit_size=2048):
+        """
+        Key set of count keys with aliases prefix0, prefix1, ...
+        :return: list of (alias, bit size)
+        """
+        return [('%s%d' % (prefix, i), bit_size) for i in range(0, count)]
+
+    def pkcs11_generate_key_set(self, keys, softhsm=None, slot_id=0, retry_attempts=3, workers=None,
+                                backoff=1.0):
+        """
+        Generates the keys one by one in the JVM session by default.
+        With more workers the keys are generated concurrently, each key in its own pkcs11HSM.sh process,
+        bypassing the JVM session. Use only with tokens supporting concurrent writers (not SoftHSM v1).
+        Failed key is retried after backoff, doubled with each attempt.
+
+        :param keys: list of (alias, bit size)
+        :param softhsm:
+        :param slot_id:
+        :param retry_attempts: attempts per key
+        :param workers: maximal number of concurrent generations, 1 = sequential in the JVM session (default)
+        :param backoff: initial retry delay in seconds
+        :return: dict alias -> (ret, out, err)
+        """
+        workers = workers if workers is not None else self.PKCS11_KEYGEN_WORKERS
+        if workers <= 1:
+            results = {}
+            for alias, bit_size in keys:
+                results[alias] = self.pkcs11_generate_key(softhsm=softhsm, bit_size=bit_size, alias=alias,
+                                                          slot_id=slot_id, retry_attempts=retry_attempts)
+                if self.print_output:
+                    sys.stderr.write('.')
+            return results
+
+        loop = process.CmdLoop()
+        pending = list(keys)
+        delayed = []
+        running = []
+        attempts = {}
+        results = {}
+
+        while len(pending) > 0 or len(delayed) > 0 or len(running) > 0:
+            now = time.time()
+            for item in [x for x in delayed if x[0] <= now]:
+                delayed.remove(item)
+                pending.append(item[1])
+
+            while len(running) < workers and len(pending) > 0:
+                alias, bit_size = pending.pop(0)
+                attempts[alias] = attempts.get(alias, 0) + 1
+                cmd = self.pkcs11_get_generate_key_cmd(softhsm=softhsm, bit_size=bit_size, alias=alias,
+                                                       slot_id=slot_id)
+                job = self.pkcs11_cmd_async(cmd, loop=loop, timeout=self.PKCS11_KEYGEN_TIMEOUT,
+                                            responder=self.get_pkcs11_responder())
+                running.append((job, (alias, bit_size)))
+
+            timeout = min([x[0] for x in delayed]) - time.time() if len(delayed) > 0 else None
+            if len(running) == 0:
+                time.sleep(max(0, timeout))
+                continue
+
+            loop.step(timeout if timeout is None else max(0, timeout))
+            for job, key in [x for x in running if x[0].done]:
+                running.remove((job, key))
+                alias = key[0]
+                if job.returncode != 0 and attempts[alias] < retry_attempts:
+                    logger.debug('Key %s generation failed, code %s, attempt %d'
+                                 % (alias, job.returncode, attempts[alias]))
+                    delayed.append((time.time() + backoff * (2 ** (attempts[alias] - 1)), key))
+                    continue
+
+                results[alias] = job.result()
+                if self.print_output:
+                    sys.stderr.write('.')
+
+        return results
 
     def pkcs11_generate_default_key_set(self, softhsm=None, slot_id=0, retry_attempts=3,
                                         sign_key_alias='signKey',
                                         default_key_alias='defaultKey',
-                                        test_key_alias='testKey'):
+                                        test_key_alias='testKey',
+                                        keys=None, workers=None):
         """
         Generates a default key set to be used with EJBCA
         :param sign_key_alias:
         :param default_key_alias:
         :param test_key_alias:
-        :return:
+        :param keys: custom key set, list of (alias, bit size)
+        :param workers: concurrent generations, sequential in the JVM session by default
+        :return: result of the first failed key, (0, None, None) on success
         """
-        aliases = [sign_key_alias, default_key_alias, test_key_alias]
-        key_sizes = [2048, 2048, 1024]
-
-        for idx,alias in enumerate(aliases):
-            key_size = key_sizes[idx]
-            ret, out, cmd = self.pkcs11_generate_key(softhsm=softhsm, bit_size=key_size, alias=alias,
-                                                     slot_id=slot_id, retry_attempts=retry_attempts)
-
+        if keys is None:
+            aliases = [sign_key_alias, default_key_alias, test_key_alias]
+            keys = [(alias, self.PKCS11_DEFAULT_KEY_SET[idx][1]) for idx, alias in enumerate(aliases)]
+
+        results = self.pkcs11_generate_key_set(keys, softhsm=softhsm, slot_id=slot_id,
+                                               retry_attempts=retry_attempts, workers=workers)
+        for alias, bit_size in keys:
+            ret, out, err = results[alias]
             if ret != 0:
-                return ret, out, cmd
-
-            if self.print_output:
-                sys.stderr.write('.')
+                return ret, out, err
         return 0, None, None
 
     def get_keystore_path(self):
@@ -631,10 +1219,50 @@ class Ejbca(object):
 
         # Update domain DNS settings
         self.reg_svc.refresh_domain_call(dns_data=dns_data)
+        self.le_dns_wait_propagation([(domain, token)])
 
         # Call done callback
         done()
 
+    def le_dns_batch(self, challenges=None, mdns=None, p=None, done=None, abort=None, *args, **kwargs):
+        """
+        DNS challenge solver for LE DNS verification, publishes TXT records for all domains in one update
+        :param challenges: list of (txt domain, token) pairs
+        :param mdns:
+        :param p:
+        :param done:
+        :param abort:
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        if challenges is None or len(challenges) == 0:
+            raise ValueError('No challenges to publish')
+        if done is None:
+            raise ValueError('Cannot signalize done - its None')
+
+        dns_data = self.reg_svc.txt_le_validation_dns_data([(domain.split('.', 1)[1], token)
+                                                            for domain, token in challenges])
+        self.reg_svc.refresh_domain_call(dns_data=dns_data)
+        self.le_dns_wait_propagation(challenges)
+        done()
+
+    def le_dns_wait_propagation(self, challenges):
+        """
+        Waits until the authoritative nameservers serve the TXT records, LetsEncrypt validation fails otherwise.
+        On timeout the challenges are released anyway, the validation may still succeed.
+        :param challenges: list of (txt domain, token) pairs
+        :return: True if propagated
+        """
+        try:
+            if dnscheck.PropagationChecker().wait_for_txt(challenges):
+                return True
+            logger.warning('DNS TXT records not propagated to all nameservers in time')
+
+        except errors.Error as e:
+            logger.warning('DNS propagation check failed: %s' % e)
+        return False
+
     def get_le_method(self, le_method=None):
         """
         Decides which method to use.
@@ -667,7 +1295,8 @@ class Ejbca(object):
 
         ret, out, err = -1, None, None
         if le_method == LE_VERIFY_DNS:
-            mdns = self.lets_encrypt.manual_dns(expand=True, on_domain_challenge=self.le_dns)
+            mdns = self.lets_encrypt.manual_dns(expand=True, on_domain_challenge=self.le_dns,
+                                                on_domain_challenges=self.le_dns_batch)
             ret, out, err = mdns.start()
         else:
             ret, out, err = self.lets_encrypt.certonly()
@@ -688,7 +1317,8 @@ class Ejbca(object):
             jks_path=jks_path,
             jks_alias=self.hostname,
             password=self.http_pass,
-            print_output=self.print_output)
+            print_output=self.print_output,
+            owner=self.JBOSS_USER)
 
         ret = self.lets_encrypt_jks.convert()
         if ret != 0:
@@ -717,7 +1347,8 @@ class Ejbca(object):
 
         ret, out, err = -1, None, None
         if le_method == LE_VERIFY_DNS:
-            mdns = self.lets_encrypt.manual_dns(expand=True, on_domain_challenge=self.le_dns)
+            mdns = self.lets_encrypt.manual_dns(expand=True, on_domain_challenge=self.le_dns,
+                                                on_domain_challenges=self.le_dns_batch)
             ret, out, err = mdns.start()
         else:
             ret, out, err = self.lets_encrypt.renew()
@@ -740,7 +1371,8 @@ class Ejbca(object):
             jks_path=jks_path,
             jks_alias=self.hostname,
             password=self.http_pass,
-            print_output=self.print_output)
+            print_output=self.print_output,
+            owner=self.JBOSS_USER)
 
         ret = self.lets_encrypt_jks.convert()
         if ret != 0:
@@ -754,24 +1386,30 @@ class Ejbca(object):
         Undeploys EJBCA installation
         :return:
         """
-        self.jboss_undeploy()
-        self.jboss_remove_datasource()
-        self.jboss_rollback_ejbca()
+        cmds = ['undeploy ejbca.ear',
+                'data-source remove --name=ejbcads'] + self.jboss_get_rollback_cmds()
+        self.jboss_batch(cmds)
         self.jboss_reload()
 
-    def configure(self):
+    def jboss_prepare(self):
         """
-        Configures EJBCA for installation deployment
-        :return:
+        Makes JBoss clean for the EJBCA deployment.
+        Restart, undeploy original EJBCA, restart, database backup, reload.
+        :return: 0 on success
         """
+        ret = self.jboss_prepare_start()
+        if ret != 0:
+            return ret
+        return self.jboss_prepare_clean()
 
-        # 1. update properties file
-        if self.print_output:
-            print " - Updating settings"
-        self.update_properties()
-        self.backup_passwords()
-        if self.config is not None:
-            self.config.ejbca_jks_password = self.http_pass
+    def jboss_prepare_start(self, mgmt_password=None):
+        """
+        Non-destructive part of jboss_prepare(), adds the management user and restarts JBoss.
+        Does not depend on the EJBCA configuration, can run before it is known.
+        :param mgmt_password: management user password, the configured one or random if None
+        :return: 0 on success
+        """
+        self.jboss_add_mgmt_user(password=mgmt_password)
 
         # Restart jboss - to make sure it is running
         if self.print_output:
@@ -780,8 +1418,15 @@ class Ejbca(object):
         if not jboss_works:
             print "\n Application server (JBoss) could not be restarted. Please, resolve the problem and start again"
             return 100
+        return 0
 
-        # 2. Undeploy original EJBCA, make JBoss clean
+    def jboss_prepare_clean(self):
+        """
+        Destructive part of jboss_prepare(), removes the original EJBCA and its database.
+        Run only once the new configuration is saved.
+        :return: 0 on success
+        """
+        # Undeploy original EJBCA, make JBoss clean
         if self.print_output:
             print "\n - Preparing environment for application server"
         self.undeploy()
@@ -798,9 +1443,36 @@ class Ejbca(object):
         self.jboss_backup_database()
         self.jboss_fix_privileges()
         self.jboss_reload()
+        return 0
+
+    def configure(self, prepare=True):
+        """
+        Configures EJBCA for installation deployment
+        :param prepare: if False, jboss_prepare() has been already called
+        :return:
+        """
 
-        # 3. deploy, 5 attempts
-        for i in range(0, 5):
+        # 1. update properties file
+        if self.print_output:
+            print " - Updating settings"
+        self.update_properties()
+        self.backup_passwords()
+        if self.config is not None:
+            self.config.ejbca_jks_password = self.http_pass
+
+        # 2. Clean application server
+        if prepare:
+            ret = self.jboss_prepare()
+            if ret != 0:
+                return ret
+
+        # 3. deploy, cached build if the build inputs did not change, otherwise 5 attempts
+        fingerprint = self.get_build_fingerprint()
+        cached = self.deploy_cached(fingerprint)
+        if cached:
+            self.ejbca_install_result = 0
+
+        for i in range(0, 0 if cached else 5):
             if self.print_output:
                 print "\n - Deploying the PKI system" if i == 0 else "\n - Deploying the PKI system, attempt %d" % (i+1)
             res, out, err = self.ant_deploy()
@@ -823,18 +1495,22 @@ class Ejbca(object):
             if res == 0:
                 break
 
-        self.ant_client_tools()
+        if not cached:
+            res, out, err = self.ant_client_tools()
+            if res == 0 and self.ejbca_install_result == 0:
+                self.build_cache_store(fingerprint)
+
         self.jboss_fix_privileges()
         self.jboss_reload()
         return self.ejbca_install_result
 
     def test_port_open(self, host, timeout=5, attempts=3):
         """
-        Tests if port is open to the public
+        Tests if port is open to the public, attempts are staggered
         :return:
         """
         return util.test_port_open(host=host, port=self.PORT, timeout=timeout, attempts=attempts,
-                                   test_upper_read_write=False)
+                                   test_upper_read_write=False, stagger=0.5)
 
     def test_environment(self):
         """
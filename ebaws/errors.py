@@ -32,3 +32,7 @@ class NoSuchEndpoint(Error):
 class SubprocessError(Error):
     """Error when executing a subprocess"""
 
+
+
+class AccessDenied(Error):
+    """Authentication / authorization failed"""
@@ -0,0 +1,123 @@
+import json
+import logging
+import os
+import time
+
+
+__author__ = 'dusanklinec'
+logger = logging.getLogger(__name__)
+
+
+class HostFacts(object):
+    """
+    Host facts (instance metadata, OS info, memory) cached across the CLI invocations.
+    The cache is bound to the boot - a reboot (new boot id) drops all the facts.
+    Each field has its TTL, None means the field is valid for the whole boot.
+    """
+    CACHE_FILE = '/var/cache/ebaws/host-facts.json'
+    BOOT_ID_FILE = '/proc/sys/kernel/random/boot_id'
+
+    # Default TTLs of the fields, seconds
+    FIELD_TTL = {
+        'ami': None,
+        'ami_ip': 60*10,
+        'os_info': None,
+        'mem_virt': None,
+        'mem_swap': 60*60,
+    }
+
+    def __init__(self, path=None, boot_id_file=None, clock=None, *args, **kwargs):
+        self.path = path if path is not None else self.CACHE_FILE
+        self.boot_id_file = boot_id_file if boot_id_file is not None else self.BOOT_ID_FILE
+        self.clock = clock if clock is not None else time.time
+        self.boot_id = None
+        self.fields = None
+
+    def read_boot_id(self):
+        try:
+            with open(self.boot_id_file, 'r') as f:
+                return f.read().strip()
+        except (IOError, OSError):
+            return None
+
+    def load(self):
+        """
+        Loads the cache, facts from another boot are dropped
+        :return: self
+        """
+        self.boot_id = self.read_boot_id()
+        self.fields = {}
+        if self.boot_id is None or not os.path.exists(self.path):
+            return self
+
+        try:
+            with open(self.path, 'r') as f:
+                js = json.load(f)
+            if js.get('boot_id') == self.boot_id:
+                self.fields = js.get('fields', {})
+        except (IOError, ValueError) as e:
+            logger.debug('Could not load the host facts %s: %s' % (self.path, e))
+        return self
+
+    def save(self):
+        """
+        Writes the cache, facts are not persisted if the boot id is unknown
+        :return:
+        """
+        if self.boot_id is None:
+            return
+        try:
+            cache_dir = os.path.dirname(self.path)
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir, 0o755)
+            tmp_path = self.path + '.tmp'
+            with os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+                f.write(json.dumps({'boot_id': self.boot_id, 'fields': self.fields}, indent=2))
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError) as e:
+            logger.debug('Could not save the host facts %s: %s' % (self.path, e))
+
+    def ensure_loaded(self):
+        if self.fields is None:
+            self.load()
+
+    def get(self, name, loader, ttl=-1):
+        """
+        Returns the cached fact, loads and stores it if missing or expired
+        :param name: field name
+        :param loader: callable returning the fact value (JSON serializable), None is not cached
+        :param ttl: seconds, None for the whole boot, FIELD_TTL by default
+        :return:
+        """
+        self.ensure_loaded()
+        ttl = self.FIELD_TTL.get(name) if ttl == -1 else ttl
+        now = self.clock()
+
+        entry = self.fields.get(name)
+        if entry is not None and (ttl is None or now - entry['time'] < ttl):
+            return entry['value']
+
+        value = loader()
+        if value is not None:
+            self.fields[name] = {'value': value, 'time': now}
+            self.save()
+        return value
+
+    def invalidate(self, *names):
+        """
+        Drops the fields, e.g., IP address before the DNS update
+        :param names:
+        :return:
+        """
+        self.ensure_loaded()
+        changed = False
+        for name in names:
+            if name in self.fields:
+                del self.fields[name]
+                changed = True
+        if changed:
+            self.save()
+
+
+# Facts shared in the process
+facts = HostFacts()
@@ -0,0 +1,152 @@
+import httplib
+import logging
+import socket
+import time
+import errors
+
+
+__author__ = 'dusanklinec'
+logger = logging.getLogger(__name__)
+
+
+class InstanceMetadata(object):
+    """
+    EC2 instance metadata (IMDS) client, replaces the ec2-metadata script (one curl per attribute).
+    IMDSv2 session token is used if the endpoint supports it, IMDSv1 otherwise.
+    All keys are requested at once, pipelined over one keep-alive connection.
+    """
+    HOST = '169.254.169.254'
+    PORT = 80
+    TOKEN_PATH = '/latest/api/token'
+    TOKEN_TTL_HEADER = 'X-aws-ec2-metadata-token-ttl-seconds'
+    TOKEN_HEADER = 'X-aws-ec2-metadata-token'
+    META_PATH = '/latest/meta-data/'
+
+    # ec2-metadata key -> metadata path
+    KEY_PATHS = {
+        'placement': 'placement/availability-zone',
+    }
+
+    def __init__(self, host=None, port=None, timeout=1.0, key_timeout=2.0, token_ttl=300, *args, **kwargs):
+        """
+        :param host:
+        :param port:
+        :param timeout: connect / token timeout
+        :param key_timeout: time limit for one key response
+        :param token_ttl: IMDSv2 token validity in seconds
+        """
+        self.host = host if host is not None else self.HOST
+        self.port = port if port is not None else self.PORT
+        self.timeout = timeout
+        self.key_timeout = key_timeout
+        self.token_ttl = token_ttl
+        self.token = None
+
+    def get_path(self, key):
+        return self.META_PATH + self.KEY_PATHS.get(key, key)
+
+    def connect(self):
+        conn = httplib.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        conn.connect()
+        return conn
+
+    def get_token(self, conn):
+        """
+        Requests the IMDSv2 session token
+        :param conn: connection, kept open for the next requests if possible
+        :return: token, None if IMDSv2 is not available
+        """
+        try:
+            conn.request('PUT', self.TOKEN_PATH, headers={self.TOKEN_TTL_HEADER: str(self.token_ttl)})
+            resp = conn.getresponse()
+            data = resp.read()
+            if resp.status == 200 and len(data.strip()) > 0:
+                return data.strip()
+            logger.debug('IMDSv2 token not available, status: %s' % resp.status)
+        except (socket.error, httplib.HTTPException) as e:
+            logger.debug('IMDSv2 token request failed: %s' % e)
+            conn.close()
+        return None
+
+    def build_request(self, key):
+        req = 'GET %s HTTP/1.1\r\nHost: %s\r\nAccept: */*\r\n' % (self.get_path(key), self.host)
+        if self.token is not None:
+            req += '%s: %s\r\n' % (self.TOKEN_HEADER, self.token)
+        return req + '\r\n'
+
+    def fetch_pipelined(self, sock, keys, results):
+        """
+        Sends all requests, reads the responses in order.
+        :param sock:
+        :param keys:
+        :param results: key -> value, None if the key does not exist or timed out
+        :return: keys processed
+        """
+        done = []
+        try:
+            sock.sendall(''.join(self.build_request(key) for key in keys))
+            for key in keys:
+                deadline = time.time() + self.key_timeout
+                sock.settimeout(self.key_timeout)
+                resp = httplib.HTTPResponse(sock, method='GET')
+                try:
+                    resp.begin()
+                    sock.settimeout(max(0.001, deadline - time.time()))
+                    data = resp.read()
+                except socket.timeout:
+                    logger.debug('IMDS key %s timed out' % key)
+                    results[key] = None
+                    done.append(key)
+                    break
+
+                results[key] = data.strip() if resp.status == 200 else None
+                done.append(key)
+                if resp.status == 401:
+                    self.token = None
+                    raise errors.AccessDenied('IMDS token rejected')
+                if resp.will_close:
+                    break
+
+        except (socket.error, httplib.HTTPException) as e:
+            logger.debug('IMDS pipeline interrupted: %s' % e)
+        return done
+
+    def fetch(self, keys):
+        """
+        Fetches the metadata keys
+        :param keys: ec2-metadata keys, e.g., instance-id, public-ipv4
+        :return: dict key -> value, None for the missing keys
+        """
+        results = {}
+        pending = list(keys)
+        conn = None
+        try:
+            try:
+                conn = self.connect()
+            except (socket.error, httplib.HTTPException) as e:
+                raise errors.RequestFailed('Could not connect to the instance metadata service: %s' % e)
+
+            if self.token is None:
+                self.token = self.get_token(conn)
+
+            # Connection closed by the server - remaining keys are requested again on a new one
+            while len(pending) > 0:
+                if conn.sock is None:
+                    try:
+                        conn.connect()
+                    except (socket.error, httplib.HTTPException) as e:
+                        raise errors.RequestFailed('Could not connect to the instance metadata service: %s' % e)
+
+                done = self.fetch_pipelined(conn.sock, pending, results)
+                conn.close()
+                if len(done) == 0:
+                    raise errors.RequestFailed('Instance metadata service does not respond')
+                pending = [x for x in pending if x not in done]
+
+        finally:
+            if conn is not None:
+                conn.close()
+
+        for key in keys:
+            results.setdefault(key, None)
+        return results
@@ -0,0 +1,195 @@
+import json
+import logging
+import re
+import requests
+import errors
+from requests.auth import HTTPDigestAuth
+
+
+__author__ = 'dusanklinec'
+logger = logging.getLogger(__name__)
+
+
+class JBossCliOp(object):
+    """
+    One management operation in the jboss-cli script, with its parsed result
+    """
+    def __init__(self, idx=None, cmd=None, *args, **kwargs):
+        self.idx = idx
+        self.cmd = cmd
+        self.executed = False
+        self.failed = False
+        self.out = []
+
+    @property
+    def success(self):
+        return self.executed and not self.failed
+
+    def __repr__(self):
+        return 'JBossCliOp(%s, %r, executed=%s, failed=%s)' % (self.idx, self.cmd, self.executed, self.failed)
+
+
+class JBossCliScript(object):
+    """
+    Several jboss-cli operations executed by one jboss-cli invocation (--file).
+
+    Each operation is wrapped in try / catch / end-try so a failing operation does not
+    abort the rest of the script and echo markers delimit its output, so
+    per-operation results can be parsed back from the output.
+    """
+    MARKER = '##EBAWS-OP'
+    MARKER_RE = re.compile(r'^%s-(START|FAILED|END) (\d+)\s*$' % re.escape(MARKER))
+
+    def __init__(self, cmds=None, *args, **kwargs):
+        self.ops = []
+        self.parsed = False
+        for cmd in (cmds if cmds is not None else []):
+            self.add(cmd)
+
+    def add(self, cmd):
+        op = JBossCliOp(idx=len(self.ops), cmd=cmd)
+        self.ops.append(op)
+        return op
+
+    def marker(self, kind, op):
+        return 'echo %s-%s %d' % (self.MARKER, kind, op.idx)
+
+    def build(self):
+        """
+        Builds the CLI script
+        :return: script text
+        """
+        lines = []
+        for op in self.ops:
+            lines.append(self.marker('START', op))
+            lines.append('try')
+            lines.append('    %s' % op.cmd)
+            lines.append('catch')
+            lines.append('    %s' % self.marker('FAILED', op))
+            lines.append('end-try')
+            lines.append(self.marker('END', op))
+        return '\n'.join(lines) + '\n'
+
+    def parse(self, lines):
+        """
+        Parses the output of the script run, sets the results to the operations.
+        Operations without the end marker were not executed (e.g., the script was aborted).
+        :param lines: output lines
+        :return: self
+        """
+        current = None
+        for line in lines:
+            m = self.MARKER_RE.match(line.strip())
+            if m is None:
+                if current is not None:
+                    current.out.append(line)
+                continue
+
+            self.parsed = True
+            kind, idx = m.group(1), int(m.group(2))
+            if idx >= len(self.ops):
+                continue
+
+            op = self.ops[idx]
+            if kind == 'START':
+                current = op
+            elif kind == 'FAILED':
+                op.failed = True
+            else:
+                op.executed = True
+                current = None
+        return self
+
+    def is_parsed(self):
+        return self.parsed
+
+    def failed_ops(self):
+        return [x for x in self.ops if not x.success]
+
+    def __len__(self):
+        return len(self.ops)
+
+
+class JBossManagementClient(object):
+    """
+    Client for the JBoss HTTP management interface (DMR JSON over HTTP, port 9990).
+    One keep-alive session is reused for all requests, digest authentication against the ManagementRealm.
+    """
+    URL = 'http://127.0.0.1:9990/management'
+    TIMEOUT = 5
+
+    def __init__(self, url=None, user=None, password=None, timeout=None, *args, **kwargs):
+        self.url = url if url is not None else self.URL
+        self.user = user
+        self.password = password
+        self.timeout = timeout if timeout is not None else self.TIMEOUT
+        self.session = None
+
+    def get_session(self):
+        if self.session is None:
+            self.session = requests.Session()
+            if self.user is not None:
+                self.session.auth = HTTPDigestAuth(self.user, self.password)
+        return self.session
+
+    def close(self):
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+
+    def execute(self, operation, address=None, **params):
+        """
+        Executes the management operation
+        :param operation: operation name, e.g., read-attribute
+        :param address: list of (type, name) tuples, e.g., [('deployment', 'ejbca.ear')]
+        :param params: operation parameters
+        :return: response dict with the outcome (success / failed)
+        """
+        req = dict(params)
+        req['operation'] = operation
+        req['address'] = [{k: v} for k, v in (address if address is not None else [])]
+
+        try:
+            resp = self.get_session().post(self.url, data=json.dumps(req), timeout=self.timeout,
+                                           headers={'Content-Type': 'application/json'})
+        except requests.exceptions.RequestException as e:
+            raise errors.RequestFailed('Management request failed: %s' % e)
+
+        if resp.status_code == 401:
+            raise errors.AccessDenied('Management interface authentication failed')
+
+        try:
+            return resp.json()
+        except ValueError:
+            raise errors.InvalidResponse('Invalid management response, status: %s' % resp.status_code)
+
+    def read_attribute(self, name, address=None):
+        """
+        Reads the attribute value, None if the operation failed
+        :param name:
+        :param address:
+        :return:
+        """
+        resp = self.execute('read-attribute', address=address, name=name)
+        if resp.get('outcome') != 'success':
+            return None
+        return resp.get('result')
+
+    def server_state(self):
+        return self.read_attribute('server-state')
+
+    def is_running(self):
+        return self.server_state() == 'running'
+
+    def deployment_status(self, name):
+        return self.read_attribute('status', address=[('deployment', name)])
+
+    def is_deployed(self, name):
+        return self.deployment_status(name) == 'OK'
+
+    def reload(self):
+        """
+        Reloads the server. Returns once the reload was accepted, server is not running yet.
+        :return: True if accepted
+        """
+        return self.execute('reload').get('outcome') == 'success'
@@ -0,0 +1,333 @@
+import base64
+import hashlib
+import logging
+import os
+import select
+import subprocess
+import time
+import errors
+import util
+
+
+__author__ = 'dusanklinec'
+logger = logging.getLogger(__name__)
+
+
+# Java helper hosting the command line tools in one JVM.
+# Request line: RUN <jar> <stdin> <arg>*, fields tab separated, base64 encoded.
+# The jar Main-Class is invoked in-process (class loader per jar is kept), System.exit is trapped.
+# System.out / System.err are replaced once by streams switched to the buffers of the running command,
+# so loggers keeping the stream reference (log4j ConsoleAppender) are captured by every command.
+# Responses go to the original stdout.
+# Response line: <marker> <exit code> <stdout> <stderr>, outputs base64 encoded.
+JVM_SESSION_CLASS = 'EbawsJvmSession'
+JVM_SESSION_SOURCE = r"""
+import java.io.*;
+import java.lang.reflect.InvocationTargetException;
+import java.lang.reflect.Method;
+import java.net.URL;
+import java.net.URLClassLoader;
+import java.security.Permission;
+import java.util.*;
+import java.util.jar.*;
+import javax.xml.bind.DatatypeConverter;
+
+public class EbawsJvmSession {
+    static volatile boolean trap = false;
+    static final Map<String, Method> MAINS = new HashMap<String, Method>();
+
+    static class SwitchStream extends OutputStream {
+        volatile OutputStream target;
+        SwitchStream(OutputStream target) { this.target = target; }
+        public void write(int b) throws IOException { target.write(b); }
+        public void write(byte[] b, int off, int len) throws IOException { target.write(b, off, len); }
+        public void flush() throws IOException { target.flush(); }
+    }
+
+    static class ExitTrap extends SecurityException {
+        final int code;
+        ExitTrap(int code) { super("exit " + code); this.code = code; }
+    }
+
+    static Method getMain(String jar) throws Exception {
+        Method m = MAINS.get(jar);
+        if (m != null) return m;
+
+        File file = new File(jar);
+        JarFile jf = new JarFile(file);
+        Attributes attrs = jf.getManifest().getMainAttributes();
+        jf.close();
+
+        List<URL> urls = new ArrayList<URL>();
+        urls.add(file.toURI().toURL());
+        String cp = attrs.getValue(Attributes.Name.CLASS_PATH);
+        if (cp != null) {
+            for (String entry : cp.trim().split("\\s+")) {
+                if (entry.length() > 0) urls.add(new File(file.getParentFile(), entry).toURI().toURL());
+            }
+        }
+
+        ClassLoader cl = new URLClassLoader(urls.toArray(new URL[urls.size()]), EbawsJvmSession.class.getClassLoader());
+        m = Class.forName(attrs.getValue(Attributes.Name.MAIN_CLASS), true, cl).getMethod("main", String[].class);
+        MAINS.put(jar, m);
+        return m;
+    }
+
+    static ExitTrap findExit(Throwable e) {
+        for (; e != null; e = e.getCause()) {
+            if (e instanceof ExitTrap) return (ExitTrap) e;
+        }
+        return null;
+    }
+
+    static String decode(String s) throws UnsupportedEncodingException {
+        return new String(DatatypeConverter.parseBase64Binary(s), "UTF-8");
+    }
+
+    public static void main(String[] argv) throws Exception {
+        final PrintStream out = System.out;
+        final PrintStream err = System.err;
+        final InputStream in = System.in;
+        final String marker = argv.length > 0 ? argv[0] : "##EBAWS-JVM";
+        BufferedReader reader = new BufferedReader(new InputStreamReader(in, "UTF-8"));
+        final SwitchStream switchOut = new SwitchStream(out);
+        final SwitchStream switchErr = new SwitchStream(err);
+        final PrintStream cmdOut = new PrintStream(switchOut, true);
+        final PrintStream cmdErr = new PrintStream(switchErr, true);
+        System.setOut(cmdOut);
+        System.setErr(cmdErr);
+
+        System.setSecurityManager(new SecurityManager() {
+            public void checkPermission(Permission perm) { }
+            public void checkPermission(Permission perm, Object context) { }
+            public void checkExit(int status) { if (trap) throw new ExitTrap(status); }
+        });
+
+        out.println(marker + " READY");
+        out.flush();
+
+        String line;
+        while ((line = reader.readLine()) != null) {
+            String[] parts = line.split("\t", -1);
+            if (!"RUN".equals(parts[0]) || parts.length < 3) break;
+
+            String jar = decode(parts[1]);
+            byte[] stdin = DatatypeConverter.parseBase64Binary(parts[2]);
+            String[] args = new String[parts.length - 3];
+            for (int i = 0; i < args.length; i++) args[i] = decode(parts[i + 3]);
+
+            ByteArrayOutputStream bout = new ByteArrayOutputStream();
+            ByteArrayOutputStream berr = new ByteArrayOutputStream();
+            Thread thread = Thread.currentThread();
+            ClassLoader savedLoader = thread.getContextClassLoader();
+            int code = 0;
+
+            switchOut.target = bout;
+            switchErr.target = berr;
+            System.setOut(cmdOut);
+            System.setErr(cmdErr);
+            System.setIn(new ByteArrayInputStream(stdin));
+            trap = true;
+            try {
+                Method m = getMain(jar);
+                thread.setContextClassLoader(m.getDeclaringClass().getClassLoader());
+                m.invoke(null, (Object) args);
+            } catch (Throwable e) {
+                Throwable cause = e instanceof InvocationTargetException ? e.getCause() : e;
+                ExitTrap exit = findExit(cause);
+                if (exit != null) {
+                    code = exit.code;
+                } else {
+                    cause.printStackTrace();
+                    code = 1;
+                }
+            } finally {
+                trap = false;
+                System.out.flush();
+                System.err.flush();
+                cmdOut.flush();
+                cmdErr.flush();
+                switchOut.target = out;
+                switchErr.target = err;
+                System.setOut(cmdOut);
+                System.setErr(cmdErr);
+                System.setIn(in);
+                thread.setContextClassLoader(savedLoader);
+            }
+
+            out.println(marker + " " + code + " " + DatatypeConverter.printBase64Binary(bout.toByteArray())
+                    + " " + DatatypeConverter.printBase64Binary(berr.toByteArray()));
+            out.flush();
+        }
+    }
+}
+"""
+
+
+class JvmSession(object):
+    """
+    Long-lived JVM executing Java command line tools (jar Main-Class) one after another,
+    so a batch of commands pays the JVM startup and class loading once.
+    The helper class is compiled on the first use to the work dir.
+    """
+    MARKER = '##EBAWS-JVM'
+    WORK_DIR = '/var/cache/ebaws/jvm-session'
+    START_TIMEOUT = 30
+    CMD_TIMEOUT = 300
+
+    def __init__(self, work_dir=None, java='java', javac='javac', run_as=None, cwd=None, java_opts=None,
+                 *args, **kwargs):
+        self.work_dir = work_dir if work_dir is not None else self.WORK_DIR
+        self.java = java
+        self.javac = javac
+        self.run_as = run_as
+        self.cwd = cwd
+        self.java_opts = list(java_opts) if java_opts is not None else []
+        self.process = None
+        self.buffer = ''
+
+    def is_available(self):
+        return util.exe_exists(self.java) and (util.exe_exists(self.javac) or self.is_compiled())
+
+    def get_source_hash(self):
+        return hashlib.sha256(JVM_SESSION_SOURCE).hexdigest()
+
+    def get_class_dir(self):
+        return os.path.join(self.work_dir, self.get_source_hash()[:16])
+
+    def is_compiled(self):
+        return os.path.exists(os.path.join(self.get_class_dir(), JVM_SESSION_CLASS + '.class'))
+
+    def compile(self):
+        """
+        Compiles the helper class, once per source version
+        :return:
+        """
+        if self.is_compiled():
+            return
+
+        class_dir = self.get_class_dir()
+        util.make_or_verify_dir(class_dir, mode=0o755)
+        src = os.path.join(class_dir, JVM_SESSION_CLASS + '.java')
+        if os.path.exists(src):
+            os.remove(src)
+        with util.safe_open(src, chmod=0o644) as f:
+            f.write(JVM_SESSION_SOURCE)
+
+        ret, out, err = util.cli_cmd_sync([self.javac, '-nowarn', '-d', class_dir, src], label='javac')
+        if ret != 0:
+            raise errors.EnvError('Could not compile the JVM session helper: %s' % ''.join(err))
+
+    def is_running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        """
+        Starts the JVM, waits for the ready message
+        :return:
+        """
+        if self.is_running():
+            return
+
+        self.compile()
+        cmd = [self.java] + self.java_opts + ['-cp', self.get_class_dir(), JVM_SESSION_CLASS, self.MARKER]
+
+        self.buffer = ''
+        kwargs = dict(stdin=subprocess.PIPE, stdout=subprocess.PIPE, cwd=self.cwd, close_fds=True)
+        if self.run_as is not None:
+            self.process = self.run_as.popen(cmd, **kwargs)
+        else:
+            self.process = subprocess.Popen(cmd, **kwargs)
+        try:
+            self.read_response(self.START_TIMEOUT)
+        except errors.Error:
+            self.close()
+            raise
+
+    def execute(self, jar, args=None, stdin='', timeout=None):
+        """
+        Executes the jar main class with the arguments in the session
+        :param jar: path to the jar with Main-Class
+        :param args: list of arguments
+        :param stdin: data the command reads from the standard input
+        :param timeout:
+        :return: (return code, stdout lines, stderr lines)
+        """
+        self.start()
+        fields = ['RUN', jar, stdin] + list(args if args is not None else [])
+        req = '\t'.join(base64.b64encode(x) if i > 0 else x for i, x in enumerate(fields))
+
+        try:
+            self.process.stdin.write(req + '\n')
+            self.process.stdin.flush()
+        except (IOError, OSError) as e:
+            self.close()
+            raise errors.RequestFailed('JVM session write failed: %s' % e)
+
+        try:
+            resp = self.read_response(timeout if timeout is not None else self.CMD_TIMEOUT)
+        except errors.Error:
+            self.close()
+            raise
+
+        if len(resp) != 3:
+            self.close()
+            raise errors.InvalidResponse('Invalid JVM session response')
+
+        out = base64.b64decode(resp[1]).splitlines(True)
+        err = base64.b64decode(resp[2]).splitlines(True)
+        return int(resp[0]), out, err
+
+    def read_response(self, timeout):
+        """
+        Reads the next marker line, other output (e.g., native libraries writing to stdout) is skipped.
+        :param timeout:
+        :return: list of the fields after the marker
+        """
+        deadline = time.time() + timeout
+        fd = self.process.stdout.fileno()
+        while True:
+            while '\n' in self.buffer:
+                line, self.buffer = self.buffer.split('\n', 1)
+                pos = line.find(self.MARKER + ' ')
+                if pos >= 0:
+                    fields = line[pos + len(self.MARKER) + 1:].strip().split(' ')
+                    return fields if fields != ['READY'] else []
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise errors.RequestFailed('JVM session timed out')
+
+            r, w, x = select.select([fd], [], [], remaining)
+            if len(r) == 0:
+                continue
+            data = os.read(fd, 65536)
+            if len(data) == 0:
+                raise errors.RequestFailed('JVM session terminated')
+            self.buffer += data
+
+    def close(self):
+        """
+        Terminates the JVM - closing the stdin ends the request loop
+        :return:
+        """
+        if self.process is None:
+            return
+        p, self.process = self.process, None
+        try:
+            p.stdin.close()
+        except (IOError, OSError):
+            pass
+        try:
+            if not util.wait_until(lambda: p.poll() is not None, timeout=5):
+                p.kill()
+                p.wait()
+        except OSError:
+            pass
+        p.stdout.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
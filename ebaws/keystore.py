@@ -0,0 +1,151 @@
+import hashlib
+import os
+import struct
+import time
+
+
+__author__ = 'dusanklinec'
+
+
+# Sun proprietary key protection algorithm used by JKS
+JKS_KEY_PROTECTOR_OID = '1.3.6.1.4.1.42.2.17.1.1'
+
+
+def der_length(length):
+    if length < 0x80:
+        return chr(length)
+    res = ''
+    while length > 0:
+        res = chr(length & 0xff) + res
+        length >>= 8
+    return chr(0x80 | len(res)) + res
+
+
+def der_tlv(tag, value):
+    return chr(tag) + der_length(len(value)) + value
+
+
+def der_oid(oid):
+    parts = [int(x) for x in oid.split('.')]
+    res = chr(40 * parts[0] + parts[1])
+    for part in parts[2:]:
+        enc = chr(part & 0x7f)
+        part >>= 7
+        while part > 0:
+            enc = chr(0x80 | (part & 0x7f)) + enc
+            part >>= 7
+        res += enc
+    return der_tlv(0x06, res)
+
+
+def load_pem_certificates(data):
+    """
+    Loads all PEM certificates from the data (e.g., fullchain.pem)
+    :param data:
+    :return: list of cryptography certificates
+    """
+    from cryptography import x509
+    from cryptography.hazmat.backends import default_backend
+    certs = []
+    marker = '-----END CERTIFICATE-----'
+    for block in data.split(marker)[:-1]:
+        certs.append(x509.load_pem_x509_certificate(block.strip() + '\n' + marker + '\n', default_backend()))
+    return certs
+
+
+class JksKeyStore(object):
+    """
+    Java KeyStore (JKS) encoder, private key entries with the certificate chain.
+    Replaces openssl pkcs12 -export & keytool -importkeystore.
+    """
+    MAGIC = 0xfeedfeed
+    VERSION = 2
+    TAG_PRIVATE_KEY = 1
+    DIGEST_WHITENER = 'Mighty Aphrodite'
+
+    def __init__(self, *args, **kwargs):
+        self.entries = []
+
+    def add_private_key(self, alias, key, chain, timestamp=None):
+        """
+        Adds the private key entry
+        :param alias: entry alias, JKS aliases are case-insensitive (stored lowercase)
+        :param key: cryptography private key
+        :param chain: list of cryptography certificates, leaf first
+        :param timestamp: entry creation time in seconds
+        :return:
+        """
+        from cryptography.hazmat.primitives import serialization
+        pkcs8 = key.private_bytes(serialization.Encoding.DER, serialization.PrivateFormat.PKCS8,
+                                  serialization.NoEncryption())
+        chain_der = [x.public_bytes(serialization.Encoding.DER) for x in chain]
+        self.entries.append((alias.lower(), pkcs8, chain_der, timestamp if timestamp is not None else time.time()))
+        return self
+
+    @staticmethod
+    def password_bytes(password):
+        return password.decode('utf-8').encode('utf-16be') if isinstance(password, str) \
+            else password.encode('utf-16be')
+
+    @staticmethod
+    def utf(data):
+        data = data.encode('utf-8') if not isinstance(data, str) else data
+        return struct.pack('>H', len(data)) + data
+
+    def protect_key(self, pkcs8, password, salt=None):
+        """
+        Sun JKS key protector: SHA1 keystream seeded by a random salt, SHA1 integrity check
+        :param pkcs8: DER PKCS#8 private key
+        :param password:
+        :param salt: 20 bytes
+        :return: DER EncryptedPrivateKeyInfo
+        """
+        passwd = self.password_bytes(password)
+        salt = salt if salt is not None else os.urandom(20)
+
+        stream = ''
+        digest = salt
+        while len(stream) < len(pkcs8):
+            digest = hashlib.sha1(passwd + digest).digest()
+            stream += digest
+
+        encrypted = ''.join(chr(ord(x) ^ ord(y)) for x, y in zip(pkcs8, stream))
+        check = hashlib.sha1(passwd + pkcs8).digest()
+
+        algorithm = der_tlv(0x30, der_oid(JKS_KEY_PROTECTOR_OID) + der_tlv(0x05, ''))
+        return der_tlv(0x30, algorithm + der_tlv(0x04, salt + encrypted + check))
+
+    def to_bytes(self, password):
+        """
+        Serializes the keystore, entry keys and the keystore integrity use the same password
+        :param password:
+        :return: JKS file content
+        """
+        data = struct.pack('>III', self.MAGIC, self.VERSION, len(self.entries))
+        for alias, pkcs8, chain_der, timestamp in self.entries:
+            data += struct.pack('>I', self.TAG_PRIVATE_KEY) + self.utf(alias) + struct.pack('>q', int(timestamp * 1000))
+
+            protected = self.protect_key(pkcs8, password)
+            data += struct.pack('>I', len(protected)) + protected
+
+            data += struct.pack('>I', len(chain_der))
+            for cert in chain_der:
+                data += self.utf('X.509') + struct.pack('>I', len(cert)) + cert
+
+        digest = hashlib.sha1(self.password_bytes(password) + self.DIGEST_WHITENER + data).digest()
+        return data + digest
+
+
+def pkcs12_to_bytes(alias, key, chain, password):
+    """
+    PKCS#12 keystore with the private key entry
+    :param alias: friendly name of the entry
+    :param key: cryptography private key
+    :param chain: list of cryptography certificates, leaf first
+    :param password:
+    :return: PKCS#12 DER
+    """
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.serialization import pkcs12
+    return pkcs12.serialize_key_and_certificates(alias, key, chain[0], chain[1:] if len(chain) > 1 else None,
+                                                 serialization.BestAvailableEncryption(password))
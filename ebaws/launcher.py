@@ -0,0 +1,23 @@
+import sys
+import precheck
+
+
+__author__ = 'dusanklinec'
+
+
+def main():
+    """
+    ebaws-cli entry point. Periodic commands (cron renew, onboot) are answered by the precheck
+    if there is nothing to do, the application with all its dependencies is loaded only otherwise.
+    :return:
+    """
+    ret = precheck.run(sys.argv[1:])
+    if ret is not precheck.PRECHECK_CONTINUE:
+        sys.exit(ret)
+
+    import cli
+    cli.main()
+
+
+if __name__ == '__main__':
+    main()
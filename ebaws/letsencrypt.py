@@ -1,20 +1,22 @@
 import os
 import util
-from sarge import run, Capture, Feeder
-from ebclient.eb_utils import EBUtils
-from datetime import datetime
+import process
+import keystore
+import certindex
+import logging
 import time
 import sys
 import types
 import errors
+import portprobe
 import subprocess
 import shutil
 import re
 import json
-import certbot_external_auth as cba
 
 
 __author__ = 'dusanklinec'
+logger = logging.getLogger(__name__)
 
 
 LE_PRIVATE_KEY = 'privkey.pem'
@@ -25,57 +27,30 @@ LE_CA = 'fullchain.pem'
 class LetsEncryptToJks(object):
     """
     Imports Lets encrypt certificate to Java Key Store (JKS)
+    The keystore is built in-process (JKS or PKCS12), the key never leaves the process unprotected.
     """
     PRIVATE_KEY = LE_PRIVATE_KEY
     CERT = LE_CERT
     CA = LE_CA
-    TMP_P12 = '/tmp/tmpcert.p12'
-    OPENSSL_LOG = '/tmp/openssl.log'
-    KEYTOOL_LOG = '/tmp/keytool.log'
 
-    def __init__(self, cert_dir=None, jks_path=None, jks_alias='tomcat', password='password', keytool_path=None, print_output=False, *args, **kwargs):
+    def __init__(self, cert_dir=None, jks_path=None, jks_alias='tomcat', password='password', print_output=False,
+                 keystore_type='JKS', owner=None, *args, **kwargs):
         self.cert_dir = cert_dir
         self.jks_path = jks_path
         self.jks_alias = jks_alias
         self.password = password
-        self.keytool_path = keytool_path
         self.print_output = print_output
+        self.keystore_type = keystore_type
+        self.owner = owner
 
         self.priv_file = None
         self.cert_file = None
         self.ca_file = None
 
-    def get_keytool(self):
-        return 'keytool' if self.keytool_path is None else self.keytool_path
-
     def print_error(self, msg):
         if self.print_output:
             sys.stderr.write(msg)
 
-    def del_entry(self, alias=None, password=None, keystore=None):
-        """
-        keytool -delete -alias mydomain -keystore keystore.jks
-        """
-        keytool = self.get_keytool()
-        if not util.exe_exists(keytool):
-            self.print_error('Error, keytool command not found')
-            return 4
-
-        alias = alias if alias is not None else self.jks_alias
-        password = password if password is not None else self.password
-        keystore = keystore if keystore is not None else self.jks_path
-
-        cmd = 'sudo -E -H %s -delete -alias "%s" -keystore "%s" -srcstorepass "%s"' \
-              % (keytool, alias, keystore, password)
-
-        log_obj = self.KEYTOOL_LOG
-        ret, out, err = util.cli_cmd_sync(cmd, log_obj=log_obj, write_dots=self.print_output)
-        if ret != 0:
-            self.print_error('\nKeyTool command failed.')
-            self.print_error('For more information please refer to the log file: %s' % log_obj)
-            return 6
-        return 0
-
     def check_files(self):
         self.priv_file = os.path.join(self.cert_dir, self.PRIVATE_KEY)
         self.cert_file = os.path.join(self.cert_dir, self.CERT)
@@ -92,7 +67,28 @@ class LetsEncryptToJks(object):
 
         return 0
 
+    def load_key_chain(self):
+        """
+        Loads the private key and the certificate chain, leaf first
+        :return: (key, chain)
+        """
+        from cryptography.hazmat.primitives import serialization
+        with open(self.priv_file, 'r') as f:
+            key = util.load_pem_private_key(f.read())
+        with open(self.cert_file, 'r') as f:
+            chain = keystore.load_pem_certificates(f.read())
+        with open(self.ca_file, 'r') as f:
+            leaf_der = [x.public_bytes(serialization.Encoding.DER) for x in chain]
+            for cert in keystore.load_pem_certificates(f.read()):
+                if cert.public_bytes(serialization.Encoding.DER) not in leaf_der:
+                    chain.append(cert)
+        return key, chain
+
     def convert(self):
+        """
+        Builds the keystore in-process and writes it atomically to the jks_path
+        :return:
+        """
         file_check = self.check_files()
         if file_check == 1:
             self.print_error('Error, private key not found at %s\n' % self.priv_file)
@@ -104,65 +100,41 @@ class LetsEncryptToJks(object):
             self.print_error('Error, fullchain file not found at %s\n' % self.ca_file)
             return 3
 
-        keytool = self.get_keytool()
-        if not util.exe_exists(keytool):
-            self.print_error('Error, keytool command not found')
-            return 4
-
-        openssl = 'openssl'
-        if not util.exe_exists(openssl):
-            self.print_error('Error, openssl command not found')
-            return 5
+        try:
+            key, chain = self.load_key_chain()
+        except (IOError, ValueError) as e:
+            self.print_error('\nCould not load the certificate: %s\n' % e)
+            return 6
 
-        # 1. step - create p12 file
-        p12_file, p12_name = util.unique_file(self.TMP_P12, mode=0o600)
-        p12_file.close()
+        if self.keystore_type == 'PKCS12':
+            data = keystore.pkcs12_to_bytes(self.jks_alias, key, chain, self.password)
+        else:
+            data = keystore.JksKeyStore().add_private_key(self.jks_alias, key, chain).to_bytes(self.password)
 
         try:
-            cmd = 'sudo -E -H %s pkcs12 -export -out "%s" ' \
-                  ' -password pass:"%s" ' \
-                  ' -inkey "%s" ' \
-                  ' -in "%s" ' \
-                  ' -certfile "%s" ' \
-                  ' -name "%s" ' % (openssl, p12_name, self.password, self.priv_file, self.cert_file, self.ca_file, self.jks_alias)
-
-            log_obj = self.OPENSSL_LOG
-            ret, out, err = util.cli_cmd_sync(cmd, log_obj=log_obj, write_dots=self.print_output)
-            if ret != 0:
-                self.print_error('\nOpenSSL command failed.')
-                self.print_error('For more information please refer to the log file: %s' % log_obj)
-                return 6
-
-            # 2. step - create JKS
-            cmd = 'sudo -E -H %s -importkeystore -deststorepass "%s" ' \
-                  ' -destkeypass "%s" ' \
-                  ' -destkeystore "%s" ' \
-                  ' -srckeystore "%s" ' \
-                  ' -srcstoretype PKCS12 ' \
-                  ' -srcstorepass "%s" ' \
-                  ' -alias "%s" ' % (keytool, self.password, self.password, self.jks_path, p12_name, self.password, self.jks_alias)
-
-            log_obj = self.KEYTOOL_LOG
-            ret, out, err = util.cli_cmd_sync(cmd, log_obj=log_obj, write_dots=self.print_output)
-            if ret != 0:
-                self.print_error('\nKeytool command failed.')
-                self.print_error('For more information please refer to the log file: %s' % log_obj)
-                return 7
-
-            return 0
+            util.write_atomic(self.jks_path, data, chmod=0o600)
+            if self.owner is not None:
+                util.chown(self.jks_path, self.owner)
+        except (IOError, OSError, KeyError) as e:
+            self.print_error('\nCould not write the keystore %s: %s\n' % (self.jks_path, e))
+            return 7
 
-        finally:
-            if os.path.exists(p12_name):
-                    os.remove(p12_name)
+        return 0
 
 
 class LetsEncryptManualDns(object):
     """
-    Manual DNS LetsEncrypt verifier
+    Manual DNS LetsEncrypt verifier.
+
+    With on_domain_challenges the TXT records of all domains are published at once.
+    Certbot emits the challenges one by one, in no particular order, and waits for each to be answered,
+    the challenges are submitted to LetsEncrypt only after the last one is answered.
+    Challenges are thus collected and answered right away, the one completing the set of expected domains
+    is held until the whole batch is published.
     """
 
     def __init__(self, email=None, domains=None, print_output=False, on_domain_challenge=None,
-                 cmd=None, cmd_exec=None, log_obj=None, debug=False, *args, **kwargs):
+                 on_domain_challenges=None, cmd=None, cmd_exec=None, log_obj=None, debug=False, *args, **kwargs):
 
         self.email = email
         self.domains = domains
@@ -175,10 +147,16 @@ class LetsEncryptManualDns(object):
 
         self.p = None
         self.on_domain_challenge = on_domain_challenge
+        self.on_domain_challenges = on_domain_challenges
+        self.batch = on_domain_challenges is not None
+        self.pending_challenges = []
+        self.seen_domains = set()
+        self.expected_domains = domains
         self.manual_dns_last_validation = None
         self.manual_dns_last_domain = None
         self.manual_dns_last_token = None
         self.manual_dns_report = None
+        self.responder = self.get_responder()
 
     def answer_manual_dns_out(self, out, feeder, p, *args, **kwargs):
         return self.answer_manual_dns(out, feeder, p, err=False)
@@ -186,6 +164,15 @@ class LetsEncryptManualDns(object):
     def answer_manual_dns_err(self, out, feeder, p, *args, **kwargs):
         return self.answer_manual_dns(out, feeder, p, err=True)
 
+    def get_responder(self):
+        """
+        Certbot external auth emits JSON commands, one per line
+        :return:
+        """
+        return process.PromptResponder([
+            process.PromptRule(prefix='{', response=self.answer_json_cmd, line_only=True),
+        ])
+
     def answer_manual_dns(self, out, feeder, p, err=False, *args, **kwargs):
         self.p = p
 
@@ -196,9 +183,14 @@ class LetsEncryptManualDns(object):
         if err:
             return
 
+        self.responder.answer(out, feeder, p)
+
+    def answer_json_cmd(self, out, feeder, p, *args, **kwargs):
+        """
+        Processes JSON command from the certbot external auth plugin
+        :return: None, challenge is answered by the done() callback
+        """
         out = out.strip()
-        if len(out) == 0:
-            return
 
         def done():
             feeder.feed('\n')
@@ -206,8 +198,9 @@ class LetsEncryptManualDns(object):
         try:
             json_obj = json.loads(out)
         except:
-            return
+            return None
 
+        import certbot_external_auth as cba
         if cba.FIELD_CMD not in json_obj:
             raise ValueError('Could not process json command: %s' % out)
         cmd = json_obj[cba.FIELD_CMD]
@@ -215,11 +208,35 @@ class LetsEncryptManualDns(object):
             self.manual_dns_last_validation = json_obj
             self.manual_dns_last_token = json_obj[cba.FIELD_VALIDATION]
             self.manual_dns_last_domain = json_obj[cba.FIELD_TXT_DOMAIN]
-            self.on_domain_challenge(domain=self.manual_dns_last_domain, token=self.manual_dns_last_token,
-                                     mdns=self, p=p, done=done, abort=self.abort)
+            if not self.batch:
+                self.on_domain_challenge(domain=self.manual_dns_last_domain, token=self.manual_dns_last_token,
+                                         mdns=self, p=p, done=done, abort=self.abort)
+                return None
+
+            domain = json_obj.get(cba.FIELD_DOMAIN)
+            self.seen_domains.add(domain)
+            self.pending_challenges.append((self.manual_dns_last_domain, self.manual_dns_last_token))
+            if not self.is_last_challenge(domain):
+                done()
+                return None
+
+            challenges, self.pending_challenges = self.pending_challenges, []
+            self.on_domain_challenges(challenges=challenges, mdns=self, p=p, done=done, abort=self.abort)
 
         elif cmd == 'report':
             pass
+        return None
+
+    def is_last_challenge(self, domain):
+        """
+        Decides whether the challenge closes the batch - challenges of all expected domains were collected.
+        Publishing a partial batch would replace the TXT records of the challenges collected before.
+        :param domain: domain of the challenge
+        :return:
+        """
+        if self.expected_domains is None or len(self.expected_domains) == 0:
+            return True
+        return all(x in self.seen_domains for x in self.expected_domains)
 
     def abort(self):
         if self.p is not None:
@@ -229,12 +246,36 @@ class LetsEncryptManualDns(object):
         if self.print_output:
             sys.stderr.write(msg)
 
+    def run_certbot(self, batch=False, expected_domains=None):
+        """
+        Runs certbot
+        :param batch: publish the challenges at once
+        :param expected_domains: domains the batch waits for, all domains by default
+        :return:
+        """
+        self.batch = batch
+        self.pending_challenges = []
+        self.seen_domains = set()
+        self.expected_domains = expected_domains if expected_domains is not None else self.domains
+        return util.cli_cmd_sync(self.cmd_exec, log_obj=self.log_obj, write_dots=self.print_output,
+                                 on_err=self.answer_manual_dns_err, on_out=self.answer_manual_dns_out)
+
     def start(self):
         """
         Trigger the new verification
         """
-        ret, out, err = util.cli_cmd_sync(self.cmd_exec, log_obj=self.log_obj, write_dots=self.print_output,
-                                          on_err=self.answer_manual_dns_err, on_out=self.answer_manual_dns_out)
+        ret, out, err = self.run_certbot(batch=self.on_domain_challenges is not None)
+
+        # Batch not closed, domains with a valid authorization have no challenge - TXT records were not published.
+        # Challenged domains are known now, the batch waits only for them.
+        if ret != 0 and len(self.pending_challenges) > 0:
+            logger.info('DNS challenge batch was not published, retrying with the challenged domains')
+            ret, out, err = self.run_certbot(batch=True, expected_domains=sorted(self.seen_domains))
+
+        if ret != 0 and len(self.pending_challenges) > 0 and self.on_domain_challenge is not None:
+            logger.info('DNS challenge batch was not published, retrying with the per domain challenges')
+            ret, out, err = self.run_certbot(batch=False)
+
         if ret != 0:
             self.print_error('\nCertbot command failed: %s\n' % self.cmd_exec)
             self.print_error('For more information please refer to the log file: %s' % self.log_obj)
@@ -262,6 +303,7 @@ class LetsEncrypt(object):
         self.print_output = print_output
         self.staging = staging
         self.debug = debug
+        self.last_probe = None
 
     def certonly(self, email=None, domains=None, expand=False):
         if email is not None:
@@ -275,7 +317,7 @@ class LetsEncrypt(object):
             email = self.FALLBACK_EMAIL
 
         cmd = self.get_standalone_cmd(self.domains, email=email, expand=expand, staging=self.staging)
-        cmd_exec = 'sudo -E -H %s %s' % (self.CERTBOT_PATH, cmd)
+        cmd_exec = '%s %s' % (self.CERTBOT_PATH, cmd)
         log_obj = self.CERTBOT_LOG
 
         ret, out, err = util.cli_cmd_sync(cmd_exec, log_obj=log_obj, write_dots=self.print_output)
@@ -285,7 +327,27 @@ class LetsEncrypt(object):
 
         return ret, out, err
 
-    def manual_dns(self, email=None, domains=None, expand=True, on_domain_challenge=None):
+    def certonly_async(self, email=None, domains=None, expand=False, loop=None, timeout=None):
+        """
+        Schedules certonly to the event loop, returns the job immediately
+        :return: CmdJob
+        """
+        if email is not None:
+            self.email = email
+        if domains is not None:
+            self.domains = domains
+
+        email = self.email
+        if (self.email is None or len(self.email) == 0) \
+                and self.FALLBACK_EMAIL is not None and len(self.FALLBACK_EMAIL) > 0:
+            email = self.FALLBACK_EMAIL
+
+        cmd = self.get_standalone_cmd(self.domains, email=email, expand=expand, staging=self.staging)
+        cmd_exec = '%s %s' % (self.CERTBOT_PATH, cmd)
+        return util.cli_cmd_async(cmd_exec, loop=loop, log_obj=self.CERTBOT_LOG, write_dots=self.print_output,
+                                  timeout=timeout)
+
+    def manual_dns(self, email=None, domains=None, expand=True, on_domain_challenge=None, on_domain_challenges=None):
         if email is not None:
             self.email = email
         if domains is not None:
@@ -297,16 +359,17 @@ class LetsEncrypt(object):
             email = self.FALLBACK_EMAIL
 
         cmd = self.get_manual_dns(self.domains, email=email, expand=expand, staging=self.staging)
-        cmd_exec = 'sudo -E -H %s %s' % (self.CERTBOT_PATH, cmd)
+        cmd_exec = '%s %s' % (self.CERTBOT_PATH, cmd)
         log_obj = self.CERTBOT_LOG
 
         mdns = LetsEncryptManualDns(email=email, domains=self.domains, on_domain_challenge=on_domain_challenge,
+                                    on_domain_challenges=on_domain_challenges,
                                     cmd=cmd, cmd_exec=cmd_exec, log_obj=log_obj)
         return mdns
 
     def renew(self):
         cmd = self.get_renew_cmd()
-        cmd_exec = 'sudo -E -H %s %s' % (self.CERTBOT_PATH, cmd)
+        cmd_exec = '%s %s' % (self.CERTBOT_PATH, cmd)
         log_obj = self.CERTBOT_LOG
 
         ret, out, err = util.cli_cmd_sync(cmd_exec, log_obj=log_obj, write_dots=self.print_output)
@@ -316,6 +379,15 @@ class LetsEncrypt(object):
 
         return ret, out, err
 
+    def renew_async(self, loop=None, timeout=None):
+        """
+        Schedules certbot renew to the event loop, returns the job immediately
+        :return: CmdJob
+        """
+        cmd_exec = '%s %s' % (self.CERTBOT_PATH, self.get_renew_cmd())
+        return util.cli_cmd_async(cmd_exec, loop=loop, log_obj=self.CERTBOT_LOG, write_dots=self.print_output,
+                                  timeout=timeout)
+
     def get_certificate_dir(self, domain=None):
         if domain is None:
             return self.LE_CERT_PATH
@@ -344,58 +416,64 @@ class LetsEncrypt(object):
         else:
             return 0
 
-    def test_certificate_for_renew(self, cert_dir=None, domain=None, renewal_before=60*60*24*30):
-        """Tries to load PEM certificate and check not after"""
+    def test_certificate_for_renew(self, cert_dir=None, domain=None, renewal_before=60*60*24*30, index=None):
+        """
+        Checks the certificate not after, answered from the certificate index,
+        the PEM is parsed only if it changed since the last check.
+        """
         priv_file, cert_file, ca_file = self.get_cert_paths(cert_dir=cert_dir, domain=domain)
         if not os.path.exists(cert_file):
             return 1
 
         try:
-            x509_pem = None
-            with open(cert_file, 'r') as hnd:
-                x509_pem = hnd.read()
-
-            if x509_pem is None or len(x509_pem) == 0:
-                return 2
-
-            x509 = util.load_x509(x509_pem)
-            if x509 is None:
-                return 3
-
-            not_after = x509.not_valid_after
-            utc_now = datetime.utcnow()
-
-            # Already expired?
-            if not_after <= utc_now:
-                return 4
-
-            delta = not_after - utc_now
-            delta_sec = delta.total_seconds()
-
-            if delta_sec < renewal_before:
-                return 5
-
-            return 0
+            if index is None:
+                index = certindex.CertIndex(root=self.LE_CERT_PATH).load()
+            res = index.check_expiry(cert_file, renewal_before=renewal_before)
+            try:
+                index.save()
+            except (IOError, OSError) as e:
+                logger.debug('Could not save the certificate index: %s' % e)
+            return res
         except:
             return 100
 
-    def test_port_open(self, ip=None, timeout=5, attempts=3):
+    def test_port_open(self, ip=None, timeout=3, attempts=3, private_ip=None):
         """
         Tests if 443 port is open on the local host - required for Certbot to work - LetsEncrypt
         verification.
         For this test a dummy TCP server is started.
+        The public and the private IP are probed concurrently, the probe ends as soon as the public IP
+        answers. Results are kept in last_probe.
 
-        :param ip:
+        :param ip: public IP
         :param timeout:
         :param attempts:
-        :return:
+        :param private_ip: if reachable while the public IP is not, the port is firewalled / NATed
+        :return: True if reachable on the public IP
         """
+        def done(results):
+            public = results.get((ip, self.PORT))
+            return public is None or public.ok or portprobe.PortProber.all_decided(results)
+
         server = util.DummyTCPServer(('0.0.0.0', self.PORT))
         with server.start():
-            time.sleep(1.5)
-            return util.test_port_open(ip, self.PORT, timeout=timeout, attempts=attempts)
+            server.wait_ready()
+            self.last_probe = portprobe.probe_ports([(ip, self.PORT), (private_ip, self.PORT)], timeout=timeout,
+                                                    attempts=attempts, echo_check=True, done=done)
+            res = self.last_probe.get((ip, self.PORT))
+            return res is not None and bool(res.ok)
         pass
 
+    def is_private_port_open(self, private_ip):
+        """
+        Private IP reachability from the last test_port_open
+        :param private_ip:
+        :return: True / False, None if not probed
+        """
+        if self.last_probe is None or (private_ip, self.PORT) not in self.last_probe:
+            return None
+        return self.last_probe[(private_ip, self.PORT)].ok
+
     def print_error(self, msg):
         if self.print_output:
             sys.stderr.write(msg)
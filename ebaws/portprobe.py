@@ -0,0 +1,236 @@
+import binascii
+import collections
+import errno
+import logging
+import os
+import select
+import socket
+import time
+
+
+__author__ = 'dusanklinec'
+logger = logging.getLogger(__name__)
+
+
+class ProbeResult(object):
+    """
+    Reachability of one host:port, ok is None until decided
+    """
+    def __init__(self, host=None, port=None, *args, **kwargs):
+        self.host = host
+        self.port = port
+        self.ok = None
+        self.attempts = 0
+        self.error = None
+        self.time = None
+
+    def __repr__(self):
+        return 'ProbeResult(%s:%s, ok=%s, attempts=%s, error=%s)' % (self.host, self.port, self.ok,
+                                                                     self.attempts, self.error)
+
+
+class ProbeAttempt(object):
+    def __init__(self, target, sock, deadline, *args, **kwargs):
+        self.target = target
+        self.sock = sock
+        self.deadline = deadline
+        self.connected = False
+        self.nonce = None
+        self.data = ''
+
+
+class PortProber(object):
+    """
+    Concurrent TCP reachability prober. All targets are probed at once over non-blocking sockets multiplexed
+    by select. Attempts to one target are staggered (happy eyeballs) - the next attempt starts after the stagger
+    delay without waiting for the previous one to time out, the first connected attempt decides.
+    """
+
+    def __init__(self, timeout=5, attempts=3, stagger=0.5, echo_check=False, clock=None, *args, **kwargs):
+        """
+        :param timeout: time limit of one attempt
+        :param attempts: attempts per target
+        :param stagger: delay between the attempt starts
+        :param echo_check: the peer has to echo the sent nonce upper-cased (util.DummyTCPServer)
+        :param clock:
+        """
+        self.timeout = timeout
+        self.attempts = attempts
+        self.stagger = stagger
+        self.echo_check = echo_check
+        self.clock = clock if clock is not None else time.time
+
+    @staticmethod
+    def all_decided(results):
+        return all(x.ok is not None for x in results.values())
+
+    @staticmethod
+    def any_open(results):
+        return any(x.ok for x in results.values()) or PortProber.all_decided(results)
+
+    @staticmethod
+    def resolve(target):
+        """
+        Resolves the target, blocking - done before the probe loop
+        :param target: (host, port)
+        :return: list of (family, socktype, proto, sockaddr)
+        """
+        infos = socket.getaddrinfo(target[0], target[1], socket.AF_UNSPEC, socket.SOCK_STREAM)
+        return [(x[0], x[1], x[2], x[4]) for x in infos]
+
+    def start_attempt(self, target, address, now):
+        """
+        Starts non-blocking connect
+        :param target: (host, port)
+        :param address: (family, socktype, proto, sockaddr) from resolve()
+        :param now:
+        :return: ProbeAttempt or the error
+        """
+        sock = None
+        try:
+            family, socktype, proto, sockaddr = address
+            sock = socket.socket(family, socktype, proto)
+            sock.setblocking(0)
+            ret = sock.connect_ex(sockaddr)
+            if ret not in [0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY]:
+                raise socket.error(ret, os.strerror(ret))
+            return ProbeAttempt(target, sock, now + self.timeout)
+
+        except socket.error as e:
+            if sock is not None:
+                sock.close()
+            logger.debug('Connect to %s:%s failed: %s' % (target[0], target[1], e))
+            return e
+
+    def on_writable(self, att):
+        """
+        Connect finished
+        :param att:
+        :return: True if reachable, False if failed, None if waiting for the echo
+        """
+        if not att.connected:
+            err = att.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err != 0:
+                raise socket.error(err, os.strerror(err))
+            att.connected = True
+            if not self.echo_check:
+                return True
+
+            att.nonce = 'ebaws-letsencrypt-test-' + binascii.hexlify(os.urandom(16))
+            att.sock.sendall(att.nonce)
+        return None
+
+    def on_readable(self, att):
+        data = att.sock.recv(4096)
+        if data is None or len(data) == 0:
+            raise socket.error(errno.ECONNRESET, 'Connection closed before the echo')
+        att.data += data
+        if len(att.data) < len(att.nonce):
+            return None
+        if att.data.strip() != att.nonce.upper():
+            raise socket.error(errno.EPROTO, 'Echo does not match')
+        return True
+
+    def probe(self, targets, done=None):
+        """
+        Probes the targets concurrently
+        :param targets: list of (host, port)
+        :param done: callable(results) returning True once the answer is certain, all_decided by default
+        :return: OrderedDict (host, port) -> ProbeResult, undecided targets have ok None
+        """
+        done = done if done is not None else self.all_decided
+        results = collections.OrderedDict()
+        for host, port in targets:
+            if host is not None and (host, port) not in results:
+                results[(host, port)] = ProbeResult(host, port)
+
+        # Name resolution blocks, done once per target before the loop. Attempts rotate over the addresses.
+        addresses = {}
+        for target, res in results.items():
+            try:
+                addresses[target] = self.resolve(target)
+            except socket.error as e:
+                logger.debug('Could not resolve %s: %s' % (target[0], e))
+                res.ok, res.error, res.time = False, e, 0.0
+                continue
+            if len(addresses[target]) == 0:
+                res.ok, res.error, res.time = False, 'no address', 0.0
+
+        time_start = self.clock()
+        next_start = dict((x, time_start) for x in results)
+        active = []
+
+        def finish(att, ok, error=None):
+            active.remove(att)
+            att.sock.close()
+            res = results[att.target]
+            if ok and res.ok is None:
+                res.ok, res.error, res.time = True, None, self.clock() - time_start
+            elif not ok and res.ok is None:
+                res.error = error
+
+        try:
+            while not done(results):
+                now = self.clock()
+                for target, res in results.items():
+                    if res.ok is None and res.attempts < self.attempts and now >= next_start[target]:
+                        res.attempts += 1
+                        next_start[target] = now + self.stagger
+                        address = addresses[target][(res.attempts - 1) % len(addresses[target])]
+                        att = self.start_attempt(target, address, now)
+                        if isinstance(att, ProbeAttempt):
+                            active.append(att)
+                        else:
+                            res.error = att
+
+                for att in [x for x in active if now >= x.deadline]:
+                    finish(att, False, 'timeout')
+                for att in [x for x in active if results[x.target].ok is not None]:
+                    finish(att, False)
+
+                # Target failed once all its attempts failed
+                pending = set(x.target for x in active)
+                for target, res in results.items():
+                    if res.ok is None and res.attempts >= self.attempts and target not in pending:
+                        res.ok, res.time = False, now - time_start
+
+                if done(results) or self.all_decided(results):
+                    break
+
+                wakes = [x.deadline for x in active]
+                wakes += [next_start[t] for t, r in results.items() if r.ok is None and r.attempts < self.attempts]
+                wait = max(0.0, min(wakes) - now) if len(wakes) > 0 else 0.0
+                writers = [x.sock for x in active if not x.connected]
+                readers = [x.sock for x in active if x.connected]
+                if len(writers) == 0 and len(readers) == 0:
+                    time.sleep(wait)
+                    continue
+
+                rlist, wlist, _ = select.select(readers, writers, [], wait)
+                for att in [x for x in active if x.sock in wlist or x.sock in rlist]:
+                    try:
+                        res = self.on_writable(att) if att.sock in wlist else self.on_readable(att)
+                        if res is not None:
+                            finish(att, res)
+                    except socket.error as e:
+                        finish(att, False, e)
+
+        finally:
+            for att in list(active):
+                att.sock.close()
+        return results
+
+
+def probe_ports(targets, timeout=5, attempts=3, stagger=0.5, echo_check=False, done=None):
+    """
+    Probes the targets concurrently
+    :param targets: list of (host, port)
+    :param timeout:
+    :param attempts:
+    :param stagger:
+    :param echo_check:
+    :param done: callable(results) returning True once the answer is certain
+    :return: OrderedDict (host, port) -> ProbeResult
+    """
+    prober = PortProber(timeout=timeout, attempts=attempts, stagger=stagger, echo_check=echo_check)
+    return prober.probe(targets, done=done)
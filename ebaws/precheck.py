@@ -0,0 +1,130 @@
+import argparse
+import json
+import logging
+import os
+import certindex
+from consts import CONFIG_DIR, CONFIG_FILE
+
+
+__author__ = 'dusanklinec'
+logger = logging.getLogger(__name__)
+
+
+# Certificate is renewed if it expires sooner
+RENEWAL_BEFORE = 60*60*24*20
+
+# Precheck results
+PRECHECK_CONTINUE = None
+
+
+def read_config(path=None):
+    """
+    Reads the configuration JSON without the Config machinery, comment lines are skipped
+    :param path: config file, default config location if None
+    :return: dict with the config section, None if there is no usable configuration
+    """
+    path = path if path is not None else os.path.join(CONFIG_DIR, CONFIG_FILE)
+    try:
+        with open(path, 'r') as f:
+            lines = [x for x in f.read().split('\n') if not x.strip().startswith('//')]
+        js = json.loads('\n'.join(lines))
+    except (IOError, OSError, ValueError) as e:
+        logger.debug('Could not read the config %s: %s' % (path, e))
+        return None
+
+    if not isinstance(js, dict) or not isinstance(js.get('config'), dict) or len(js['config']) == 0:
+        return None
+    return js['config']
+
+
+def is_renewal_needed(hostname, domains=None, renewal_before=RENEWAL_BEFORE, index=None):
+    """
+    Decides from the certificate index whether the certificate for the hostname has to be renewed.
+    Certificates are parsed only if changed since the last check.
+    :param hostname: EJBCA hostname, certificate name
+    :param domains: domains the certificate has to cover
+    :param renewal_before:
+    :param index: CertIndex, default index if None
+    :return: True if the renewal is needed or cannot be ruled out
+    """
+    if hostname is None or len(hostname) == 0 or hostname == 'localhost':
+        return True
+
+    index = index if index is not None else certindex.CertIndex().load()
+    cert_dir = os.path.dirname(index.get_cert_file(hostname))
+    if not os.path.exists(os.path.join(cert_dir, 'privkey.pem')) \
+            or not os.path.exists(os.path.join(cert_dir, 'fullchain.pem')):
+        return True
+
+    res = index.check_domain(hostname, renewal_before=renewal_before, domains=domains)
+    try:
+        index.save()
+    except (IOError, OSError) as e:
+        logger.debug('Could not save the certificate index: %s' % e)
+    return res != certindex.CertIndex.OK
+
+
+def parse_args(argv):
+    """
+    Parses the options relevant for the precheck, the full parser lives in the cli.
+    Options taking a value are listed so the value is not taken for a command.
+    :param argv: arguments without the program name
+    :return: (args, unknown)
+    """
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('-n', '--non-interactive', dest='noninteractive', action='store_const', const=True)
+    parser.add_argument('--force', dest='force', action='store_const', const=True, default=False)
+    parser.add_argument('--vpc', dest='is_vpc', default=None)
+    parser.add_argument('--le-verification', dest='le_verif', default=None)
+    for opt in ['-r', '--attempts', '-l', '--pid-lock', '--stats-log', '--email', '--reg-type', '--reg-token']:
+        parser.add_argument(opt)
+    parser.add_argument('commands', nargs=argparse.ZERO_OR_MORE, default=[])
+    return parser.parse_known_args(argv)
+
+
+def run(argv, config_path=None, index=None):
+    """
+    Answers the periodic commands without loading the full application if there is nothing to do.
+    Only the non-interactive renew without overrides (they rewrite the config) and onboot
+    without a configuration are handled here.
+    :param argv: arguments without the program name
+    :param config_path:
+    :param index: CertIndex
+    :return: exit code, PRECHECK_CONTINUE if the full application has to run
+    """
+    try:
+        args, unknown = parse_args(argv)
+    except SystemExit:
+        return PRECHECK_CONTINUE
+
+    if not args.noninteractive or len(unknown) > 0 or len(args.commands) != 1:
+        return PRECHECK_CONTINUE
+
+    cmd = args.commands[0]
+    if cmd == 'renew':
+        if args.force or args.is_vpc is not None or args.le_verif is not None:
+            return PRECHECK_CONTINUE
+
+        # Missing config / domains are reported by the application
+        config = read_config(config_path)
+        if config is None or not config.get('domains'):
+            return PRECHECK_CONTINUE
+
+        hostname = config.get('ejbca_hostname')
+        if is_renewal_needed(hostname, domains=config.get('ejbca_domains'), index=index):
+            return PRECHECK_CONTINUE
+
+        print('\nRenewal for %s is not needed now. Run with --force to override this' % hostname)
+        return 0
+
+    elif cmd == 'onboot':
+        # Re-registration needs the identity and the instance metadata, only the missing config is answered
+        if read_config(config_path) is not None:
+            return PRECHECK_CONTINUE
+
+        print('\nError! Enigma config file not found %s' % (config_path if config_path is not None
+                                                             else os.path.join(CONFIG_DIR, CONFIG_FILE)))
+        print(' Cannot continue. Have you run init already?\n')
+        return 2
+
+    return PRECHECK_CONTINUE
@@ -0,0 +1,1082 @@
+import collections
+import errno
+import fcntl
+import grp
+import json
+import logging
+import os
+import pwd
+import re
+import select
+import shlex
+import subprocess
+import sys
+import threading
+import time
+import types
+
+
+__author__ = 'dusanklinec'
+logger = logging.getLogger(__name__)
+
+
+class CmdExecution(object):
+    """
+    Handle on a running command, passed to the output callbacks.
+    Mimics the sarge Pipeline interface used by the callbacks (p.commands[0].terminate())
+    """
+    def __init__(self, cmd=None, process=None, *args, **kwargs):
+        self.cmd = cmd
+        self.process = process
+        self.commands = [process]
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    @property
+    def returncode(self):
+        return self.process.returncode
+
+    def poll(self):
+        return self.process.poll()
+
+    def terminate(self):
+        try:
+            self.process.terminate()
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def kill(self):
+        try:
+            self.process.kill()
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+
+
+class LineSplitter(object):
+    """
+    Accumulates raw chunks read from a pipe, returns complete lines (with the trailing newline).
+    The unterminated rest is kept until more data arrives or the stream is closed.
+    """
+    def __init__(self, *args, **kwargs):
+        self.buffer = ''
+
+    def feed(self, data):
+        """
+        Adds a new chunk, returns list of completed lines
+        :param data:
+        :return:
+        """
+        self.buffer += data
+        idx = self.buffer.rfind('\n')
+        if idx < 0:
+            return []
+
+        complete, self.buffer = self.buffer[:idx], self.buffer[idx+1:]
+        return [x + '\n' for x in complete.split('\n')]
+
+    def flush(self):
+        """
+        Returns the unterminated rest of the stream, if any
+        :return:
+        """
+        rest, self.buffer = self.buffer, ''
+        return [rest] if len(rest) > 0 else []
+
+
+class OutputCapture(object):
+    """
+    Bounded output capture. Keeps only the tail of the output within the line / byte budget (ring buffer),
+    so a chatty command cannot grow the memory. Regex watchers are evaluated on each line as it streams,
+    callers looking for a pattern do not need the whole output.
+    """
+    def __init__(self, max_lines=None, max_bytes=None, *args, **kwargs):
+        self.max_lines = max_lines
+        self.max_bytes = max_bytes
+        self.lines = collections.deque()
+        self.bytes = 0
+        self.total_lines = 0
+        self.total_bytes = 0
+        self.dropped_lines = 0
+        self.watchers = []
+        self.matches = {}
+
+    def watch(self, pattern, callback=None, name=None, flags=0):
+        """
+        Registers a streaming regex hook, called as callback(match, line) on each matching line.
+        The last match is remembered under the name (pattern string by default), see matched().
+
+        :param pattern: regex string or compiled pattern
+        :param callback:
+        :param name:
+        :param flags:
+        :return: self
+        """
+        regex = re.compile(pattern, flags) if isinstance(pattern, types.StringTypes) else pattern
+        name = name if name is not None else regex.pattern
+        self.watchers.append((name, regex, callback))
+        return self
+
+    def matched(self, name):
+        return name in self.matches
+
+    def get_match(self, name):
+        return self.matches.get(name)
+
+    def append(self, line):
+        self.total_lines += 1
+        self.total_bytes += len(line)
+
+        for name, regex, callback in self.watchers:
+            match = regex.search(line)
+            if match is None:
+                continue
+            self.matches[name] = match
+            if callback is not None:
+                callback(match, line)
+
+        self.lines.append(line)
+        self.bytes += len(line)
+        while len(self.lines) > 1 and (
+                (self.max_lines is not None and len(self.lines) > self.max_lines) or
+                (self.max_bytes is not None and self.bytes > self.max_bytes)):
+            self.bytes -= len(self.lines.popleft())
+            self.dropped_lines += 1
+
+    def is_truncated(self):
+        return self.dropped_lines > 0
+
+    def tail(self, count=None):
+        lines = list(self.lines)
+        return lines if count is None else lines[-count:]
+
+    def to_list(self):
+        return list(self.lines)
+
+    def __iter__(self):
+        return iter(self.lines)
+
+    def __len__(self):
+        return len(self.lines)
+
+
+class PromptRule(object):
+    """
+    One row of the prompt -> response table.
+    Prompt is given as a substring (text), line prefix (prefix) or a regular expression (regex).
+    Response is a string fed to the process or a callable response(line, feeder, p) returning
+    the string to feed (or None).
+    Line only rules are evaluated on complete lines only, never on partial output.
+    """
+    def __init__(self, text=None, prefix=None, regex=None, response='\n', line_only=False, *args, **kwargs):
+        self.text = text
+        self.prefix = prefix
+        self.regex = regex
+        self.response = response
+        self.line_only = line_only
+
+    def to_regex(self):
+        if self.text is not None:
+            return r'(?=.*?%s)' % re.escape(self.text)
+        if self.prefix is not None:
+            return r'(?=\s*%s)' % re.escape(self.prefix)
+        if self.regex is not None:
+            return r'(?=.*?(?:%s))' % self.regex
+        raise ValueError('Prompt rule has no pattern')
+
+
+class PromptResponder(object):
+    """
+    Prompt answering automaton.
+    The prompt table is compiled into a single regex alternation anchored at the line start,
+    so one match per line decides the answer and the table order gives the rule priority.
+
+    In the streaming mode (feed()) the output is matched incrementally: an unterminated line
+    is matched as soon as it looks like a prompt waiting for input (ends with a prompt terminator),
+    so the answer goes out the moment the prompt appears. Each line is answered at most once.
+    """
+    PROMPT_END = re.compile(r'[:?>\]]\s*$')
+    MAX_PARTIAL = 4096
+
+    def __init__(self, rules=None, *args, **kwargs):
+        self.rules = list(rules) if rules is not None else []
+        self.regex_line = None
+        self.regex_partial = None
+        self.streams = {}
+        self.compile()
+
+    def add(self, rule):
+        self.rules.append(rule)
+        return self.compile()
+
+    def compile(self):
+        def build(only_partial):
+            parts = ['(?P<r%d>%s)' % (idx, rule.to_regex()) for idx, rule in enumerate(self.rules)
+                     if not (only_partial and rule.line_only)]
+            return re.compile(r'^(?:%s)' % '|'.join(parts)) if len(parts) > 0 else None
+
+        self.regex_line = build(False)
+        self.regex_partial = build(True)
+        return self
+
+    def match(self, line, partial=False):
+        """
+        Returns the rule for the line, None if there is no matching rule
+        :param line:
+        :param partial: True if the line is not terminated yet
+        :return:
+        """
+        regex = self.regex_partial if partial else self.regex_line
+        if regex is None:
+            return None
+        m = regex.match(line)
+        if m is None:
+            return None
+        return self.rules[int(m.lastgroup[1:])]
+
+    def answer(self, line, feeder, p=None, partial=False, *args, **kwargs):
+        """
+        Answers the line if some rule matches. Line mode entry point, usable as on_out callback.
+        :return: matched rule or None
+        """
+        rule = self.match(line, partial=partial)
+        if rule is None:
+            return None
+
+        response = rule.response
+        if callable(response):
+            response = response(line, feeder, p)
+        if response is not None:
+            feeder.feed(response)
+        return rule
+
+    def __call__(self, line, feeder, p=None, *args, **kwargs):
+        return self.answer(line, feeder, p)
+
+    def feed(self, data, feeder, p=None, stream=None):
+        """
+        Streaming mode - consumes raw output chunk, answers completed lines
+        and the pending partial line if it is a prompt.
+
+        :param data: raw output data
+        :param feeder:
+        :param p:
+        :param stream: stream identifier, each stream has its own line state
+        :return:
+        """
+        buf, answered = self.streams.get(stream, ('', False))
+        lines = (buf + data).split('\n')
+        for line in lines[:-1]:
+            if not answered:
+                self.answer(line, feeder, p)
+            answered = False
+
+        buf = lines[-1][-self.MAX_PARTIAL:]
+        if len(buf) > 0 and not answered and self.PROMPT_END.search(buf):
+            answered = self.answer(buf, feeder, p, partial=True) is not None
+
+        self.streams[stream] = (buf, answered)
+
+
+class QueueFeeder(object):
+    """
+    Non-blocking stdin feeder, drop-in for the sarge Feeder in the event loop.
+    Data is queued and written to the process stdin by the loop once the pipe is writable,
+    so a process not reading its input never blocks the loop.
+    """
+    def __init__(self, *args, **kwargs):
+        self.buffer = ''
+        self.closed = False
+        self.runner = None
+
+    def feed(self, data):
+        if isinstance(data, types.UnicodeType):
+            data = data.encode('utf-8')
+        if self.closed:
+            raise ValueError('Feeder already closed')
+        self.buffer += data
+        if self.runner is not None:
+            self.runner.stdin_changed()
+
+    def close(self):
+        """
+        Closes the process stdin once all queued data is written
+        :return:
+        """
+        self.closed = True
+        if self.runner is not None:
+            self.runner.stdin_changed()
+
+    def pending(self):
+        return len(self.buffer) > 0
+
+    def consumed(self, count):
+        self.buffer = self.buffer[count:]
+
+
+class Poller(object):
+    """
+    Readiness notification on file descriptors.
+    Uses poll() where available (epoll semantics for a few descriptors), select() otherwise.
+    """
+    HAS_POLL = hasattr(select, 'poll')
+    EV_READ = (select.POLLIN | select.POLLPRI | select.POLLHUP | select.POLLERR) if HAS_POLL else 1
+    EV_WRITE = (select.POLLOUT | select.POLLHUP | select.POLLERR) if HAS_POLL else 4
+
+    def __init__(self, *args, **kwargs):
+        self.fds = {}
+        self.poller = select.poll() if self.HAS_POLL else None
+
+    def register(self, fd, read=True, write=False):
+        mask = (self.EV_READ if read else 0) | (self.EV_WRITE if write else 0)
+        if fd in self.fds:
+            self.fds[fd] = mask
+            if self.poller is not None:
+                self.poller.modify(fd, mask)
+            return
+
+        self.fds[fd] = mask
+        if self.poller is not None:
+            self.poller.register(fd, mask)
+
+    def unregister(self, fd):
+        if fd not in self.fds:
+            return
+        del self.fds[fd]
+        if self.poller is not None:
+            self.poller.unregister(fd)
+
+    def __len__(self):
+        return len(self.fds)
+
+    def poll(self, timeout=None):
+        """
+        Blocks until some of the registered descriptors is ready or timeout elapses.
+        :param timeout: timeout in seconds, None blocks indefinitely
+        :return: list of ready descriptors (fd, readable, writable)
+        """
+        while True:
+            try:
+                if self.poller is not None:
+                    events = self.poller.poll(None if timeout is None else int(max(0, timeout) * 1000))
+                    return [(fd, bool(evt & self.EV_READ), bool(evt & self.EV_WRITE)) for fd, evt in events]
+
+                rlist = [fd for fd, mask in self.fds.items() if mask & self.EV_READ]
+                wlist = [fd for fd, mask in self.fds.items() if mask & self.EV_WRITE]
+                readable, writable, _ = select.select(rlist, wlist, [], timeout)
+                return [(fd, fd in readable, fd in writable) for fd in set(readable) | set(writable)]
+
+            except (select.error, IOError, OSError) as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+
+
+class CmdStats(object):
+    """
+    Resource accounting record of one finished command
+    """
+    def __init__(self, cmd=None, label=None, pid=None, *args, **kwargs):
+        self.cmd = cmd
+        self.label = label
+        self.pid = pid
+        self.returncode = None
+        self.time_start = None
+        self.wall = None
+        self.utime = None
+        self.stime = None
+        self.maxrss = None
+        self.out_bytes = 0
+        self.err_bytes = 0
+
+    def set_rusage(self, rusage):
+        if rusage is None:
+            return
+        self.utime = rusage.ru_utime
+        self.stime = rusage.ru_stime
+        self.maxrss = rusage.ru_maxrss
+
+    def to_json(self):
+        cmd = self.cmd if isinstance(self.cmd, types.StringTypes) or self.cmd is None else ' '.join(self.cmd)
+        return collections.OrderedDict([
+            ('label', self.label),
+            ('cmd', cmd),
+            ('pid', self.pid),
+            ('returncode', self.returncode),
+            ('time_start', self.time_start),
+            ('wall', self.wall),
+            ('utime', self.utime),
+            ('stime', self.stime),
+            ('maxrss_kb', self.maxrss),
+            ('out_bytes', self.out_bytes),
+            ('err_bytes', self.err_bytes),
+        ])
+
+    def __repr__(self):
+        return 'CmdStats(%s)' % json.dumps(self.to_json())
+
+
+class StatsCollector(object):
+    """
+    Collects CmdStats of all commands run through the engine.
+    Records are kept in memory and optionally appended to a JSON-lines sink.
+    """
+    def __init__(self, *args, **kwargs):
+        self.records = []
+        self.sink = None
+
+    def set_sink(self, path):
+        """
+        Appends each record as one JSON line to the given file. None disables the sink.
+        :param path:
+        :return:
+        """
+        if self.sink is not None:
+            self.sink.close()
+        self.sink = open(path, 'a') if path is not None else None
+
+    def add(self, stats):
+        self.records.append(stats)
+        if self.sink is not None:
+            try:
+                self.sink.write(json.dumps(stats.to_json()) + '\n')
+                self.sink.flush()
+            except (IOError, OSError) as e:
+                logger.warning('Could not write command stats: %s' % e)
+
+    def get_records(self, label=None):
+        return [x for x in self.records if label is None or x.label == label]
+
+    def summary(self):
+        """
+        Aggregates records by label
+        :return: dict label -> {count, wall, utime, stime, maxrss_kb}
+        """
+        res = collections.OrderedDict()
+        for rec in sorted(self.records, key=lambda x: x.wall or 0, reverse=True):
+            agg = res.setdefault(rec.label, {'count': 0, 'wall': 0.0, 'utime': 0.0, 'stime': 0.0, 'maxrss_kb': 0})
+            agg['count'] += 1
+            agg['wall'] += rec.wall or 0.0
+            agg['utime'] += rec.utime or 0.0
+            agg['stime'] += rec.stime or 0.0
+            agg['maxrss_kb'] = max(agg['maxrss_kb'], rec.maxrss or 0)
+        return res
+
+    def clear(self):
+        self.records = []
+
+
+# Process-wide collector of the command resource usage
+collector = StatsCollector()
+
+# preexec_fn is not safe in multithreaded programs (commands are started from the task worker threads),
+# spawns switching the identity are serialized
+spawn_lock = threading.Lock()
+
+
+class RunAs(object):
+    """
+    Identity the command runs under - replacement of the sudo -E -H -u user wrapper.
+    The child process switches groups, gid and uid itself right before exec,
+    environment is inherited, HOME / USER / LOGNAME are set to the target user.
+    """
+    def __init__(self, user=None, *args, **kwargs):
+        pw = pwd.getpwnam(user) if user is not None else pwd.getpwuid(os.geteuid())
+        self.user = pw.pw_name
+        self.uid = pw.pw_uid
+        self.gid = pw.pw_gid
+        self.home = pw.pw_dir
+        self.groups = self.get_groups()
+
+    def get_groups(self):
+        """
+        Supplementary groups of the user, as initgroups() would set them
+        :return:
+        """
+        groups = [self.gid]
+        for group in grp.getgrall():
+            if self.user in group.gr_mem and group.gr_gid not in groups:
+                groups.append(group.gr_gid)
+        return groups
+
+    def is_current(self):
+        return self.uid == os.geteuid()
+
+    def get_env(self, env=None):
+        env = dict(env if env is not None else os.environ)
+        env['HOME'] = self.home
+        env['USER'] = self.user
+        env['LOGNAME'] = self.user
+        return env
+
+    def preexec(self):
+        """
+        Runs in the child between fork and exec
+        :return:
+        """
+        if self.is_current():
+            return
+        os.setgroups(self.groups)
+        os.setgid(self.gid)
+        os.setuid(self.uid)
+
+    def popen(self, args, env=None, **kwargs):
+        """
+        Spawns the process under the identity, serialized by spawn_lock
+        :param args: subprocess.Popen arguments
+        :param env: environment, current one if None
+        :param kwargs: subprocess.Popen keyword arguments
+        :return: subprocess.Popen
+        """
+        if self.is_current():
+            return subprocess.Popen(args, env=self.get_env(env), **kwargs)
+        with spawn_lock:
+            return subprocess.Popen(args, env=self.get_env(env), preexec_fn=self.preexec, **kwargs)
+
+    def __repr__(self):
+        return 'RunAs(%s)' % self.user
+
+
+class CmdRunner(object):
+    """
+    Event driven subprocess I/O engine.
+    Both output pipes are read in bulk, only when the poller reports readiness.
+    Complete lines are dispatched to on_out / on_err callbacks: callback(line).
+
+    Command is executed directly, under the run_as identity if given (no sudo / shell wrappers).
+
+    Wall time, CPU time, peak RSS and output sizes of the command are recorded
+    to CmdStats (self.stats) and reported to the collector when the process is reaped.
+    """
+    CHUNK_SIZE = 65536
+
+    # Exit is checked periodically, pipes inherited by a daemonized grandchild may never close
+    EXIT_CHECK_INTERVAL = 0.5
+    DRAIN_TIMEOUT = 2.0
+
+    def __init__(self, cmd, cwd=None, env=None, stdin=None, on_out=None, on_err=None, shell=False,
+                 label=None, stats_collector=None, run_as=None, *args, **kwargs):
+        self.cmd = cmd
+        self.cwd = cwd
+        self.env = env
+        self.stdin = stdin
+        self.on_out = on_out
+        self.on_err = on_err
+        self.shell = shell
+        self.label = label
+        self.run_as = run_as
+        self.stats_collector = stats_collector if stats_collector is not None else collector
+
+        self.process = None
+        self.execution = None
+        self.streams = {}
+        self.loop = None
+        self.stats = None
+        self.exit_time = None
+
+    def get_args(self):
+        """
+        Command to execute. Strings are tokenized as a shell would do, no shell is spawned.
+        :return:
+        """
+        if self.shell or not isinstance(self.cmd, types.StringTypes):
+            return self.cmd
+        return shlex.split(self.cmd)
+
+    def get_stdin(self):
+        return self.stdin
+
+    def start(self):
+        """
+        Spawns the process
+        :return: CmdExecution
+        """
+        self.stats = CmdStats(cmd=self.cmd, label=self.label)
+        self.stats.time_start = time.time()
+        kwargs = dict(shell=self.shell, cwd=self.cwd, stdin=self.get_stdin(), stdout=subprocess.PIPE,
+                      stderr=subprocess.PIPE, close_fds=True)
+        if self.run_as is not None:
+            self.process = self.run_as.popen(self.get_args(), env=self.env, **kwargs)
+        else:
+            self.process = subprocess.Popen(self.get_args(), env=self.env, **kwargs)
+        self.execution = CmdExecution(cmd=self.cmd, process=self.process)
+        self.stats.pid = self.process.pid
+
+        self.streams = {
+            self.process.stdout.fileno(): (LineSplitter(), self.on_out),
+            self.process.stderr.fileno(): (LineSplitter(), self.on_err),
+        }
+        return self.execution
+
+    def is_started(self):
+        return self.process is not None
+
+    def is_running(self):
+        return self.process is not None and len(self.streams) > 0
+
+    def read_stream(self, fd):
+        """
+        Reads the available data from the stream, dispatches complete lines.
+        :param fd:
+        :return: False if the stream got closed
+        """
+        while True:
+            try:
+                data = os.read(fd, self.CHUNK_SIZE)
+                break
+            except (IOError, OSError) as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.EAGAIN:
+                    return True
+                raise
+
+        if len(data) == 0:
+            self.close_stream(fd)
+            return False
+
+        splitter, callback = self.streams[fd]
+
+        if fd == self.process.stdout.fileno():
+            self.stats.out_bytes += len(data)
+        else:
+            self.stats.err_bytes += len(data)
+
+        self.on_stream_data(fd, data)
+        self.dispatch(callback, splitter.feed(data))
+        return True
+
+    def close_stream(self, fd):
+        """
+        Stream closed (EOF or abandoned after the process exit), dispatches the last partial line
+        :param fd:
+        :return:
+        """
+        splitter, callback = self.streams.pop(fd)
+        self.on_stream_data(fd, '')
+        self.dispatch(callback, splitter.flush())
+
+    def on_stream_data(self, fd, data):
+        """
+        Hook called on each raw chunk read from the output, before line dispatching.
+        :param fd:
+        :param data: raw data, empty string on stream close
+        :return:
+        """
+        pass
+
+    def dispatch(self, callback, lines):
+        if callback is None:
+            return
+        for line in lines:
+            callback(line)
+
+    def get_write_fd(self):
+        """
+        Returns stdin descriptor the loop should write to, if any data is pending
+        :return:
+        """
+        return None
+
+    def write_stdin(self):
+        pass
+
+    def stdin_changed(self):
+        if self.loop is not None:
+            self.loop.update(self)
+
+    def get_deadline(self):
+        return None
+
+    def on_deadline(self):
+        pass
+
+    def finish(self):
+        """
+        Called by the loop after both output streams are closed. Reaps the process.
+        :return: return code
+        """
+        self.process.stdout.close()
+        self.process.stderr.close()
+        self.reap()
+
+        self.stats.returncode = self.process.returncode
+        self.stats.wall = time.time() - self.stats.time_start
+        if self.stats_collector is not None:
+            self.stats_collector.add(self.stats)
+        return self.process.returncode
+
+    def reap(self, block=True):
+        """
+        Waits for the process with wait4() to get its resource usage.
+        If the process has been already reaped (e.g., by poll()) the usage is not available.
+        :param block: if False, returns None if the process is still running
+        :return: return code
+        """
+        if self.process.returncode is not None:
+            return self.process.returncode
+
+        while True:
+            try:
+                pid, status, rusage = os.wait4(self.process.pid, 0 if block else os.WNOHANG)
+                break
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    return self.process.wait() if block else self.process.poll()
+                raise
+
+        if pid == 0:
+            return None
+        if os.WIFSIGNALED(status):
+            self.process.returncode = -os.WTERMSIG(status)
+        else:
+            self.process.returncode = os.WEXITSTATUS(status)
+        self.stats.set_rusage(rusage)
+        return self.process.returncode
+
+    def get_exit_check(self):
+        """
+        Time of the next exit check, the drain deadline if the process already exited
+        :return:
+        """
+        if self.exit_time is not None:
+            return self.exit_time + self.DRAIN_TIMEOUT
+        return time.time() + self.EXIT_CHECK_INTERVAL
+
+    def is_drained(self):
+        """
+        Process exited and its output had time to be read. Pipes still open at this point are held by
+        a daemonized grandchild and are abandoned.
+        :return:
+        """
+        if self.exit_time is None:
+            if self.reap(block=False) is None:
+                return False
+            self.exit_time = time.time()
+        return time.time() >= self.exit_time + self.DRAIN_TIMEOUT
+
+    def wait(self):
+        """
+        Processes the output until both pipes are closed, reaps the process.
+        :return: return code
+        """
+        CmdLoop().add(self).run()
+        return self.process.returncode
+
+    def run(self):
+        """
+        Starts the process and waits for its termination
+        :return: return code
+        """
+        self.start()
+        return self.wait()
+
+
+class CmdJob(CmdRunner):
+    """
+    Command scheduled in the CmdLoop, several jobs run concurrently in one loop.
+    Output lines are accumulated, optionally logged and passed to the handlers as
+    handler(line, feeder, job). Handlers run in the loop so they must not block, answers are
+    queued to the non-blocking feeder.
+
+    Prompts can be answered by a PromptResponder working on the raw output stream, so
+    prompts without a trailing newline are answered immediately.
+
+    Output is accumulated to unbounded lists by default, OutputCapture can be passed to keep
+    only a bounded tail and to watch for patterns.
+
+    Supports a deadline (timeout in seconds) and cancellation.
+    """
+    KILL_GRACE = 5.0
+
+    def __init__(self, cmd, on_out=None, on_err=None, feeder=None, log=None, write_dots=False, timeout=None,
+                 on_done=None, out_capture=None, err_capture=None, responder=None, *args, **kwargs):
+        super(CmdJob, self).__init__(cmd, *args, **kwargs)
+        self.feeder = feeder if feeder is not None else QueueFeeder()
+        self.log = log
+        self.write_dots = write_dots
+        self.timeout = timeout
+        self.on_done = on_done
+        self.user_on_out = on_out
+        self.user_on_err = on_err
+        self.responder = responder
+
+        self.out_acc = out_capture if out_capture is not None else []
+        self.err_acc = err_capture if err_capture is not None else []
+        self.returncode = None
+        self.deadline = None
+        self.kill_deadline = None
+        self.timed_out = False
+        self.cancelled = False
+        self.done = False
+
+        self.on_out = self._handler(self.out_acc, 'user_on_out')
+        self.on_err = self._handler(self.err_acc, 'user_on_err')
+
+    def _handler(self, acc, callback_attr):
+        def handler(line):
+            acc.append(line)
+            if self.log is not None:
+                self.log.write(line)
+                self.log.flush()
+
+            if self.write_dots:
+                sys.stderr.write('.')
+
+            callback = getattr(self, callback_attr)
+            if callback is not None:
+                callback(line, self.feeder, self.execution)
+        return handler
+
+    def on_stream_data(self, fd, data):
+        if self.responder is not None and len(data) > 0:
+            self.responder.feed(data, self.feeder, self.execution, stream=fd)
+
+    def is_queue_feeder(self):
+        return isinstance(self.feeder, QueueFeeder)
+
+    def get_stdin(self):
+        if self.is_queue_feeder():
+            return subprocess.PIPE
+        return self.feeder.fileno() if self.feeder is not None else self.stdin
+
+    def start(self):
+        if self.timeout is not None:
+            self.deadline = time.time() + self.timeout
+
+        execution = super(CmdJob, self).start()
+        if self.is_queue_feeder():
+            self.feeder.runner = self
+            fcntl.fcntl(self.process.stdin.fileno(), fcntl.F_SETFL,
+                        fcntl.fcntl(self.process.stdin.fileno(), fcntl.F_GETFL) | os.O_NONBLOCK)
+        return execution
+
+    def get_write_fd(self):
+        if not self.is_queue_feeder() or self.process is None or self.process.stdin is None:
+            return None
+        if self.feeder.pending() or self.feeder.closed:
+            return self.process.stdin.fileno()
+        return None
+
+    def write_stdin(self):
+        """
+        Writes queued feeder data to the process stdin, closes it when requested.
+        :return:
+        """
+        stdin = self.process.stdin
+        if stdin is None:
+            return
+
+        try:
+            if self.feeder.pending():
+                written = os.write(stdin.fileno(), self.feeder.buffer)
+                self.feeder.consumed(written)
+
+        except (IOError, OSError) as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            if e.errno != errno.EPIPE:
+                raise
+            # Process does not read the input anymore
+            self.feeder.consumed(len(self.feeder.buffer))
+
+        if self.feeder.closed and not self.feeder.pending():
+            self.close_stdin()
+
+    def close_stdin(self):
+        stdin, self.process.stdin = self.process.stdin, None
+        if stdin is not None:
+            if self.loop is not None:
+                self.loop.forget(stdin.fileno())
+            try:
+                stdin.close()
+            except (IOError, OSError):
+                pass
+
+    def get_deadline(self):
+        if self.kill_deadline is not None:
+            return self.kill_deadline
+        return self.deadline
+
+    def on_deadline(self):
+        """
+        Deadline reached - terminate the process, kill it if it ignores termination.
+        :return:
+        """
+        if self.kill_deadline is not None:
+            logger.info('Process %s does not terminate, killing' % self.process.pid)
+            self.execution.kill()
+            self.kill_deadline = None
+            return
+
+        self.timed_out = not self.cancelled
+        self.stop()
+
+    def stop(self):
+        self.execution.terminate()
+        self.deadline = None
+        self.kill_deadline = time.time() + self.KILL_GRACE
+
+    def cancel(self):
+        """
+        Cancels the job. Running process is terminated, not yet started job will not start.
+        :return:
+        """
+        self.cancelled = True
+        if self.done:
+            return
+        if self.process is None:
+            self.done = True
+            if self.loop is not None:
+                self.loop.remove(self)
+            return
+        self.stop()
+        if self.loop is not None:
+            self.loop.update(self)
+
+    def finish(self):
+        if self.process.stdin is not None:
+            self.close_stdin()
+        if self.is_queue_feeder():
+            self.feeder.runner = None
+        else:
+            self.feeder.close()
+
+        self.returncode = super(CmdJob, self).finish()
+        self.done = True
+        if self.on_done is not None:
+            self.on_done(self)
+        return self.returncode
+
+    def result(self):
+        """
+        Job result in the cli_cmd_sync format
+        :return: (return code, stdout lines, stderr lines)
+        """
+        out = self.out_acc if isinstance(self.out_acc, list) else self.out_acc.to_list()
+        err = self.err_acc if isinstance(self.err_acc, list) else self.err_acc.to_list()
+        return self.returncode, out, err
+
+    def wait(self):
+        """
+        Runs the job to completion. If scheduled in a loop, the whole loop runs until this job finishes.
+        :return: return code
+        """
+        if self.loop is not None:
+            self.loop.run(until=[self])
+        else:
+            CmdLoop().add(self).run()
+        return self.returncode
+
+
+class CmdLoop(object):
+    """
+    Event loop running several commands concurrently in one thread.
+    All output pipes and pending stdin writes are multiplexed by one poller,
+    the loop sleeps until some descriptor is ready or the nearest job deadline.
+    """
+    def __init__(self, *args, **kwargs):
+        self.poller = Poller()
+        self.runners = []
+        self.fds = {}
+
+    def add(self, runner):
+        """
+        Adds a runner to the loop, starts it if not started yet.
+        :param runner:
+        :return: self
+        """
+        if getattr(runner, 'done', False):
+            return self
+        if not runner.is_started():
+            runner.start()
+
+        runner.loop = self
+        self.runners.append(runner)
+        for fd in runner.streams:
+            self.fds[fd] = runner
+            self.poller.register(fd, read=True)
+        self.update(runner)
+        return self
+
+    def update(self, runner):
+        """
+        Re-evaluates the write interest of the runner stdin
+        :param runner:
+        :return:
+        """
+        fd = runner.get_write_fd()
+        if fd is not None:
+            self.fds[fd] = runner
+            self.poller.register(fd, read=False, write=True)
+
+    def forget(self, fd):
+        self.fds.pop(fd, None)
+        self.poller.unregister(fd)
+
+    def remove(self, runner):
+        if runner in self.runners:
+            self.runners.remove(runner)
+
+    def next_timeout(self):
+        deadlines = [x.get_deadline() for x in self.runners if x.get_deadline() is not None]
+        deadlines += [x.get_exit_check() for x in self.runners]
+        if len(deadlines) == 0:
+            return None
+        return max(0, min(deadlines) - time.time())
+
+    def check_deadlines(self):
+        now = time.time()
+        for runner in list(self.runners):
+            deadline = runner.get_deadline()
+            if deadline is not None and deadline <= now:
+                runner.on_deadline()
+
+    def step(self, timeout=None):
+        """
+        One loop iteration - waits for readiness, processes ready descriptors
+        :param timeout:
+        :return:
+        """
+        for fd, readable, writable in self.poller.poll(timeout):
+            runner = self.fds.get(fd)
+            if runner is None:
+                continue
+
+            if fd in runner.streams:
+                if not runner.read_stream(fd):
+                    self.forget(fd)
+            elif writable or readable:
+                runner.write_stdin()
+                if runner.get_write_fd() is None and fd in self.fds and runner.process.stdin is not None:
+                    self.poller.unregister(fd)
+                    self.fds.pop(fd, None)
+
+        self.check_deadlines()
+        for runner in list(self.runners):
+            if len(runner.streams) > 0 and runner.is_drained():
+                logger.debug('Process %s exited, output pipes held open by another process'
+                             % runner.process.pid)
+                for fd in list(runner.streams):
+                    runner.close_stream(fd)
+                    self.forget(fd)
+
+            if len(runner.streams) == 0:
+                self.runners.remove(runner)
+                runner.finish()
+
+    def run(self, until=None):
+        """
+        Runs the loop until all runners (or the given ones) finish.
+        :param until: optional list of runners to wait for
+        :return:
+        """
+        while len(self.runners) > 0:
+            if until is not None and all(x not in self.runners for x in until):
+                break
+            self.step(self.next_timeout())
+        return self
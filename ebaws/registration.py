@@ -1,9 +1,12 @@
 import logging
-from config import Config
+from config import Config, EBEndpoint
 from core import Core
 from errors import *
 import requests
 import util
+import imds
+import hostfacts
+import apisession
 import re
 import errors
 import consts
@@ -26,7 +29,8 @@ logger = logging.getLogger(__name__)
 
 class InfoLoader(object):
     """
-    Loads information from the system
+    Loads information from the system.
+    Values are loaded lazily through the host facts cache, IP related values have a short TTL.
     """
 
     AMI_KEY_ID = 'ami-id'
@@ -41,18 +45,58 @@ class InfoLoader(object):
     AMI_KEYS = [AMI_KEY_ID, AMI_KEY_INSTANCE_ID, AMI_KEY_INSTANCE_TYPE, AMI_KEY_PLACEMENT, AMI_KEY_PRODUCT_CODES,
                 AMI_KEY_PUBLIC_IP, AMI_KEY_LOCAL_IP, AMI_KEY_PUBLIC_HOSTNAME]
 
-    def __init__(self, *args, **kwargs):
-        self.ami_id = None
-        self.ami_instance_id = None
-        self.ami_instance_type = None
-        self.ami_placement = None
-        self.ami_product_code = None
-        self.ami_results = None
-        self.ami_public_ip = None
-        self.ami_local_ip = None
-        self.ami_public_hostname = None
+    # Host facts field -> metadata keys
+    AMI_IP_KEYS = [AMI_KEY_PUBLIC_IP, AMI_KEY_LOCAL_IP, AMI_KEY_PUBLIC_HOSTNAME]
+    AMI_FIELDS = {
+        'ami': [x for x in AMI_KEYS if x not in AMI_IP_KEYS],
+        'ami_ip': AMI_IP_KEYS,
+    }
+
+    def __init__(self, facts=None, *args, **kwargs):
+        self.facts = facts if facts is not None else hostfacts.facts
+        self.values = {}
         self.ec2_metadata_executable = None
 
+    @property
+    def ami_id(self):
+        return self.get(self.AMI_KEY_ID)
+
+    @property
+    def ami_instance_id(self):
+        return self.get(self.AMI_KEY_INSTANCE_ID)
+
+    @property
+    def ami_instance_type(self):
+        return self.get(self.AMI_KEY_INSTANCE_TYPE)
+
+    @property
+    def ami_placement(self):
+        return self.get(self.AMI_KEY_PLACEMENT)
+
+    @property
+    def ami_product_code(self):
+        return self.get(self.AMI_KEY_PRODUCT_CODES)
+
+    @property
+    def ami_public_ip(self):
+        return self.get(self.AMI_KEY_PUBLIC_IP)
+
+    @property
+    def ami_local_ip(self):
+        return self.get(self.AMI_KEY_LOCAL_IP)
+
+    @property
+    def ami_public_hostname(self):
+        return self.get(self.AMI_KEY_PUBLIC_HOSTNAME)
+
+    @property
+    def ami_results(self):
+        """
+        All loaded metadata values (copy)
+        """
+        self.load()
+        return dict((k, v) for k, v in self.values.items() if v is not None)
+
     def env_check(self):
         for candidate in consts.EC2META_FILES:
             if util.exe_exists(candidate):
@@ -60,7 +104,72 @@ class InfoLoader(object):
         if self.ec2_metadata_executable is None:
             raise EnvError('ec2-metadata executable was not found')
 
+    def get(self, key):
+        if key not in self.values:
+            for field, keys in self.AMI_FIELDS.items():
+                if key in keys:
+                    self.load_field(field)
+        return self.values.get(key)
+
     def load(self):
+        """
+        Loads all the instance metadata
+        :return:
+        """
+        for field in self.AMI_FIELDS:
+            if any(x not in self.values for x in self.AMI_FIELDS[field]):
+                self.load_field(field)
+
+    def load_field(self, field):
+        keys = self.AMI_FIELDS[field]
+        res = self.facts.get(field, lambda: self.fetch(keys, required=field == 'ami'))
+        for key in keys:
+            self.values[key] = res.get(key) if res is not None else None
+
+    def invalidate_ip(self):
+        """
+        Drops the cached IP related values, the next access asks the metadata service again
+        :return:
+        """
+        self.facts.invalidate('ami_ip')
+        for key in self.AMI_IP_KEYS:
+            self.values.pop(key, None)
+
+    def fetch(self, keys, required=True):
+        """
+        Fetches the metadata, directly from the metadata service, the ec2-metadata script is a fallback
+        :param keys:
+        :param required: instance id has to be loaded, otherwise the metadata service is considered failed
+        :return: dict key -> value
+        """
+        res = self.fetch_imds(keys if not required else list(set(keys + [self.AMI_KEY_INSTANCE_ID])))
+        if res is not None:
+            return dict((k, v) for k, v in res.items() if k in keys)
+        res = self.fetch_script()
+        return dict((k, res.get(k)) for k in keys)
+
+    def fetch_imds(self, keys):
+        """
+        Loads the metadata over HTTP
+        :return: dict, None on failure
+        """
+        try:
+            results = imds.InstanceMetadata().fetch(keys)
+        except errors.Error as e:
+            logger.debug('Instance metadata service failed: %s' % e)
+            return None
+
+        if all(results.get(x) is None for x in keys):
+            return None
+        if self.AMI_KEY_INSTANCE_ID in keys and results.get(self.AMI_KEY_INSTANCE_ID) is None:
+            return None
+        return results
+
+    def fetch_script(self):
+        """
+        Loads the metadata with the ec2-metadata script
+        :return: dict
+        """
         self.env_check()
 
         # removed options:
@@ -69,7 +178,7 @@ class InfoLoader(object):
         out, err = util.run_script([self.ec2_metadata_executable] + ('-a -i -t -z -v -p -o'.split(' ')))
 
         lines = [x.strip() for x in out.split('\n')]
-        self.ami_results = {}
+        results = {}
         for line in lines:
             if len(line) == 0:
                 continue
@@ -80,25 +189,8 @@ class InfoLoader(object):
 
             c_key = match.group(1).strip()
             c_val = match.group(2).strip()
-            self.ami_results[c_key] = c_val
-
-            if c_key == self.AMI_KEY_ID:
-                self.ami_id = c_val
-            elif c_key == self.AMI_KEY_INSTANCE_ID:
-                self.ami_instance_id = c_val
-            elif c_key == self.AMI_KEY_INSTANCE_TYPE:
-                self.ami_instance_type = c_val
-            elif c_key == self.AMI_KEY_PLACEMENT:
-                self.ami_placement = c_val
-            elif c_key == self.AMI_KEY_PRODUCT_CODES:
-                self.ami_product_code = c_val
-            elif c_key == self.AMI_KEY_LOCAL_IP:
-                self.ami_local_ip = c_val
-            elif c_key == self.AMI_KEY_PUBLIC_IP:
-                self.ami_public_ip = c_val
-            elif c_key == self.AMI_KEY_PUBLIC_HOSTNAME:
-                self.ami_public_hostname = c_val
-        pass
+            results[c_key] = c_val
+        return results
 
 
 class EBRegAuth(object):
@@ -143,7 +235,7 @@ class Registration(object):
         self.auth_data = None
 
         self.info_loader = InfoLoader()
-        self.info_loader.load()
+        self.api_session = apisession.ApiSession()
         pass
 
     def new_identity(self, identities=None, id_dir=consts.CONFIG_DIR, backup_dir=consts.CONFIG_DIR_OLD):
@@ -237,7 +329,7 @@ class Registration(object):
         }
 
         get_auth_req = GetClientAuthRequest(client_data=client_data_req, env=self.config.env, config=self.eb_config)
-        get_auth_resp = get_auth_req.call()
+        get_auth_resp = self.api_session.call(get_auth_req)
         if 'authentication' not in get_auth_resp:
             raise InvalidResponse('Authentication types not present in the response')
 
@@ -297,7 +389,7 @@ class Registration(object):
         }
 
         init_auth_req = InitClientAuthRequest(client_data=client_data_req, env=self.config.env, config=self.eb_config)
-        init_auth_resp = init_auth_req.call()
+        init_auth_resp = self.api_session.call(init_auth_req)
         if 'clientid' not in init_auth_resp:
             raise InvalidResponse('Authentication initialization fails')
 
@@ -341,7 +433,7 @@ class Registration(object):
             client_data_reg['clientid'] = clid
 
         regreq = RegistrationRequest(client_data=client_data_reg, env=self.config.env, config=self.eb_config)
-        regresponse = regreq.call()
+        regresponse = self.api_session.call(regreq)
 
         if 'username' not in regresponse:
             raise InvalidResponse('Username was not present in the response')
@@ -363,7 +455,7 @@ class Registration(object):
 
         apireq = ApiKeyRequest(client_data=client_api_req, endpoint=endpoint,
                                env=self.config.env, config=self.eb_config)
-        apiresponse = apireq.call()
+        apiresponse = self.api_session.call(apireq)
 
         if 'apikey' not in apiresponse:
             raise InvalidResponse('ApiKey was not present in the getApiKey response')
@@ -391,7 +483,7 @@ class Registration(object):
 
         req = EnrolDomainRequest(api_data=api_data_reg, env=self.config.env, config=self.eb_config)
         try:
-            resp = req.call()
+            resp = self.api_session.call(req)
         except Exception:
             print api_data_reg
             print req.response
@@ -432,7 +524,9 @@ class Registration(object):
         """
 
         # In case of the private network, public address is not usable.
+        # DNS is updated with the current address, cached one could be outdated.
         if ip_to_use is None:
+            self.info_loader.invalidate_ip()
             if self.config.is_private_network:
                 ip_to_use = self.info_loader.ami_local_ip
             else:
@@ -446,7 +540,7 @@ class Registration(object):
         }
 
         req = GetDomainChallengeRequest(api_data=api_data_req_body, env=self.config.env, config=self.eb_config)
-        resp = req.call()
+        resp = self.api_session.call(req)
 
         if 'authentication' not in resp:
             raise InvalidResponse('Authentication not present in the response')
@@ -483,7 +577,7 @@ class Registration(object):
         req_upd.aux_data = signature_aux
 
         try:
-            resp_update = req_upd.call()
+            resp_update = self.api_session.call(req_upd)
         except Exception:
             if self.debug:
                 print api_data_req_body
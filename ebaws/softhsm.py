@@ -2,6 +2,7 @@ import os
 import json
 from core import Core
 import util
+import process
 from consts import *
 from errors import *
 from config import Config
@@ -161,16 +162,32 @@ class SoftHsmV1Config(object):
         :return:
         """
         util.make_or_verify_dir(self.SOFTHSM_DB_DIR, mode=0o755)
-        cmd = 'softhsm --init-token --slot 0 --pin 0000 --so-pin 0000 --label ejbca'
+        cmd = self.get_init_token_command()
 
         if user is None:
-            out, err = util.run_script(cmd.split(' '))
+            out, err = util.run_script(cmd)
             return out, err
 
         else:
             util.chown(self.SOFTHSM_DB_DIR, user, user)
-            cmd_sudo = ['sudo', '-E', '-H', '-u', user, '/bin/bash', '-c', cmd]
-            return util.run_script(cmd_sudo)
+            return util.run_script(cmd, run_as=process.RunAs(user))
+
+    def init_token_async(self, user=None, loop=None, timeout=None):
+        """
+        Schedules the token initialization to the event loop, returns the job immediately.
+        :param user: user to initialize token under
+        :return: CmdJob
+        """
+        util.make_or_verify_dir(self.SOFTHSM_DB_DIR, mode=0o755)
+
+        run_as = None
+        if user is not None:
+            util.chown(self.SOFTHSM_DB_DIR, user, user)
+            run_as = process.RunAs(user)
+        return util.cli_cmd_async(self.get_init_token_command(), loop=loop, timeout=timeout, run_as=run_as)
+
+    def get_init_token_command(self):
+        return ['softhsm', '--init-token', '--slot', '0', '--pin', '0000', '--so-pin', '0000', '--label', 'ejbca']
 
     def chown_tokens(self, user):
         """
@@ -0,0 +1,468 @@
+import hashlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import errors
+import util
+
+
+__author__ = 'dusanklinec'
+logger = logging.getLogger(__name__)
+
+
+class Task(object):
+    """
+    One step of the workflow.
+    Task function is called as fnc(ctx) with the shared context dict, returns the return code (0 / None = success).
+    Inputs are context keys the task reads, outputs are context keys the task sets.
+    Interactive tasks (prompts) are executed on the calling thread, one at a time.
+
+    Checkpoint tasks are recorded in the graph journal once they succeed. On the next run the task
+    is restored instead of executed if the fingerprint of its inputs matches the journal
+    and all its checkpoint input producers were restored as well.
+    JSON-serializable outputs are restored from the journal, restore(ctx) callback re-creates the rest,
+    returns False if the task cannot be restored (executed then).
+    Optional task does not stop the graph if it returns non-zero code, it is journaled as a warning.
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    RESTORED = 'restored'
+    FAILED = 'failed'
+    SKIPPED = 'skipped'
+
+    def __init__(self, name, fnc, inputs=None, outputs=None, after=None, interactive=False,
+                 checkpoint=False, fingerprint=None, restore=None, invalidates=None, optional=False,
+                 *args, **kwargs):
+        self.name = name
+        self.fnc = fnc
+        self.inputs = list(inputs) if inputs is not None else []
+        self.outputs = list(outputs) if outputs is not None else []
+        self.after = list(after) if after is not None else []
+        self.interactive = interactive
+        self.checkpoint = checkpoint
+        self.fingerprint = fingerprint
+        self.restore = restore
+        self.invalidates = list(invalidates) if invalidates is not None else []
+        self.optional = optional
+
+        self.deps = set()
+        self.input_deps = set()
+        self.fingerprint_value = None
+        self.state = self.PENDING
+        self.code = None
+        self.error = None
+        self.time_start = None
+        self.time_end = None
+
+    def is_complete(self):
+        return self.state in [self.DONE, self.RESTORED]
+
+    @property
+    def duration(self):
+        if self.time_start is None:
+            return None
+        return (self.time_end if self.time_end is not None else time.time()) - self.time_start
+
+    def __repr__(self):
+        return 'Task(%s, state=%s, code=%s)' % (self.name, self.state, self.code)
+
+
+class TaskJournal(object):
+    """
+    Persistent journal of the completed checkpoint tasks, so the interrupted workflow
+    continues from the failed step on the next run.
+    Each step is stored with the fingerprint of its inputs and its JSON-serializable outputs.
+    """
+
+    def __init__(self, path, *args, **kwargs):
+        self.path = path
+        self.lock = threading.RLock()
+        self.data = None
+        self.reset()
+
+    def reset(self):
+        """
+        Starts a new journal, previous records are discarded on the next save
+        :return:
+        """
+        with self.lock:
+            self.data = {'time_start': time.time(), 'finished': False, 'failed': None, 'steps': {}, 'warnings': {}}
+
+    def load(self):
+        """
+        Loads the journal from the file
+        :return: True if the journal was loaded
+        """
+        if not os.path.exists(self.path):
+            return False
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except (IOError, ValueError) as e:
+            logger.debug('Could not load the journal %s: %s' % (self.path, e))
+            return False
+
+        with self.lock:
+            self.reset()
+            self.data.update(data)
+        return True
+
+    def save(self):
+        with self.lock:
+            util.make_or_verify_dir(os.path.dirname(self.path), mode=0o755)
+            tmp_path = self.path + '.tmp'
+            with os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+                f.write(json.dumps(self.data, indent=2))
+            os.rename(tmp_path, self.path)
+
+    def is_unfinished(self):
+        """
+        True if there are some records of the workflow which did not finish
+        :return:
+        """
+        with self.lock:
+            return not self.data['finished'] and (len(self.data['steps']) > 0 or self.data['failed'] is not None)
+
+    def get_step(self, name):
+        with self.lock:
+            return self.data['steps'].get(name)
+
+    def get_failed_step(self):
+        with self.lock:
+            return self.data['failed']['step'] if self.data['failed'] is not None else None
+
+    def is_done(self, name, fingerprint):
+        step = self.get_step(name)
+        return step is not None and step['fingerprint'] == fingerprint
+
+    def record(self, name, fingerprint, outputs=None):
+        """
+        Records successfully finished step
+        :param name:
+        :param fingerprint:
+        :param outputs: JSON-serializable outputs to restore
+        :return:
+        """
+        with self.lock:
+            self.data['steps'][name] = {'fingerprint': fingerprint, 'time': time.time(),
+                                        'outputs': outputs if outputs is not None else {}}
+            self.save()
+
+    def fail(self, name, code, invalidate=None):
+        """
+        Records the failed step, the step and invalidated steps have to be executed again
+        :param name:
+        :param code:
+        :param invalidate: list of steps invalidated by the failure
+        :return:
+        """
+        with self.lock:
+            for step in [name] + list(invalidate if invalidate is not None else []):
+                self.data['steps'].pop(step, None)
+            self.data['failed'] = {'step': name, 'code': code, 'time': time.time()}
+            self.save()
+
+    def warn(self, name, code):
+        """
+        Records the failed optional step, the workflow continues and can finish
+        :param name:
+        :param code:
+        :return:
+        """
+        with self.lock:
+            self.data['steps'].pop(name, None)
+            self.data['warnings'][name] = {'code': code, 'time': time.time()}
+            self.save()
+
+    def get_warnings(self):
+        with self.lock:
+            return sorted(self.data['warnings'].keys())
+
+    def finish(self):
+        with self.lock:
+            self.data['finished'] = True
+            self.data['failed'] = None
+            self.save()
+
+    @staticmethod
+    def fingerprint(data):
+        """
+        Fingerprint of the JSON-serializable data
+        :param data:
+        :return: hex digest
+        """
+        return hashlib.sha256(json.dumps(data, sort_keys=True)).hexdigest()
+
+    @staticmethod
+    def is_serializable(value):
+        try:
+            json.dumps(value)
+            return True
+        except (TypeError, ValueError):
+            return False
+
+
+class TaskGraph(object):
+    """
+    Dependency graph of tasks.
+    Dependencies are derived from the declared inputs / outputs (and explicit after= ordering),
+    independent tasks run in parallel in worker threads.
+    The first failing task stops scheduling of new tasks, running tasks are finished.
+    With the journal, checkpoint tasks completed in the previous run are restored instead of executed.
+    """
+
+    def __init__(self, name=None, max_workers=4, journal=None, *args, **kwargs):
+        self.name = name
+        self.max_workers = max_workers
+        self.journal = journal
+        self.tasks = []
+        self.ctx = {}
+        self.cond = threading.Condition()
+        self.failed = None
+        self.time_start = None
+        self.time_end = None
+
+    def add(self, name, fnc, inputs=None, outputs=None, after=None, interactive=False, **kwargs):
+        """
+        Adds a new task to the graph
+        :param kwargs: checkpoint, fingerprint, restore, invalidates, optional - see Task
+        :return: Task
+        """
+        if self.get_task(name) is not None:
+            raise ValueError('Duplicate task: %s' % name)
+        task = Task(name, fnc, inputs=inputs, outputs=outputs, after=after, interactive=interactive, **kwargs)
+        self.tasks.append(task)
+        return task
+
+    def get_task(self, name):
+        for task in self.tasks:
+            if task.name == name:
+                return task
+        return None
+
+    def resolve(self, ctx):
+        """
+        Computes task dependencies, checks all inputs are provided and the graph is acyclic
+        :param ctx: initial context
+        :return:
+        """
+        producers = {}
+        for task in self.tasks:
+            for key in task.outputs:
+                if key in producers:
+                    raise ValueError('Output %s produced by %s and %s' % (key, producers[key].name, task.name))
+                producers[key] = task
+
+        for task in self.tasks:
+            task.deps = set()
+            task.input_deps = set()
+            for key in task.inputs:
+                if key in producers:
+                    task.deps.add(producers[key].name)
+                    task.input_deps.add(producers[key].name)
+                elif key not in ctx:
+                    raise ValueError('Input %s of the task %s is not provided' % (key, task.name))
+            for name in task.after + task.invalidates:
+                if self.get_task(name) is None:
+                    raise ValueError('Unknown task %s in the task %s' % (name, task.name))
+            task.deps.update(task.after)
+
+        visited, stack = set(), set()
+
+        def visit(task):
+            if task.name in stack:
+                raise ValueError('Dependency cycle at the task %s' % task.name)
+            if task.name in visited:
+                return
+            stack.add(task.name)
+            for dep in task.deps:
+                visit(self.get_task(dep))
+            stack.remove(task.name)
+            visited.add(task.name)
+
+        for task in self.tasks:
+            visit(task)
+
+    def is_ready(self, task):
+        return task.state == Task.PENDING \
+            and all(self.get_task(dep).is_complete() for dep in task.deps)
+
+    def run(self, ctx=None):
+        """
+        Runs the graph until all tasks finish or some task fails.
+        Exception raised by a task is re-raised once the running tasks finish.
+
+        :param ctx: initial context
+        :return: 0 on success, return code of the failed task otherwise
+        """
+        self.ctx = ctx if ctx is not None else {}
+        self.resolve(self.ctx)
+        self.failed = None
+        self.time_start = time.time()
+
+        try:
+            while True:
+                interactive = None
+                with self.cond:
+                    running = [x for x in self.tasks if x.state == Task.RUNNING]
+                    if self.failed is None:
+                        for task in [x for x in self.tasks if self.is_ready(x)]:
+                            if task.interactive:
+                                interactive = interactive or task
+                            elif len(running) < self.max_workers:
+                                self.start(task)
+                                running.append(task)
+
+                    if interactive is None:
+                        if len(running) == 0:
+                            break
+                        self.cond.wait(0.5)  # timeout keeps the main thread responsive to signals
+                        continue
+
+                    interactive.state = Task.RUNNING
+                self.execute(interactive)
+
+        finally:
+            self.time_end = time.time()
+
+        for task in self.tasks:
+            if task.state == Task.PENDING:
+                task.state = Task.SKIPPED
+
+        logger.debug('Task graph %s finished:\n%s' % (self.name, self.format_report()))
+        if self.failed is None:
+            if self.journal is not None:
+                self.journal.finish()
+            return 0
+
+        if self.failed.error is not None:
+            raise self.failed.error[0], self.failed.error[1], self.failed.error[2]
+        return self.failed.code
+
+    def start(self, task):
+        task.state = Task.RUNNING
+        thread = threading.Thread(target=self.execute, args=(task, ), name='task-%s' % task.name)
+        thread.setDaemon(True)
+        thread.start()
+
+    def execute(self, task):
+        """
+        Executes the task, records the result
+        :param task:
+        :return:
+        """
+        task.time_start = time.time()
+        code, error = None, None
+        try:
+            if self.journal is not None and task.checkpoint:
+                task.fingerprint_value = self.get_fingerprint(task)
+                if self.try_restore(task):
+                    with self.cond:
+                        task.time_end = time.time()
+                        task.code = 0
+                        task.state = Task.RESTORED
+                        self.cond.notify_all()
+                    return
+
+            code = task.fnc(self.ctx)
+            missing = [x for x in task.outputs if x not in self.ctx]
+            if (code is None or code == 0) and len(missing) > 0:
+                raise errors.InvalidState('Task %s did not set outputs: %s' % (task.name, ', '.join(missing)))
+
+        except Exception:
+            error = sys.exc_info()
+            logger.debug('Task %s failed with exception %s' % (task.name, error[1]))
+
+        with self.cond:
+            task.time_end = time.time()
+            task.code = code if code is not None else 0
+            task.error = error
+            task.state = Task.DONE if task.code == 0 and error is None else Task.FAILED
+            if task.state == Task.FAILED and task.optional and error is None:
+                task.state = Task.DONE
+            if task.state == Task.FAILED and self.failed is None:
+                self.failed = task
+                if error is not None and task.code == 0:
+                    task.code = -1
+            self.journal_result(task)
+            self.cond.notify_all()
+
+    def get_fingerprint(self, task):
+        """
+        Fingerprint of the task inputs, chained with the fingerprints of the checkpoint input producers.
+        Uses task.fingerprint(ctx) data if given, JSON-serializable inputs otherwise.
+        :param task:
+        :return:
+        """
+        if task.fingerprint is not None:
+            inputs = task.fingerprint(self.ctx)
+        else:
+            inputs = dict((k, self.ctx[k]) for k in task.inputs if TaskJournal.is_serializable(self.ctx[k]))
+
+        deps = sorted(self.get_task(x).fingerprint_value for x in task.input_deps if self.get_task(x).checkpoint)
+        return TaskJournal.fingerprint({'task': task.name, 'inputs': inputs, 'deps': deps})
+
+    def try_restore(self, task):
+        """
+        Restores the task from the journal if possible
+        :param task:
+        :return: True if restored
+        """
+        deps = [self.get_task(x) for x in task.input_deps]
+        if any(x.checkpoint and x.state != Task.RESTORED for x in deps):
+            return False
+        if not self.journal.is_done(task.name, task.fingerprint_value):
+            return False
+
+        self.ctx.update(self.journal.get_step(task.name)['outputs'])
+        try:
+            restored = task.restore is None or task.restore(self.ctx) is not False
+        except Exception as e:
+            logger.debug('Task %s could not be restored: %s' % (task.name, e))
+            restored = False
+
+        if restored and all(x in self.ctx for x in task.outputs):
+            logger.debug('Task %s restored from the journal' % task.name)
+            return True
+
+        for key in task.outputs:
+            self.ctx.pop(key, None)
+        return False
+
+    def journal_result(self, task):
+        """
+        Records the finished checkpoint task to the journal
+        :param task:
+        :return:
+        """
+        if self.journal is None or not task.checkpoint or task.fingerprint_value is None:
+            return
+        try:
+            if task.state == Task.DONE and task.code == 0:
+                outputs = dict((k, self.ctx[k]) for k in task.outputs if TaskJournal.is_serializable(self.ctx[k]))
+                self.journal.record(task.name, task.fingerprint_value, outputs)
+            elif task.state == Task.DONE:
+                self.journal.warn(task.name, task.code)
+            else:
+                self.journal.fail(task.name, task.code, invalidate=task.invalidates)
+        except (IOError, OSError) as e:
+            logger.warning('Could not write the journal %s: %s' % (self.journal.path, e))
+
+    def report(self):
+        """
+        Per-task timings
+        :return: list of (name, state, duration in seconds)
+        """
+        return [(x.name, x.state, x.duration) for x in self.tasks]
+
+    def format_report(self):
+        lines = []
+        for name, state, duration in self.report():
+            lines.append('  %-20s %-8s %s' % (name, state, '%.2f s' % duration if duration is not None else '-'))
+        if self.time_start is not None and self.time_end is not None:
+            lines.append('  %-20s %-8s %.2f s' % ('total', '', self.time_end - self.time_start))
+        return '\n'.join(lines)
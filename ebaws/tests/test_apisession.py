@@ -0,0 +1,95 @@
+import BaseHTTPServer
+import SocketServer
+import json
+import threading
+import unittest
+from ebaws import apisession, process
+from ebclient.eb_configuration import Configuration, Endpoint, SimpleRetry
+from ebclient.eb_registration import GetClientAuthRequest
+
+
+__author__ = 'dusanklinec'
+
+
+class ApiHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Stand-in for the registration API, keep-alive"""
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        req = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        self.server.functions.append(req.get('function'))
+        body = json.dumps({'status': self.server.status, 'response': {'authentication': ['type1']}})
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class ApiServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Keep-alive connections do not block the server shutdown"""
+    daemon_threads = True
+
+
+class ApiSessionTest(unittest.TestCase):
+    """Pooled API session against a local server"""
+
+    def setUp(self):
+        self.server = ApiServer(('127.0.0.1', 0), ApiHandler)
+        self.server.connections = 0
+        self.server.functions = []
+        self.server.status = 0x9000
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs={'poll_interval': 0.05})
+        self.thread.daemon = True
+        self.thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        self.collector = process.StatsCollector()
+        self.session = apisession.ApiSession(collector=self.collector)
+        self.addCleanup(self.session.close)
+
+    def get_request(self):
+        url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        config = Configuration(endpoint_register=Endpoint.url(url), timeout=5, retry=SimpleRetry(max_retry=1))
+        return GetClientAuthRequest(client_data={'type': 'test'}, env='devel', config=config)
+
+    def test_connection_reuse(self):
+        for _ in range(3):
+            resp = self.session.call(self.get_request())
+            self.assertEqual(resp, {'authentication': ['type1']})
+
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(self.server.functions, ['getauth'] * 3)
+
+    def test_stats(self):
+        self.session.call(self.get_request())
+        self.session.call(self.get_request())
+
+        records = self.collector.get_records(label='api:getauth')
+        self.assertEqual(len(records), 2)
+        self.assertEqual([x.new_connections for x in records], [1, 0])
+        self.assertEqual(records[0].returncode, 200)
+        self.assertTrue(records[0].wall >= 0)
+        self.assertTrue('new_connections' in records[0].to_json())
+
+        summary = self.session.summary()
+        self.assertEqual(summary['api:getauth']['count'], 2)
+        self.assertEqual(summary['api:getauth']['new_connections'], 1)
+
+    def test_invalid_status(self):
+        self.server.status = 0x6f00
+        with self.assertRaises(Exception):
+            self.session.call(self.get_request())
+        self.assertEqual(len(self.collector.get_records()), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
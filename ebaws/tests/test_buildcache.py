@@ -0,0 +1,73 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from ebaws import buildcache
+
+
+__author__ = 'dusanklinec'
+
+
+class BuildCacheTest(unittest.TestCase):
+    """Build fingerprint & artifact cache"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+        self.home = os.path.join(self.tmpdir, 'home')
+        for path in ['src/a.java', 'conf/install.properties', 'dist/ejbca.ear', 'dist/clientToolBox/tool.jar']:
+            self.write(os.path.join(self.home, path), path)
+
+    def write(self, path, data):
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(data)
+
+    def fingerprint(self, props='a=b'):
+        fp = buildcache.BuildFingerprint()
+        fp.add_data('install.properties', props)
+        fp.add_tree(self.home, exclude=['dist', 'conf/install.properties'])
+        return fp.hexdigest()
+
+    def test_fingerprint(self):
+        fp1 = self.fingerprint()
+        self.write(os.path.join(self.home, 'dist/ejbca.ear'), 'rebuilt')
+        self.write(os.path.join(self.home, 'conf/install.properties'), 'generated')
+        self.assertEqual(fp1, self.fingerprint())
+        self.assertNotEqual(fp1, self.fingerprint(props='a=c'))
+
+        self.write(os.path.join(self.home, 'src/b.java'), 'new')
+        self.assertNotEqual(fp1, self.fingerprint())
+
+    def test_store_restore(self):
+        cache = buildcache.BuildCache(os.path.join(self.tmpdir, 'cache'), keep=2)
+        artifacts = {'ejbca.ear': os.path.join(self.home, 'dist/ejbca.ear'),
+                     'clientToolBox': os.path.join(self.home, 'dist/clientToolBox')}
+
+        self.assertFalse(cache.has('fp1'))
+        cache.store('fp1', artifacts)
+        self.assertTrue(cache.has('fp1', ['ejbca.ear', 'clientToolBox']))
+        self.assertFalse(cache.has('fp1', ['missing']))
+
+        shutil.rmtree(os.path.join(self.home, 'dist'))
+        os.makedirs(os.path.join(self.home, 'dist'))
+        self.assertTrue(cache.restore('fp1', 'clientToolBox', os.path.join(self.home, 'dist/clientToolBox')))
+        self.assertTrue(cache.restore('fp1', 'ejbca.ear', os.path.join(self.home, 'dist/ejbca.ear')))
+        with open(os.path.join(self.home, 'dist/clientToolBox/tool.jar')) as f:
+            self.assertEqual(f.read(), 'dist/clientToolBox/tool.jar')
+        self.assertFalse(cache.restore('fp2', 'ejbca.ear', os.path.join(self.home, 'x')))
+
+        # Only the most recent entries are kept
+        for fp in ['fp2', 'fp3']:
+            time.sleep(0.01)
+            cache.store(fp, artifacts)
+        self.assertFalse(cache.has('fp1'))
+        self.assertTrue(cache.has('fp2'))
+        self.assertTrue(cache.has('fp3'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import datetime
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from ebaws import certindex
+
+
+__author__ = 'dusanklinec'
+
+
+class CountingIndex(certindex.CertIndex):
+    parsed = 0
+
+    def parse(self, data):
+        CountingIndex.parsed += 1
+        return certindex.CertIndex.parse(data)
+
+
+class CertIndexTest(unittest.TestCase):
+    """Certificate expiry index"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.key = rsa.generate_private_key(65537, 1024, default_backend())
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.root = os.path.join(self.tmpdir, 'live')
+        self.index_path = os.path.join(self.tmpdir, 'index.json')
+        CountingIndex.parsed = 0
+
+    def write_cert(self, domain, days, sans):
+        now = datetime.datetime.utcnow()
+        subject = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, domain.decode('utf-8'))])
+        crt = x509.CertificateBuilder().subject_name(subject).issuer_name(subject) \
+            .public_key(self.key.public_key()).serial_number(x509.random_serial_number()) \
+            .not_valid_before(now - datetime.timedelta(days=1)).not_valid_after(now + datetime.timedelta(days=days)) \
+            .add_extension(x509.SubjectAlternativeName([x509.DNSName(x.decode('utf-8')) for x in sans]), False) \
+            .sign(self.key, hashes.SHA256(), default_backend())
+
+        cert_dir = os.path.join(self.root, domain)
+        if not os.path.exists(cert_dir):
+            os.makedirs(cert_dir)
+        path = os.path.join(cert_dir, 'cert.pem')
+        tmp_path = path + '.new'
+        with open(tmp_path, 'w') as f:
+            f.write(crt.public_bytes(serialization.Encoding.PEM))
+        os.rename(tmp_path, path)
+        return path
+
+    def test_incremental(self):
+        path = self.write_cert('a.example.com', 90, ['a.example.com', 'b.example.com'])
+        self.write_cert('c.example.com', 5, ['c.example.com'])
+
+        index = CountingIndex(path=self.index_path, root=self.root).load()
+        self.assertTrue(index.update())
+        index.save()
+        self.assertEqual(CountingIndex.parsed, 2)
+        self.assertEqual(index.entries[path]['sans'], ['a.example.com', 'b.example.com'])
+
+        # Answered from the persisted index, nothing parsed
+        index = CountingIndex(path=self.index_path, root=self.root).load()
+        self.assertEqual(index.check_domain('a.example.com', renewal_before=86400 * 20), index.OK)
+        self.assertEqual(index.check_domain('c.example.com', renewal_before=86400 * 20), index.RENEW)
+        self.assertEqual(index.check_domain('a.example.com', domains=['a.example.com', 'x.example.com']),
+                         index.INVALID)
+        self.assertEqual(index.check_domain('missing.example.com'), index.MISSING)
+        self.assertFalse(index.update())
+        self.assertEqual(CountingIndex.parsed, 2)
+
+        # Renewed certificate (new inode) is re-parsed
+        self.write_cert('c.example.com', 90, ['c.example.com'])
+        self.assertEqual(index.check_domain('c.example.com', renewal_before=86400 * 20), index.OK)
+        self.assertEqual(CountingIndex.parsed, 3)
+        self.assertEqual(index.check_expiry(path, now=time.time() + 86400 * 100), index.EXPIRED)
+
+        shutil.rmtree(os.path.join(self.root, 'c.example.com'))
+        self.assertTrue(index.update())
+        self.assertEqual(list(index.entries.keys()), [path])
+
+    def test_invalid(self):
+        os.makedirs(os.path.join(self.root, 'x'))
+        for data, code in [('', certindex.CertIndex.EMPTY), ('garbage', certindex.CertIndex.INVALID)]:
+            with open(os.path.join(self.root, 'x', 'cert.pem'), 'w') as f:
+                f.write(data)
+            index = certindex.CertIndex(path=self.index_path, root=self.root)
+            self.assertEqual(index.check_domain('x'), code)
+
+
+if __name__ == '__main__':
+    unittest.main()
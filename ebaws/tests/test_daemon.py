@@ -0,0 +1,130 @@
+import random
+import time
+import unittest
+from ebaws import daemon
+
+
+__author__ = 'dusanklinec'
+
+DAY = 60 * 60 * 24
+
+
+class FakeHost(object):
+    """Certificate and IP state the daemon sees"""
+
+    def __init__(self, now):
+        self.now = now
+        self.not_after = now + 90 * DAY
+        self.ip = ('1.2.3.4', '10.0.0.1')
+        self.renew_calls = []
+        self.onboot_calls = []
+        self.renew_result = 0
+
+    def clock(self):
+        return self.now
+
+    def renew(self):
+        self.renew_calls.append(self.now)
+        if self.renew_result == 0:
+            self.not_after = self.now + 90 * DAY
+        return self.renew_result
+
+    def onboot(self):
+        self.onboot_calls.append(self.now)
+        return 0
+
+
+class DaemonTest(unittest.TestCase):
+    """Renewal daemon scheduling"""
+
+    def setUp(self):
+        self.host = FakeHost(1500000000)
+        self.schedule = daemon.RenewalSchedule(renewal_before=20 * DAY, jitter=6 * 3600, rand=random.Random(42))
+        self.daemon = daemon.RenewalDaemon(renew=self.host.renew, onboot=self.host.onboot,
+                                           get_not_after=lambda: self.host.not_after,
+                                           get_ip=lambda: self.host.ip, schedule=self.schedule,
+                                           ip_check_interval=300, clock=self.host.clock)
+        self.daemon.log = lambda msg: None
+
+    def advance(self, until):
+        """Runs the daemon loop with the fake clock, returns number of wake-ups"""
+        wakes = 0
+        while True:
+            wake = self.daemon.step(self.host.now)
+            if wake > until:
+                self.host.now = until
+                return wakes
+            self.host.now = max(self.host.now, wake)
+            wakes += 1
+
+    def test_schedule(self):
+        now = 1000000
+        for _ in range(50):
+            due = self.schedule.next_renewal(now + 90 * DAY, now)
+            self.assertGreaterEqual(due, now + 70 * DAY)
+            self.assertLessEqual(due, now + 70 * DAY + 6 * 3600)
+        self.assertEqual(self.schedule.next_renewal(None, now), now)
+        self.assertEqual(self.schedule.next_renewal(now + 5 * DAY, now), now)
+
+        retries = [self.schedule.next_retry(x, now) - now for x in range(1, 10)]
+        self.assertLessEqual(retries[0], 15 * 60 * 1.25)
+        self.assertLessEqual(max(retries), 12 * 3600 * 1.25)
+        self.assertGreater(retries[3], retries[0])
+
+    def test_renewal_cycle(self):
+        start = self.host.now
+        self.daemon.start(start)
+        self.advance(start + 60 * DAY)
+        self.assertEqual(self.host.onboot_calls, [start])
+        self.assertEqual(self.host.renew_calls, [])
+
+        self.advance(start + 71 * DAY)
+        self.assertEqual(len(self.host.renew_calls), 1)
+        self.assertGreaterEqual(self.host.renew_calls[0], start + 70 * DAY)
+        self.assertEqual(self.host.not_after, self.host.renew_calls[0] + 90 * DAY)
+
+        # Next renewal is scheduled from the new certificate
+        self.advance(start + 120 * DAY)
+        self.assertEqual(len(self.host.renew_calls), 1)
+
+    def test_renewal_failure_backoff(self):
+        self.host.not_after = self.host.now + 10 * DAY
+        self.host.renew_result = 1
+        start = self.host.now
+        self.daemon.start(start)
+        self.advance(start + DAY)
+        self.assertGreater(len(self.host.renew_calls), 3)
+        self.assertLess(len(self.host.renew_calls), 10)
+
+        self.host.renew_result = 0
+        self.advance(start + 2 * DAY)
+        calls = len(self.host.renew_calls)
+        self.advance(start + 30 * DAY)
+        self.assertEqual(len(self.host.renew_calls), calls)
+
+    def test_ip_change(self):
+        start = self.host.now
+        self.daemon.start(start)
+        self.advance(start + 3600)
+        self.assertEqual(len(self.host.onboot_calls), 1)
+
+        self.host.ip = ('5.6.7.8', '10.0.0.1')
+        self.advance(start + 2 * 3600)
+        self.assertEqual(len(self.host.onboot_calls), 2)
+        self.assertLessEqual(self.host.onboot_calls[1] - (start + 3600), 300)
+
+    def test_stop(self):
+        def onboot():
+            self.daemon.stop()
+            return self.host.onboot()
+
+        self.daemon.clock = time.time
+        self.host.not_after = time.time() + 90 * DAY
+        self.daemon.onboot = onboot
+        self.daemon.run()
+        self.assertEqual(len(self.host.onboot_calls), 1)
+        self.assertEqual(len(self.host.renew_calls), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
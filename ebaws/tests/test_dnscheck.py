@@ -0,0 +1,146 @@
+import socket
+import struct
+import threading
+import unittest
+from ebaws import dnscheck, errors
+from ebaws.dnscheck import DnsClient
+
+
+__author__ = 'dusanklinec'
+
+
+def encode_record(name, rtype, data):
+    if rtype == DnsClient.TYPE_A:
+        rdata = socket.inet_aton(data)
+    elif rtype in [DnsClient.TYPE_NS, DnsClient.TYPE_SOA]:
+        rdata = DnsClient.encode_name(data) + ('' if rtype == DnsClient.TYPE_NS else '\0' + '\0' * 20)
+    else:
+        rdata = ''.join(chr(len(x)) + x for x in [data[i:i + 255] for i in range(0, len(data), 255)])
+    return DnsClient.encode_name(name) + struct.pack('!HHIH', rtype, 1, 60, len(rdata)) + rdata
+
+
+class StubDnsServer(object):
+    """
+    Stub DNS server for the zone example.test, acts both as the resolver and the authoritative server.
+    records: (name, type) -> list of values
+    """
+
+    def __init__(self, address, port=0):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((address, port))
+        self.port = self.sock.getsockname()[1]
+        self.records = {}
+        self.queries = []
+        self.silent = False
+        self.running = True
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def serve(self):
+        while self.running:
+            try:
+                data, addr = self.sock.recvfrom(4096)
+            except socket.error:
+                return
+            qid, flags = struct.unpack('!HH', data[:4])
+            qname, offset = DnsClient.parse_name(data, 12)
+            qtype = struct.unpack('!H', data[offset:offset + 2])[0]
+            self.queries.append((qname, qtype, (flags & DnsClient.FLAG_RD) != 0))
+            if self.silent:
+                continue
+
+            answers = [encode_record(qname, qtype, x) for x in self.records.get((qname, qtype), [])]
+            authority, additional = [], []
+            if len(answers) == 0 and (qname == 'example.test' or qname.endswith('.example.test')):
+                authority.append(encode_record('example.test', DnsClient.TYPE_SOA, 'ns1.example.test'))
+            if qtype == DnsClient.TYPE_NS:
+                for ns in self.records.get((qname, qtype), []):
+                    additional += [encode_record(ns, DnsClient.TYPE_A, x)
+                                   for x in self.records.get((ns, DnsClient.TYPE_A), [])]
+
+            header = struct.pack('!HHHHHH', qid, DnsClient.FLAG_QR | DnsClient.FLAG_AA, 1, len(answers),
+                                 len(authority), len(additional))
+            self.sock.sendto(header + data[12:offset + 4] + ''.join(answers + authority + additional), addr)
+
+    def close(self):
+        self.running = False
+        self.sock.close()
+
+
+class DnsCheckTest(unittest.TestCase):
+    """Propagation checker against two stub nameservers"""
+
+    def setUp(self):
+        self.ns1 = StubDnsServer('127.0.0.1')
+        self.addCleanup(self.ns1.close)
+        try:
+            self.ns2 = StubDnsServer('127.0.0.2', self.ns1.port)
+        except socket.error:
+            self.skipTest('127.0.0.2 not available')
+        self.addCleanup(self.ns2.close)
+
+        for ns in [self.ns1, self.ns2]:
+            ns.records[('example.test', DnsClient.TYPE_NS)] = ['ns1.example.test', 'ns2.example.test']
+            ns.records[('ns1.example.test', DnsClient.TYPE_A)] = ['127.0.0.1']
+            ns.records[('ns2.example.test', DnsClient.TYPE_A)] = ['127.0.0.2']
+
+        self.now = [1000.0]
+        self.sleeps = []
+
+    def sleep(self, delay):
+        self.sleeps.append(delay)
+        self.now[0] += delay
+        # Second nameserver catches up after a while
+        if self.now[0] >= 1005.0:
+            self.ns2.records[('_acme-challenge.host.example.test', DnsClient.TYPE_TXT)] = ['tok1', 'tok2']
+
+    def get_checker(self, **kwargs):
+        client = DnsClient(timeout=0.2, retries=0, port=self.ns1.port)
+        return dnscheck.PropagationChecker(resolvers=['127.0.0.1'], client=client, clock=lambda: self.now[0],
+                                           sleep=self.sleep, **kwargs)
+
+    def test_find_zone(self):
+        checker = self.get_checker()
+        zone, addresses = checker.find_zone('_acme-challenge.host.example.test')
+        self.assertEqual(zone, 'example.test')
+        self.assertEqual(addresses, ['127.0.0.1', '127.0.0.2'])
+
+    def test_wait_all_nameservers(self):
+        self.ns1.records[('_acme-challenge.host.example.test', DnsClient.TYPE_TXT)] = ['tok1', 'tok2']
+        checker = self.get_checker(backoff=1.0)
+
+        res = checker.wait_for_txt([('_acme-challenge.host.example.test', 'tok1'),
+                                    ('_acme-challenge.host.example.test.', 'tok2')])
+        self.assertTrue(res)
+        self.assertEqual(self.sleeps, [1.0, 2.0, 4.0])
+
+        # Authoritative servers are queried without recursion, the first one only until it serves the record
+        txt_queries = [x for x in self.ns1.queries if x[1] == DnsClient.TYPE_TXT]
+        self.assertEqual(txt_queries, [('_acme-challenge.host.example.test', DnsClient.TYPE_TXT, False)])
+
+    def test_deadline(self):
+        checker = self.get_checker(backoff=1.0, deadline=3.0)
+        self.assertFalse(checker.wait_for_txt([('_acme-challenge.host.example.test', 'tok1')]))
+        self.assertEqual(self.now[0], 1003.0)
+
+    def test_query_timeout(self):
+        self.ns1.silent = True
+        client = DnsClient(timeout=0.1, retries=1, port=self.ns1.port)
+        with self.assertRaises(errors.RequestFailed):
+            client.query('127.0.0.1', 'example.test', DnsClient.TYPE_NS)
+        self.assertEqual(len(self.ns1.queries), 2)
+
+    def test_parse_compressed(self):
+        client = DnsClient()
+        question = DnsClient.encode_name('host.example.test') + struct.pack('!HH', DnsClient.TYPE_TXT, 1)
+        answer = '\xc0\x0c' + struct.pack('!HHIH', DnsClient.TYPE_TXT, 1, 60, 4) + '\x03abc'
+        resp = client.parse_response(struct.pack('!HHHHHH', 7, DnsClient.FLAG_QR, 1, 1, 0, 0) + question + answer)
+        self.assertEqual([(x.name, x.data) for x in resp.answers], [('host.example.test', 'abc')])
+
+        with self.assertRaises(errors.InvalidResponse):
+            client.parse_response(struct.pack('!HHHHHH', 7, DnsClient.FLAG_QR, 1, 1, 0, 0) + question + answer[:6])
+
+
+if __name__ == '__main__':
+    unittest.main()
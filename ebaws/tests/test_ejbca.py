@@ -0,0 +1,207 @@
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+from ebaws.ejbca import Ejbca
+
+
+__author__ = 'dusanklinec'
+
+
+class KeyGenEjbca(Ejbca):
+    """pkcs11HSM.sh replaced by a script asking for the pin, first attempt of failKey fails"""
+    SCRIPT = 'import os, sys, time\n' \
+             'sys.stdout.write("Password:"); sys.stdout.flush()\n' \
+             'pin = sys.stdin.readline().strip()\n' \
+             'alias, marker = sys.argv[4], os.path.join(sys.argv[6], sys.argv[4])\n' \
+             'time.sleep(0.3)\n' \
+             'if alias == "failKey" and not os.path.exists(marker):\n' \
+             '    open(marker, "w").close(); sys.exit(5)\n' \
+             'print("\\n%s %s %s" % (alias, sys.argv[3], pin))\n'
+
+    def __init__(self, tmpdir, *args, **kwargs):
+        super(KeyGenEjbca, self).__init__(*args, **kwargs)
+        self.tmpdir = tmpdir
+
+    def pkcs11_get_cwd(self):
+        return self.tmpdir
+
+    def get_jboss_run_as(self):
+        return None
+
+    def pkcs11_get_command(self, cmd):
+        return [sys.executable, '-c', self.SCRIPT] + cmd.split(' ') + [self.tmpdir]
+
+
+class StubSession(object):
+    """JVM session failing every command"""
+    def __init__(self):
+        self.calls = []
+
+    def execute(self, jar, cmd, stdin=''):
+        self.calls.append((os.path.basename(jar), cmd))
+        return 1, ['session failed\n'], []
+
+
+class SessionEjbca(Ejbca):
+    """Tools run in the stub session, scripts replaced by a command printing its arguments"""
+    def __init__(self, tmpdir, *args, **kwargs):
+        super(SessionEjbca, self).__init__(*args, **kwargs)
+        self.tmpdir = tmpdir
+        self.session = StubSession()
+        for jar in [self.EJBCA_CLI_JAR, self.CLIENT_TOOLBOX_JAR]:
+            os.makedirs(os.path.dirname(os.path.join(tmpdir, jar)))
+            open(os.path.join(tmpdir, jar), 'w').close()
+        os.makedirs(os.path.join(tmpdir, 'bin'))
+
+    def get_ejbca_home(self):
+        return self.tmpdir
+
+    def get_jvm_session(self):
+        return self.session
+
+    def get_jboss_run_as(self):
+        return None
+
+    def ejbca_get_command(self, cmd):
+        return [sys.executable, '-c', 'import sys; print("script " + " ".join(sys.argv[1:]))'] + cmd.split(' ')
+
+    def pkcs11_get_command(self, cmd):
+        return self.ejbca_get_command(cmd)
+
+
+class DeployEjbca(Ejbca):
+    """ant replaced by a script, the split service targets missing in old EJBCA trees, jboss-cli recorded"""
+    SCRIPT = 'import sys\n' \
+             'targets = sys.argv[2:]\n' \
+             'missing = [x for x in targets if x.startswith("jee:")] if sys.argv[1] == "old" else []\n' \
+             'if missing:\n' \
+             '    sys.stderr.write("BUILD FAILED\\nTarget \\"%s\\" does not exist in the project \\"ejbca\\".\\n"' \
+             ' % missing[0]); sys.exit(1)\n' \
+             'print("BUILD SUCCESSFUL")\n'
+
+    def __init__(self, tmpdir, tree, *args, **kwargs):
+        super(DeployEjbca, self).__init__(*args, **kwargs)
+        self.tmpdir = tmpdir
+        self.tree = tree
+        self.BUILD_CACHE_DIR = os.path.join(tmpdir, 'cache')
+        self.ant_calls = []
+        self.jboss_calls = []
+
+    def get_ejbca_home(self):
+        return self.tmpdir
+
+    def get_jboss_run_as(self):
+        return None
+
+    def ant_get_command(self, cmd):
+        self.ant_calls.append(cmd)
+        return [sys.executable, '-c', self.SCRIPT, self.tree] + cmd.split(' ')
+
+    def jboss_cmd(self, cmd, out_capture=None):
+        self.jboss_calls.append(cmd)
+        return 0, [], []
+
+    def jboss_has_datasource(self):
+        return True
+
+    def jboss_fix_privileges(self):
+        pass
+
+    def jboss_wait_after_deploy(self):
+        return True
+
+
+class EjbcaTest(unittest.TestCase):
+    """EJBCA helper"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def test_key_set_concurrent(self):
+        ejbca = KeyGenEjbca(self.tmpdir)
+        keys = ejbca.pkcs11_get_key_set(prefix='key', count=4, bit_size=1024) + [('failKey', 2048)]
+
+        time_start = time.time()
+        results = ejbca.pkcs11_generate_key_set(keys, retry_attempts=2, workers=5, backoff=0.1)
+        self.assertLess(time.time() - time_start, 1.5)
+
+        self.assertEqual(sorted(results.keys()), ['failKey', 'key0', 'key1', 'key2', 'key3'])
+        self.assertEqual(results['key2'][0], 0)
+        self.assertEqual(results['key2'][1][-1], 'key2 1024 0000\n')
+        self.assertEqual(results['failKey'][0], 0)
+
+    def test_key_set_retries_exhausted(self):
+        ejbca = KeyGenEjbca(self.tmpdir)
+        ret, out, err = ejbca.pkcs11_generate_default_key_set(keys=[('signKey', 2048), ('failKey', 2048)],
+                                                              retry_attempts=1, workers=2)
+        self.assertEqual(ret, 5)
+
+    def test_session_failure_fallback(self):
+        ejbca = SessionEjbca(self.tmpdir)
+        lines = []
+        ret, out, err = ejbca.ejbca_cmd('ca listcas', retry_attempts=3,
+                                        on_out=lambda line, feeder, p, *args, **kwargs: lines.append(line))
+        self.assertEqual(ret, 0)
+        self.assertEqual(out, ['script ca listcas\n'])
+        self.assertEqual(lines, ['session failed\n', 'script ca listcas\n'])
+        self.assertEqual(ejbca.session.calls, [('ejbca-ejb-cli.jar', ['ca', 'listcas'])])
+
+        ret, out, err = ejbca.pkcs11_cmd('generate lib.so 2048 key 0', retry_attempts=2, session_input='0000\n')
+        self.assertEqual(ret, 0)
+        self.assertEqual(out, ['script generate lib.so 2048 key 0\n'])
+        self.assertEqual(ejbca.session.calls[1:], [('clientToolBox.jar', ['PKCS11HSMKeyTool', 'generate', 'lib.so',
+                                                                          '2048', 'key', '0'])])
+
+    def test_deploy_cached(self):
+        os.makedirs(os.path.join(self.tmpdir, 'dist', 'clientToolBox'))
+        open(os.path.join(self.tmpdir, 'dist', 'ejbca.ear'), 'w').close()
+
+        ejbca = DeployEjbca(self.tmpdir, 'new')
+        self.assertFalse(ejbca.deploy_cached('abcd'))
+        ejbca.build_cache_store('abcd')
+
+        self.assertTrue(ejbca.deploy_cached('abcd'))
+        self.assertEqual(ejbca.ant_calls, [ejbca.ANT_DEPLOY_SERVICES])
+        self.assertEqual(ejbca.jboss_calls, ['deploy %s --force' % os.path.join(self.tmpdir, 'dist', 'ejbca.ear')])
+
+        # Split service targets not defined, full deploy target is used, no redeploy of the cached EAR
+        ejbca = DeployEjbca(self.tmpdir, 'old')
+        self.assertTrue(ejbca.deploy_cached('abcd'))
+        self.assertEqual(ejbca.ant_calls, [ejbca.ANT_DEPLOY_SERVICES, 'deploy'])
+        self.assertEqual(ejbca.jboss_calls, [])
+
+    def test_add_mgmt_user(self):
+        conf_dir = os.path.join(self.tmpdir, 'standalone', 'configuration')
+        os.makedirs(conf_dir)
+        users_file = os.path.join(conf_dir, 'mgmt-users.properties')
+        with open(users_file, 'w') as f:
+            f.write('#admin=abc\nadmin=def\nebaws-mgmt=old')
+        os.chmod(users_file, 0o600)
+
+        ejbca = Ejbca()
+        ejbca.get_jboss_home = lambda: self.tmpdir
+        self.assertEqual(ejbca.jboss_add_mgmt_user(password='secret'), 0)
+        self.assertEqual(ejbca.get_jboss_mgmt_password(), 'secret')
+
+        digest = hashlib.md5('ebaws-mgmt:ManagementRealm:secret').hexdigest()
+        with open(users_file, 'r') as f:
+            self.assertEqual(f.read(), '#admin=abc\nadmin=def\nebaws-mgmt=%s\n' % digest)
+        self.assertEqual(os.stat(users_file).st_mode & 0o777, 0o600)
+
+        # Configured password is reused
+        self.assertEqual(ejbca.jboss_add_mgmt_user(), 0)
+        self.assertEqual(ejbca.get_jboss_mgmt_password(), 'secret')
+
+        ejbca = Ejbca()
+        ejbca.get_jboss_home = lambda: os.path.join(self.tmpdir, 'missing')
+        self.assertNotEqual(ejbca.jboss_add_mgmt_user(), 0)
+        self.assertIsNone(ejbca.get_jboss_mgmt_password())
+
+
+if __name__ == '__main__':
+    unittest.main()
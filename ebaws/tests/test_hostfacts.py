@@ -0,0 +1,108 @@
+import os
+import shutil
+import tempfile
+import unittest
+from ebaws import hostfacts
+from ebaws.registration import InfoLoader
+
+
+__author__ = 'dusanklinec'
+
+
+class CountingLoader(InfoLoader):
+    """Metadata from a dict instead of the metadata service"""
+
+    def __init__(self, metadata, *args, **kwargs):
+        super(CountingLoader, self).__init__(*args, **kwargs)
+        self.metadata = metadata
+        self.fetches = []
+
+    def fetch(self, keys, required=True):
+        self.fetches.append(sorted(keys))
+        return dict((k, self.metadata.get(k)) for k in keys)
+
+
+class HostFactsTest(unittest.TestCase):
+    """Host facts cache"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'cache', 'facts.json')
+        self.boot_id_file = os.path.join(self.tmpdir, 'boot_id')
+        self.now = 1000.0
+        self.set_boot_id('boot-1')
+
+    def set_boot_id(self, boot_id):
+        with open(self.boot_id_file, 'w') as f:
+            f.write(boot_id + '\n')
+
+    def get_facts(self):
+        return hostfacts.HostFacts(path=self.path, boot_id_file=self.boot_id_file, clock=lambda: self.now)
+
+    def test_boot_and_ttl(self):
+        calls = []
+
+        def loader(val):
+            calls.append(val)
+            return val
+
+        facts = self.get_facts()
+        self.assertEqual(facts.get('os_info', lambda: loader(['amzn', '2016.09'])), ['amzn', '2016.09'])
+        self.assertEqual(facts.get('mem_swap', lambda: loader(1024)), 1024)
+        self.assertEqual(len(calls), 2)
+
+        # Another invocation, same boot
+        facts = self.get_facts()
+        self.now += 60 * 60 * 2
+        self.assertEqual(facts.get('os_info', lambda: loader(['x', 'y'])), ['amzn', '2016.09'])
+        self.assertEqual(facts.get('mem_swap', lambda: loader(2048)), 2048)
+        self.assertEqual(len(calls), 3)
+
+        facts.invalidate('mem_swap')
+        self.assertEqual(self.get_facts().get('mem_swap', lambda: loader(4096)), 4096)
+
+        # Reboot drops everything
+        self.set_boot_id('boot-2')
+        self.assertEqual(self.get_facts().get('os_info', lambda: loader(['amzn', '2017.03'])), ['amzn', '2017.03'])
+
+        # Unknown boot - not persisted
+        os.remove(self.boot_id_file)
+        facts = self.get_facts()
+        self.assertEqual(facts.get('os_info', lambda: loader(['a', 'b'])), ['a', 'b'])
+        self.set_boot_id('boot-2')
+        self.assertEqual(self.get_facts().get('os_info', lambda: loader(['c', 'd'])), ['amzn', '2017.03'])
+
+    def test_info_loader(self):
+        metadata = {'instance-id': 'i-1234', 'ami-id': 'ami-1', 'local-ipv4': '10.0.0.1', 'public-ipv4': '1.2.3.4'}
+        info = CountingLoader(metadata, facts=self.get_facts())
+        self.assertEqual(info.ami_instance_id, 'i-1234')
+        self.assertEqual(len(info.fetches), 1)
+        self.assertEqual(info.ami_public_ip, '1.2.3.4')
+        self.assertEqual(info.ami_local_ip, '10.0.0.1')
+        self.assertIsNone(info.ami_public_hostname)
+        self.assertEqual(len(info.fetches), 2)
+        self.assertEqual(info.ami_results['ami-id'], 'ami-1')
+
+        # Next invocation answers from the cache
+        info = CountingLoader(metadata, facts=self.get_facts())
+        self.assertEqual(info.ami_public_ip, '1.2.3.4')
+        self.assertEqual(info.ami_instance_id, 'i-1234')
+        self.assertEqual(info.fetches, [])
+
+        # IP changed, DNS update asks for the fresh value
+        metadata['public-ipv4'] = '5.6.7.8'
+        info.invalidate_ip()
+        self.assertEqual(info.ami_public_ip, '5.6.7.8')
+        self.assertEqual(info.ami_instance_id, 'i-1234')
+        self.assertEqual(len(info.fetches), 1)
+
+        # IP TTL expired
+        metadata['public-ipv4'] = '9.9.9.9'
+        self.now += hostfacts.HostFacts.FIELD_TTL['ami_ip'] + 1
+        info = CountingLoader(metadata, facts=self.get_facts())
+        self.assertEqual(info.ami_public_ip, '9.9.9.9')
+
+
+if __name__ == '__main__':
+    unittest.main()
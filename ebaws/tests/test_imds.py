@@ -0,0 +1,125 @@
+import BaseHTTPServer
+import threading
+import time
+import unittest
+from ebaws import imds, errors
+
+
+__author__ = 'dusanklinec'
+
+
+METADATA = {
+    'ami-id': 'ami-12345678',
+    'instance-id': 'i-0123456789abcdef0',
+    'instance-type': 't2.medium',
+    'placement/availability-zone': 'eu-west-1a',
+    'local-ipv4': '10.0.0.12',
+    'public-hostname': 'ec2-52-1-2-3.eu-west-1.compute.amazonaws.com',
+}
+
+
+class MetadataHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Stand-in for the instance metadata service"""
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+        self.served = 0
+
+    def log_message(self, *args):
+        pass
+
+    def respond(self, code, body=''):
+        self.served += 1
+        close = self.server.max_requests is not None and self.served >= self.server.max_requests
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(body)))
+        if close:
+            self.send_header('Connection', 'close')
+            self.close_connection = 1
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_PUT(self):
+        if not self.server.v2:
+            return self.respond(405)
+        ttl = self.headers.get(imds.InstanceMetadata.TOKEN_TTL_HEADER)
+        return self.respond(200, 'token-%s' % ttl) if ttl else self.respond(400)
+
+    def do_GET(self):
+        self.server.paths.append(self.path)
+        if self.server.v2 and self.headers.get(imds.InstanceMetadata.TOKEN_HEADER) != 'token-300':
+            return self.respond(401)
+
+        key = self.path[len(imds.InstanceMetadata.META_PATH):]
+        if key in self.server.slow:
+            time.sleep(self.server.slow[key])
+        if key not in METADATA:
+            return self.respond(404, 'Not Found')
+        return self.respond(200, METADATA[key])
+
+
+class ImdsTest(unittest.TestCase):
+    """Instance metadata client against a local server"""
+
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), MetadataHandler)
+        self.server.v2 = True
+        self.server.connections = 0
+        self.server.max_requests = None
+        self.server.slow = {}
+        self.server.paths = []
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs={'poll_interval': 0.05})
+        self.thread.daemon = True
+        self.thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def get_client(self, **kwargs):
+        return imds.InstanceMetadata(host='127.0.0.1', port=self.server.server_address[1], **kwargs)
+
+    def fetch(self, **kwargs):
+        keys = ['ami-id', 'instance-id', 'instance-type', 'placement', 'public-ipv4', 'local-ipv4',
+                'public-hostname']
+        return self.get_client(**kwargs).fetch(keys)
+
+    def test_v2_single_connection(self):
+        res = self.fetch()
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(res['instance-id'], 'i-0123456789abcdef0')
+        self.assertEqual(res['placement'], 'eu-west-1a')
+        self.assertIsNone(res['public-ipv4'])
+        self.assertEqual(len(self.server.paths), 7)
+
+    def test_v1(self):
+        self.server.v2 = False
+        res = self.fetch()
+        self.assertEqual(res['ami-id'], 'ami-12345678')
+        self.assertEqual(res['public-hostname'], METADATA['public-hostname'])
+
+    def test_reconnect(self):
+        self.server.max_requests = 3
+        res = self.fetch()
+        self.assertEqual(res['local-ipv4'], '10.0.0.12')
+        self.assertEqual(res['instance-type'], 't2.medium')
+        self.assertEqual(len(self.server.paths), 7)
+        self.assertGreater(self.server.connections, 2)
+
+    def test_key_timeout(self):
+        self.server.slow = {'instance-type': 1.0}
+        res = self.fetch(key_timeout=0.2)
+        self.assertIsNone(res['instance-type'])
+        self.assertEqual(res['ami-id'], 'ami-12345678')
+        self.assertEqual(res['public-hostname'], METADATA['public-hostname'])
+
+    def test_unavailable(self):
+        port = self.server.server_address[1]
+        self.server.shutdown()
+        self.server.server_close()
+        client = imds.InstanceMetadata(host='127.0.0.1', port=port, timeout=0.5)
+        self.assertRaises(errors.RequestFailed, client.fetch, ['instance-id'])
+
+
+if __name__ == '__main__':
+    unittest.main()
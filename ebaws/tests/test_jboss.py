@@ -0,0 +1,118 @@
+import json
+import threading
+import unittest
+import BaseHTTPServer
+from ebaws import jboss
+from ebaws import errors
+
+
+__author__ = 'dusanklinec'
+
+
+class JBossCliScriptTest(unittest.TestCase):
+    """Batched jboss-cli script"""
+
+    def test_build_parse(self):
+        script = jboss.JBossCliScript(['undeploy ejbca.ear', '/interface=http:remove', '/interface=x:remove'])
+        text = script.build()
+        self.assertIn('try\n    undeploy ejbca.ear\ncatch\n    echo ##EBAWS-OP-FAILED 0\nend-try\n', text)
+        self.assertEqual(text.count('end-try'), 3)
+
+        out = ['##EBAWS-OP-START 0\n',
+               '##EBAWS-OP-END 0\n',
+               '##EBAWS-OP-START 1\n',
+               '{"outcome" => "failed", "failure-description" => "JBAS014807: Management resource not found"}\n',
+               '##EBAWS-OP-FAILED 1\n',
+               '##EBAWS-OP-END 1\n',
+               '##EBAWS-OP-START 2\n']
+        script.parse(out)
+
+        self.assertTrue(script.is_parsed())
+        self.assertTrue(script.ops[0].success)
+        self.assertTrue(script.ops[1].executed)
+        self.assertTrue(script.ops[1].failed)
+        self.assertIn('outcome', script.ops[1].out[0])
+        self.assertFalse(script.ops[2].executed)
+        self.assertEqual([x.idx for x in script.failed_ops()], [1, 2])
+
+    def test_not_parsed(self):
+        script = jboss.JBossCliScript(['/interface=http:remove'])
+        script.parse(['Unexpected command try\n'])
+        self.assertFalse(script.is_parsed())
+
+
+class ManagementHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Stand-in for the JBoss HTTP management endpoint"""
+    protocol_version = 'HTTP/1.1'
+    state = {'server-state': 'running'}
+    deployments = {'ejbca.ear': 'OK'}
+    requests = []
+
+    def do_POST(self):
+        req = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        ManagementHandler.requests.append((self.path, req))
+
+        if self.headers.get('Authorization') == 'deny':
+            return self.respond(401, 'denied')
+
+        address = dict(x.items()[0] for x in req['address'])
+        if req['operation'] == 'read-attribute' and 'deployment' in address:
+            status = self.deployments.get(address['deployment'])
+            if status is None:
+                return self.respond(500, {'outcome': 'failed', 'failure-description': 'not found'})
+            return self.respond(200, {'outcome': 'success', 'result': status})
+        if req['operation'] == 'read-attribute':
+            return self.respond(200, {'outcome': 'success', 'result': self.state[req['name']]})
+        if req['operation'] == 'reload':
+            return self.respond(200, {'outcome': 'success'})
+        return self.respond(500, {'outcome': 'failed'})
+
+    def respond(self, code, body):
+        data = json.dumps(body) if isinstance(body, dict) else body
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class JBossManagementClientTest(unittest.TestCase):
+    """HTTP management API client against a local stand-in server"""
+
+    def setUp(self):
+        ManagementHandler.requests = []
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), ManagementHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.client = jboss.JBossManagementClient(url='http://127.0.0.1:%d/management' % self.server.server_port)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_status(self):
+        self.assertTrue(self.client.is_running())
+        self.assertTrue(self.client.is_deployed('ejbca.ear'))
+        self.assertFalse(self.client.is_deployed('other.ear'))
+        self.assertTrue(self.client.reload())
+
+        path, req = ManagementHandler.requests[1]
+        self.assertEqual(path, '/management')
+        self.assertEqual(req, {'operation': 'read-attribute', 'name': 'status',
+                               'address': [{'deployment': 'ejbca.ear'}]})
+
+    def test_errors(self):
+        self.client.get_session().headers['Authorization'] = 'deny'
+        self.assertRaises(errors.AccessDenied, self.client.is_running)
+
+        client = jboss.JBossManagementClient(url='http://127.0.0.1:1/management', timeout=1)
+        self.assertRaises(errors.RequestFailed, client.is_running)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+from ebaws import util
+from ebaws import jvmsession
+
+
+__author__ = 'dusanklinec'
+
+
+TOOL_SOURCE = """
+import java.io.*;
+
+public class Tool {
+    // Stream kept by the first command, like log4j ConsoleAppender
+    static PrintStream log = null;
+
+    public static void main(String[] args) throws Exception {
+        if (log == null) log = System.out;
+        String pin = new BufferedReader(new InputStreamReader(System.in)).readLine();
+        System.out.println("args=" + args.length + " " + args[0] + " pin=" + pin);
+        System.err.println("err");
+        log.println("log " + args[0]);
+        if (args.length > 1) System.exit(Integer.parseInt(args[1]));
+    }
+}
+"""
+
+
+class JvmSessionTest(unittest.TestCase):
+    """Commands executed in one long-lived JVM"""
+
+    def setUp(self):
+        if not util.exe_exists('java') or not util.exe_exists('javac'):
+            self.skipTest('Requires JDK')
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+        src = os.path.join(self.tmpdir, 'Tool.java')
+        with open(src, 'w') as f:
+            f.write(TOOL_SOURCE)
+        ret, out, err = util.cli_cmd_sync(['javac', '-d', self.tmpdir, src])
+        self.assertEqual(ret, 0)
+
+        self.jar = os.path.join(self.tmpdir, 'tool.jar')
+        with zipfile.ZipFile(self.jar, 'w') as jar:
+            jar.writestr('META-INF/MANIFEST.MF', 'Manifest-Version: 1.0\nMain-Class: Tool\n\n')
+            jar.write(os.path.join(self.tmpdir, 'Tool.class'), 'Tool.class')
+
+    def test_commands(self):
+        with jvmsession.JvmSession(work_dir=os.path.join(self.tmpdir, 'session')) as session:
+            self.assertEqual(session.execute(self.jar, ['a b'], stdin='0000\n'),
+                             (0, ['args=1 a b pin=0000\n', 'log a b\n'], ['err\n']))
+
+            # Output through the stream kept from the first command goes to the second one
+            ret, out, err = session.execute(self.jar, ['x', '3'])
+            self.assertEqual(ret, 3)
+            self.assertEqual(out, ['args=2 x pin=null\n', 'log x\n'])
+
+            # Exit is trapped, the same JVM serves the next command
+            pid = session.process.pid
+            self.assertEqual(session.execute(self.jar, ['y'])[0], 0)
+            self.assertEqual(session.process.pid, pid)
+
+            ret, out, err = session.execute(os.path.join(self.tmpdir, 'missing.jar'), [])
+            self.assertEqual(ret, 1)
+        self.assertFalse(session.is_running())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+import hashlib
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import datetime
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.serialization import pkcs12
+from ebaws import util
+from ebaws import keystore
+from ebaws.letsencrypt import LetsEncryptToJks
+
+
+__author__ = 'dusanklinec'
+
+
+class KeyStoreTest(unittest.TestCase):
+    """In-process keystore writer"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+        self.pems = []
+        for name in ['ca', 'leaf']:
+            key = rsa.generate_private_key(65537, 1024, util.get_backend())
+            subject = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, u'%s.example.com' % name)])
+            now = datetime.datetime.utcnow()
+            crt = x509.CertificateBuilder().subject_name(subject).issuer_name(subject)\
+                .public_key(key.public_key()).serial_number(x509.random_serial_number())\
+                .not_valid_before(now).not_valid_after(now + datetime.timedelta(days=1))\
+                .sign(key, hashes.SHA256(), util.get_backend())
+            self.pems.append((key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                                serialization.NoEncryption()),
+                              crt.public_bytes(serialization.Encoding.PEM)))
+
+        files = {'privkey.pem': self.pems[1][0], 'cert.pem': self.pems[1][1],
+                 'fullchain.pem': self.pems[1][1] + self.pems[0][1]}
+        for name, data in files.items():
+            with open(os.path.join(self.tmpdir, name), 'w') as f:
+                f.write(data)
+
+    def der_value(self, data):
+        length = ord(data[1])
+        if length < 0x80:
+            return data[2:2 + length]
+        size = length & 0x7f
+        length = int(data[2:2 + size].encode('hex'), 16)
+        return data[2 + size:2 + size + length]
+
+    def parse_jks(self, data, password):
+        passwd = password.encode('utf-16be')
+        body, digest = data[:-20], data[-20:]
+        self.assertEqual(hashlib.sha1(passwd + 'Mighty Aphrodite' + body).digest(), digest)
+
+        magic, version, count = struct.unpack('>III', body[:12])
+        self.assertEqual((magic, version, count), (0xfeedfeed, 2, 1))
+        pos = 12
+        tag, alias_len = struct.unpack('>IH', body[pos:pos + 6])
+        alias = body[pos + 6:pos + 6 + alias_len]
+        pos += 6 + alias_len + 8
+
+        key_len = struct.unpack('>I', body[pos:pos + 4])[0]
+        protected = body[pos + 4:pos + 4 + key_len]
+        pos += 4 + key_len
+
+        # EncryptedPrivateKeyInfo: SEQUENCE { algorithm SEQUENCE, OCTET STRING }
+        info = self.der_value(protected)
+        algorithm = self.der_value(info)
+        self.assertTrue(algorithm.startswith(keystore.der_oid(keystore.JKS_KEY_PROTECTOR_OID)))
+        octets = self.der_value(info[2 + len(algorithm):])
+        salt, encrypted, check = octets[:20], octets[20:-20], octets[-20:]
+        stream, digest = '', salt
+        while len(stream) < len(encrypted):
+            digest = hashlib.sha1(passwd + digest).digest()
+            stream += digest
+        pkcs8 = ''.join(chr(ord(x) ^ ord(y)) for x, y in zip(encrypted, stream))
+        self.assertEqual(hashlib.sha1(passwd + pkcs8).digest(), check)
+
+        chain_len = struct.unpack('>I', body[pos:pos + 4])[0]
+        return tag, alias, pkcs8, chain_len
+
+    def test_jks(self):
+        path = os.path.join(self.tmpdir, 'keystore.jks')
+        conv = LetsEncryptToJks(cert_dir=self.tmpdir, jks_path=path, jks_alias='PKI.example.com', password='secret')
+        self.assertEqual(conv.convert(), 0)
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+
+        with open(path, 'rb') as f:
+            tag, alias, pkcs8, chain_len = self.parse_jks(f.read(), 'secret')
+        self.assertEqual((tag, alias, chain_len), (1, 'pki.example.com', 2))
+
+        key = util.load_pem_private_key(self.pems[1][0])
+        self.assertEqual(pkcs8, key.private_bytes(serialization.Encoding.DER, serialization.PrivateFormat.PKCS8,
+                                                  serialization.NoEncryption()))
+
+        if util.exe_exists('keytool'):
+            ret, out, err = util.cli_cmd_sync(['keytool', '-list', '-keystore', path, '-storepass', 'secret'])
+            self.assertEqual(ret, 0)
+
+    def test_pkcs12(self):
+        path = os.path.join(self.tmpdir, 'keystore.p12')
+        conv = LetsEncryptToJks(cert_dir=self.tmpdir, jks_path=path, jks_alias='pki', password='secret',
+                                keystore_type='PKCS12')
+        self.assertEqual(conv.convert(), 0)
+
+        with open(path, 'rb') as f:
+            key, cert, cas = pkcs12.load_key_and_certificates(f.read(), 'secret', util.get_backend())
+        self.assertEqual(cert.public_bytes(serialization.Encoding.PEM), self.pems[1][1])
+        self.assertEqual(len(cas), 1)
+
+    def test_missing_files(self):
+        os.remove(os.path.join(self.tmpdir, 'fullchain.pem'))
+        conv = LetsEncryptToJks(cert_dir=self.tmpdir, jks_path=os.path.join(self.tmpdir, 'x.jks'))
+        self.assertEqual(conv.convert(), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
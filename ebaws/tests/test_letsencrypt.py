@@ -0,0 +1,96 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from ebaws.letsencrypt import LetsEncryptManualDns
+
+
+__author__ = 'dusanklinec'
+
+
+# Stand-in for certbot with the external auth plugin in the JSON mode: one challenge per domain,
+# each waits for the answer. Validation fails unless the TXT records were published (marker file).
+CERTBOT = 'import json, os, sys\n' \
+          'marker = sys.argv[1]\n' \
+          'for domain in sys.argv[2:]:\n' \
+          '    print(json.dumps({"cmd": "perform_challenge", "type": "dns-01", "domain": domain,\n' \
+          '                      "validation": "tok-" + domain, "txt_domain": "_acme-challenge." + domain}))\n' \
+          '    sys.stdout.flush()\n' \
+          '    sys.stdin.readline()\n' \
+          'sys.exit(0 if os.path.exists(marker) else 1)\n'
+
+
+class ManualDnsTest(unittest.TestCase):
+    """Batched DNS-01 challenges against a certbot stand-in"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.script = os.path.join(self.tmpdir, 'certbot.py')
+        with open(self.script, 'w') as f:
+            f.write(CERTBOT)
+        self.marker = os.path.join(self.tmpdir, 'published')
+        self.batches = []
+        self.singles = []
+
+    def publish(self):
+        open(self.marker, 'w').close()
+
+    def on_challenges(self, challenges=None, done=None, *args, **kwargs):
+        self.batches.append(challenges)
+        self.publish()
+        done()
+
+    def on_challenge(self, domain=None, token=None, done=None, *args, **kwargs):
+        self.singles.append((domain, token))
+        self.publish()
+        done()
+
+    def get_mdns(self, domains, challenged=None):
+        challenged = challenged if challenged is not None else domains
+        cmd_exec = '%s %s %s %s' % (sys.executable, self.script, self.marker, ' '.join(challenged))
+        return LetsEncryptManualDns(domains=domains, on_domain_challenge=self.on_challenge,
+                                    on_domain_challenges=self.on_challenges, cmd_exec=cmd_exec,
+                                    log_obj=os.path.join(self.tmpdir, 'certbot.log'))
+
+    def test_batch(self):
+        domains = ['a.example.com', 'b.example.com', 'c.example.com']
+        ret, out, err = self.get_mdns(domains).start()
+
+        self.assertEqual(ret, 0)
+        self.assertEqual(self.singles, [])
+        self.assertEqual(self.batches, [[('_acme-challenge.%s' % x, 'tok-%s' % x) for x in domains]])
+
+    def test_batch_valid_authorization(self):
+        domains = ['a.example.com', 'b.example.com', 'c.example.com']
+        ret, out, err = self.get_mdns(domains, challenged=['a.example.com', 'c.example.com']).start()
+
+        self.assertEqual(ret, 0)
+        self.assertEqual(len(self.batches), 1)
+        self.assertEqual([x[0] for x in self.batches[0]], ['_acme-challenge.a.example.com',
+                                                           '_acme-challenge.c.example.com'])
+
+    def test_batch_order(self):
+        # Last domain challenged first, the batch is published only once all challenges are collected
+        domains = ['a.example.com', 'b.example.com', 'c.example.com']
+        ret, out, err = self.get_mdns(domains, challenged=['c.example.com', 'a.example.com', 'b.example.com']).start()
+
+        self.assertEqual(ret, 0)
+        self.assertEqual(len(self.batches), 1)
+        self.assertEqual([x[0] for x in self.batches[0]], ['_acme-challenge.c.example.com',
+                                                           '_acme-challenge.a.example.com',
+                                                           '_acme-challenge.b.example.com'])
+
+    def test_batch_not_closed(self):
+        # Last domain has a valid authorization, retried with the batch of the challenged domains
+        domains = ['a.example.com', 'b.example.com', 'c.example.com']
+        ret, out, err = self.get_mdns(domains, challenged=['a.example.com', 'b.example.com']).start()
+
+        self.assertEqual(ret, 0)
+        self.assertEqual(self.singles, [])
+        self.assertEqual(self.batches, [[('_acme-challenge.a.example.com', 'tok-a.example.com'),
+                                         ('_acme-challenge.b.example.com', 'tok-b.example.com')]])
+
+if __name__ == '__main__':
+    unittest.main()
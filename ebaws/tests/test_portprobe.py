@@ -0,0 +1,91 @@
+import socket
+import time
+import unittest
+from ebaws import portprobe, util
+
+
+__author__ = 'dusanklinec'
+
+
+class PortProbeTest(unittest.TestCase):
+    """Concurrent port prober against local sockets"""
+
+    def listen(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(16)
+        self.addCleanup(sock.close)
+        return sock.getsockname()
+
+    def closed_port(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('127.0.0.1', 0))
+        address = sock.getsockname()
+        sock.close()
+        return address
+
+    def echo_server(self):
+        server = util.DummyTCPServer(('127.0.0.1', 0))
+        server.start()
+        server.wait_ready()
+        self.addCleanup(server.close)
+        return server.server.server_address
+
+    def test_open_and_closed(self):
+        open_target, closed_target = self.listen(), self.closed_port()
+        results = portprobe.probe_ports([open_target, closed_target], timeout=2, attempts=3, stagger=0.05)
+
+        self.assertTrue(results[open_target].ok)
+        self.assertEqual(results[open_target].attempts, 1)
+        self.assertFalse(results[closed_target].ok)
+        self.assertEqual(results[closed_target].attempts, 3)
+
+    def test_echo_check(self):
+        echo_target, silent_target = self.echo_server(), self.listen()
+        time_start = time.time()
+        results = portprobe.probe_ports([echo_target, silent_target], timeout=0.5, attempts=3, stagger=0.1,
+                                        echo_check=True)
+
+        # Attempts to the silent peer overlap: ~0.2 s of staggering + one timeout, not 3 timeouts
+        self.assertLess(time.time() - time_start, 1.2)
+        self.assertTrue(results[echo_target].ok)
+        self.assertFalse(results[silent_target].ok)
+        self.assertEqual(results[silent_target].attempts, 3)
+        self.assertEqual(results[silent_target].error, 'timeout')
+
+    def test_done_early(self):
+        open_target, silent_target = self.listen(), self.listen()
+        time_start = time.time()
+        results = portprobe.probe_ports([silent_target, open_target], timeout=5, echo_check=False,
+                                        done=lambda r: r[open_target].ok is not None)
+        self.assertLess(time.time() - time_start, 1.0)
+        self.assertTrue(results[open_target].ok)
+
+        results = portprobe.PortProber(timeout=5, echo_check=True).probe(
+            [silent_target, self.echo_server()], done=portprobe.PortProber.any_open)
+        self.assertLess(time.time() - time_start, 2.0)
+        self.assertIsNone(results[silent_target].ok)
+
+    def test_ipv6(self):
+        try:
+            sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+            sock.bind(('::1', 0))
+        except socket.error:
+            self.skipTest('IPv6 loopback not available')
+        sock.listen(16)
+        self.addCleanup(sock.close)
+
+        open_target = ('::1', sock.getsockname()[1])
+        results = portprobe.probe_ports([open_target], timeout=2, attempts=1)
+        self.assertTrue(results[open_target].ok)
+
+    def test_util_port_open(self):
+        echo_target, closed_target = self.echo_server(), self.closed_port()
+        self.assertTrue(util.test_port_open(host=echo_target[0], port=echo_target[1], timeout=2))
+        self.assertFalse(util.test_port_open(host=closed_target[0], port=closed_target[1], timeout=2,
+                                             stagger=0.05))
+        self.assertFalse(util.test_port_open(host=None, port=closed_target[1]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+import datetime
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from ebaws import certindex, precheck
+
+
+__author__ = 'dusanklinec'
+
+
+class PrecheckTest(unittest.TestCase):
+    """Renew / onboot precheck without the full application"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.key = rsa.generate_private_key(65537, 1024, default_backend())
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.root = os.path.join(self.tmpdir, 'live')
+        self.config_path = os.path.join(self.tmpdir, 'config.json')
+        self.index_path = os.path.join(self.tmpdir, 'index.json')
+
+    def get_index(self):
+        return certindex.CertIndex(path=self.index_path, root=self.root).load()
+
+    def write_config(self, hostname='pki.example.com', domains=None):
+        with open(self.config_path, 'w') as f:
+            f.write('// \n// Config file generated: 2016-11-01 10:00\n// \n')
+            f.write(json.dumps({'config': {'ejbca_hostname': hostname, 'ejbca_domains': [hostname],
+                                           'domains': domains if domains is not None else [hostname]}}))
+
+    def write_cert(self, domain, days):
+        now = datetime.datetime.utcnow()
+        subject = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, domain.decode('utf-8'))])
+        crt = x509.CertificateBuilder().subject_name(subject).issuer_name(subject) \
+            .public_key(self.key.public_key()).serial_number(x509.random_serial_number()) \
+            .not_valid_before(now - datetime.timedelta(days=1)).not_valid_after(now + datetime.timedelta(days=days)) \
+            .add_extension(x509.SubjectAlternativeName([x509.DNSName(domain.decode('utf-8'))]), False) \
+            .sign(self.key, hashes.SHA256(), default_backend())
+
+        cert_dir = os.path.join(self.root, domain)
+        if not os.path.exists(cert_dir):
+            os.makedirs(cert_dir)
+        pem = crt.public_bytes(serialization.Encoding.PEM)
+        for fname in ['cert.pem', 'fullchain.pem', 'privkey.pem']:
+            with open(os.path.join(cert_dir, fname), 'w') as f:
+                f.write(pem)
+
+    def run_precheck(self, argv):
+        return precheck.run(argv, config_path=self.config_path, index=self.get_index())
+
+    def test_renew(self):
+        self.write_config()
+        self.assertEqual(self.run_precheck(['-n', 'renew']), precheck.PRECHECK_CONTINUE)
+
+        self.write_cert('pki.example.com', 90)
+        self.assertEqual(self.run_precheck(['-n', '--pid-lock', '3', 'renew']), 0)
+        self.assertEqual(self.run_precheck(['-n', '--force', 'renew']), precheck.PRECHECK_CONTINUE)
+        self.assertEqual(self.run_precheck(['-n', '--vpc', '1', 'renew']), precheck.PRECHECK_CONTINUE)
+        self.assertEqual(self.run_precheck(['renew']), precheck.PRECHECK_CONTINUE)
+        self.assertEqual(self.run_precheck(['-n', 'init']), precheck.PRECHECK_CONTINUE)
+
+        self.write_cert('pki.example.com', 5)
+        self.assertEqual(self.run_precheck(['-n', 'renew']), precheck.PRECHECK_CONTINUE)
+
+        self.write_config(domains=[])
+        self.assertEqual(self.run_precheck(['-n', 'renew']), precheck.PRECHECK_CONTINUE)
+
+    def test_onboot(self):
+        self.assertEqual(self.run_precheck(['-n', 'onboot']), 2)
+        self.write_config()
+        self.assertEqual(self.run_precheck(['-n', 'onboot']), precheck.PRECHECK_CONTINUE)
+
+    def test_light_imports(self):
+        code = 'import sys; import ebaws.launcher; ' \
+               'print(",".join(x for x in ["cmd2", "blessed", "requests", "ebclient", "OpenSSL", "cryptography"] ' \
+               'if x in sys.modules))'
+        out = subprocess.check_output([sys.executable, '-c', code],
+                                      cwd=os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+        self.assertEqual(out.strip(), '')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,188 @@
+import os
+import subprocess
+import sys
+import time
+import unittest
+from ebaws import util
+from ebaws import process
+
+
+__author__ = 'dusanklinec'
+
+
+class ProcessTest(unittest.TestCase):
+    """Subprocess engine behind util.cli_cmd_sync"""
+
+    def test_both_pipes_bulk(self):
+        # Fills stderr pipe before anything goes to stdout - blocking readers would stall here
+        script = 'import sys\n' \
+                 'sys.stderr.write("e" * 200000 + "\\n")\n' \
+                 'sys.stdout.write("line1\\nline2\\npartial")\n'
+        ret, out, err = util.cli_cmd_sync([sys.executable, '-c', script])
+        self.assertEqual(ret, 0)
+        self.assertEqual(out, ['line1\n', 'line2\n', 'partial'])
+        self.assertEqual(len(''.join(err)), 200001)
+
+    def test_feeder_answer(self):
+        script = 'import sys\n' \
+                 'sys.stdout.write("Please enter value:\\n"); sys.stdout.flush()\n' \
+                 'val = sys.stdin.readline().strip()\n' \
+                 'sys.stdout.write("got %s\\n" % val)\n' \
+                 'sys.exit(3)\n'
+
+        def answer(out, feeder, p, *args, **kwargs):
+            if out.startswith('Please enter'):
+                feeder.feed('secret\n')
+
+        ret, out, err = util.cli_cmd_sync([sys.executable, '-c', script], on_out=answer)
+        self.assertEqual(ret, 3)
+        self.assertEqual(out[-1], 'got secret\n')
+
+    def test_string_command(self):
+        ret, out, err = util.cli_cmd_sync('%s -c "print(\'a b\')"' % sys.executable)
+        self.assertEqual(ret, 0)
+        self.assertEqual(out, ['a b\n'])
+
+    def test_loop_concurrent(self):
+        loop = process.CmdLoop()
+        sleeper = [sys.executable, '-c', 'import time; time.sleep(0.5); print("done")']
+        jobs = [util.cli_cmd_async(sleeper, loop=loop) for _ in range(4)]
+
+        time_start = time.time()
+        loop.run()
+        self.assertLess(time.time() - time_start, 1.5)
+        for job in jobs:
+            self.assertEqual(job.result(), (0, ['done\n'], []))
+
+    def test_loop_deadline_cancel(self):
+        loop = process.CmdLoop()
+        forever = [sys.executable, '-c', 'import time; time.sleep(30)']
+        job_timeout = util.cli_cmd_async(forever, loop=loop, timeout=0.3)
+        job_cancel = util.cli_cmd_async(forever, loop=loop)
+        job_cancel.cancel()
+
+        time_start = time.time()
+        loop.run()
+        self.assertLess(time.time() - time_start, 5)
+        self.assertTrue(job_timeout.timed_out)
+        self.assertTrue(job_cancel.cancelled)
+        self.assertFalse(job_cancel.timed_out)
+        self.assertNotEqual(job_timeout.returncode, 0)
+
+    def test_loop_feeder(self):
+        script = 'import sys\n' \
+                 'sys.stdout.write("Password:\\n"); sys.stdout.flush()\n' \
+                 'sys.stdout.write(sys.stdin.read())\n'
+
+        def answer(out, feeder, p, *args, **kwargs):
+            if 'Password:' in out:
+                feeder.feed('0000\n' * 50000)
+                feeder.close()
+
+        job = util.cli_cmd_async([sys.executable, '-c', script], on_out=answer)
+        self.assertEqual(job.wait(), 0)
+        self.assertEqual(len(job.out_acc), 50001)
+
+    def test_capture_budget(self):
+        script = 'for i in range(10000): print("line %d" % i)\nprint("BUILD SUCCESSFUL")'
+        capture = process.OutputCapture(max_lines=10, max_bytes=60)
+        hits = []
+        capture.watch(r'line 5\d\d\d$', callback=lambda m, line: hits.append(line))
+        capture.watch(r'BUILD (\w+)', name='build')
+
+        ret, out, err = util.cli_cmd_sync([sys.executable, '-c', script], out_capture=capture)
+        self.assertEqual(ret, 0)
+        self.assertEqual(len(hits), 1000)
+        self.assertEqual(capture.get_match('build').group(1), 'SUCCESSFUL')
+        self.assertEqual(capture.total_lines, 10001)
+        self.assertTrue(capture.is_truncated())
+        self.assertLessEqual(sum(len(x) for x in out), 60)
+        self.assertEqual(out[-1], 'BUILD SUCCESSFUL\n')
+
+    def test_responder_partial_prompt(self):
+        # Prompts without newline, the process blocks until answered
+        script = 'import sys\n' \
+                 'sys.stdout.write("[input] Please enter the superadmin password: "); sys.stdout.flush()\n' \
+                 'a = sys.stdin.readline().strip()\n' \
+                 'sys.stderr.write("Password:"); sys.stderr.flush()\n' \
+                 'b = sys.stdin.readline().strip()\n' \
+                 'sys.stdout.write("\\nPlease enter other [x]\\n"); sys.stdout.flush()\n' \
+                 'c = sys.stdin.readline().strip()\n' \
+                 'sys.stdout.write("got %s,%s,%s\\n" % (a, b, c))\n'
+
+        responder = process.PromptResponder([
+            process.PromptRule(text='the superadmin password', response='super\n'),
+            process.PromptRule(text='Password:', response='0000\n'),
+            process.PromptRule(prefix='Please enter', response=lambda line, feeder, p: 'default\n'),
+            process.PromptRule(prefix='[input] Please enter', response='wrong\n'),
+        ])
+
+        job = util.cli_cmd_async([sys.executable, '-c', script], responder=responder, timeout=10)
+        self.assertEqual(job.wait(), 0)
+        self.assertFalse(job.timed_out)
+        self.assertEqual(job.out_acc[-1], 'got super,0000,default\n')
+
+    def test_responder_priority(self):
+        responder = process.PromptResponder([
+            process.PromptRule(text='truststore', response='a'),
+            process.PromptRule(prefix='[input] Please enter', response='b'),
+            process.PromptRule(regex=r'^\{', response='c', line_only=True),
+        ])
+        self.assertEqual(responder.match('  [input] Please enter the truststore pass').response, 'a')
+        self.assertEqual(responder.match('[input] Please enter value').response, 'b')
+        self.assertEqual(responder.match('{"cmd": 1}').response, 'c')
+        self.assertIsNone(responder.match('{"cmd": 1}', partial=True))
+        self.assertIsNone(responder.match('nothing here'))
+
+    def test_stats(self):
+        stats = process.StatsCollector()
+        script = 'import sys; x = "a" * (20 * 1024 * 1024); sys.stdout.write("o" * 1000); sys.stderr.write("e" * 10)'
+        runner = process.CmdRunner([sys.executable, '-c', script], label='test', stats_collector=stats)
+        runner.run()
+
+        self.assertEqual(len(stats.get_records('test')), 1)
+        rec = runner.stats
+        self.assertEqual(rec.returncode, 0)
+        self.assertEqual(rec.out_bytes, 1000)
+        self.assertEqual(rec.err_bytes, 10)
+        self.assertGreater(rec.wall, 0)
+        self.assertIsNotNone(rec.utime)
+        self.assertGreater(rec.maxrss, 20 * 1024)
+        self.assertEqual(stats.summary()['test']['count'], 1)
+
+        ret, out, err = util.cli_cmd_sync([sys.executable, '-c', 'import sys; sys.exit(2)'], label='exit')
+        self.assertEqual(ret, 2)
+        self.assertEqual(process.collector.get_records('exit')[-1].returncode, 2)
+
+    def test_daemonized_grandchild(self):
+        # Grandchild inherits stdout/stderr and outlives the command, like standalone.sh started by jboss scripts
+        script = 'import subprocess, sys\n' \
+                 'subprocess.Popen([sys.executable, "-c", "import time; time.sleep(30)"])\n' \
+                 'sys.stdout.write("started\\n")\n' \
+                 'sys.exit(4)\n'
+        job = process.CmdJob([sys.executable, '-c', script])
+        job.DRAIN_TIMEOUT = 0.2
+
+        time_start = time.time()
+        self.assertEqual(job.wait(), 4)
+        self.assertLess(time.time() - time_start, 5)
+        self.assertEqual(job.result()[1], ['started\n'])
+
+    def test_run_as(self):
+        run_as = process.RunAs()
+        self.assertTrue(run_as.is_current())
+        self.assertEqual(run_as.get_env({'PATH': '/bin'})['USER'], run_as.user)
+        p = run_as.popen(['/bin/sh', '-c', 'echo $USER'], stdout=subprocess.PIPE)
+        self.assertEqual(p.communicate()[0], '%s\n' % run_as.user)
+
+        if os.geteuid() != 0:
+            self.skipTest('Requires root')
+
+        nobody = process.RunAs('nobody')
+        ret, out, err = util.cli_cmd_sync(['/bin/sh', '-c', 'echo $(id -u) $(id -g) $HOME'], run_as=nobody, cwd='/')
+        self.assertEqual(ret, 0)
+        self.assertEqual(out, ['%d %d %s\n' % (nobody.uid, nobody.gid, nobody.home)])
+
+
+if __name__ == '__main__':
+    unittest.main()
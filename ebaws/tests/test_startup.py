@@ -0,0 +1,74 @@
+import os
+import subprocess
+import sys
+import time
+import unittest
+
+
+__author__ = 'dusanklinec'
+
+
+# Modules only the commands doing the actual work may load.
+# ebclient.eb_configuration (with Crypto) is loaded by config for the EBEndpoint base class.
+HEAVY_MODULES = ['OpenSSL', 'cryptography', 'requests', 'sarge', 'psutil', 'certbot_external_auth',
+                 'certbot', 'ebclient.eb_registration', 'pkg_resources']
+
+# Wall time budget of the light commands, best of the runs, seconds
+STARTUP_BUDGET = 1.0
+STARTUP_RUNS = 3
+
+STARTUP_CODE = """
+import atexit, sys
+atexit.register(lambda: sys.stderr.write('##MODULES ' + ','.join(sorted(k for k, v in sys.modules.items() if v)) + '\\n'))
+sys.argv = ['ebaws-cli', '-n'] + sys.argv[1:]
+from ebaws import launcher
+launcher.main()
+"""
+
+
+class StartupTest(unittest.TestCase):
+    """Start-up cost of the ebaws-cli entry point"""
+
+    def run_cli(self, *args):
+        """
+        Runs the entry point in a fresh interpreter
+        :return: (return code, wall time, loaded modules)
+        """
+        cwd = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        time_start = time.time()
+        p = subprocess.Popen([sys.executable, '-W', 'ignore', '-c', STARTUP_CODE] + list(args), cwd=cwd,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = p.communicate()
+        elapsed = time.time() - time_start
+
+        modules = []
+        for line in err.splitlines():
+            if line.startswith('##MODULES '):
+                modules = line[len('##MODULES '):].split(',')
+        return p.returncode, elapsed, modules
+
+    def check_light(self, cmd):
+        timings = []
+        for _ in range(STARTUP_RUNS):
+            ret, elapsed, modules = self.run_cli(cmd)
+            self.assertEqual(ret, 0)
+            self.assertTrue(len(modules) > 0)
+            loaded = [x for x in HEAVY_MODULES if x in modules]
+            self.assertEqual(loaded, [], 'Heavy modules loaded by %s: %s' % (cmd, loaded))
+            timings.append(elapsed)
+        self.assertLess(min(timings), STARTUP_BUDGET, '%s took %.3f s' % (cmd, min(timings)))
+
+    def test_version(self):
+        self.check_light('version')
+
+    def test_usage(self):
+        self.check_light('usage')
+
+    def test_endpoint_alias(self):
+        from ebaws.config import EBEndpoint
+        from ebaws import registration
+        self.assertIs(EBEndpoint, registration.EBEndpoint)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,153 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from ebaws import tasks
+
+
+__author__ = 'dusanklinec'
+
+
+class TaskGraphTest(unittest.TestCase):
+    """Dependency graph task scheduler"""
+
+    def test_parallel_and_order(self):
+        order = []
+
+        def sleeper(name, key):
+            def fnc(ctx):
+                time.sleep(0.3)
+                order.append(name)
+                ctx[key] = name
+            return fnc
+
+        def join(ctx):
+            order.append('join')
+            ctx['joined'] = (ctx['a'], ctx['b'], threading.current_thread().name)
+
+        graph = tasks.TaskGraph()
+        graph.add('join', join, inputs=['a', 'b'], outputs=['joined'], interactive=True)
+        graph.add('a', sleeper('a', 'a'), outputs=['a'])
+        graph.add('b', sleeper('b', 'b'), outputs=['b'])
+
+        time_start = time.time()
+        ctx = {}
+        self.assertEqual(graph.run(ctx), 0)
+        self.assertLess(time.time() - time_start, 0.55)
+        self.assertEqual(order[-1], 'join')
+        self.assertEqual(ctx['joined'], ('a', 'b', threading.current_thread().name))
+        self.assertGreaterEqual(graph.get_task('a').duration, 0.3)
+        self.assertIn('total', graph.format_report())
+
+    def test_failure_stops_dependents(self):
+        graph = tasks.TaskGraph()
+        graph.add('fail', lambda ctx: 10, outputs=['x'])
+        graph.add('next', lambda ctx: ctx.update(y=1), inputs=['x'], outputs=['y'])
+        self.assertEqual(graph.run({}), 10)
+        self.assertEqual(graph.get_task('fail').state, tasks.Task.FAILED)
+        self.assertEqual(graph.get_task('next').state, tasks.Task.SKIPPED)
+
+    def test_exception_and_validation(self):
+        def boom(ctx):
+            raise KeyError('boom')
+
+        graph = tasks.TaskGraph()
+        graph.add('boom', boom)
+        self.assertRaises(KeyError, graph.run, {})
+
+        graph = tasks.TaskGraph()
+        graph.add('a', lambda ctx: 0, inputs=['b'], outputs=['a'])
+        graph.add('b', lambda ctx: 0, inputs=['a'], outputs=['b'])
+        self.assertRaises(ValueError, graph.run, {})
+
+        graph = tasks.TaskGraph()
+        graph.add('a', lambda ctx: 0, inputs=['missing'])
+        self.assertRaises(ValueError, graph.run, {})
+
+    def test_journal_resume(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'journal-test.json')
+        calls = []
+        fail = {'install': True}
+
+        def step(name, key, value):
+            def fnc(ctx):
+                calls.append(name)
+                if fail.get(name):
+                    return 3
+                ctx[key] = value
+            return fnc
+
+        def build(arg):
+            journal = tasks.TaskJournal(path)
+            journal.load()
+            graph = tasks.TaskGraph(journal=journal)
+            graph.add('prepare', step('prepare', 'prepared', True), checkpoint=True)
+            graph.add('register', step('register', 'identity', {'user': arg}), inputs=['arg'],
+                      outputs=['identity'], checkpoint=True)
+            graph.add('config', step('config', 'config', object()), inputs=['identity'], outputs=['config'],
+                      checkpoint=True, restore=lambda ctx: ctx.update(config='restored'))
+            graph.add('install', step('install', 'installed', True), inputs=['config'], outputs=['installed'],
+                      checkpoint=True, invalidates=['prepare'])
+            graph.add('check', step('check', 'checked', True), inputs=['installed'], outputs=['checked'])
+            return journal, graph
+
+        journal, graph = build('a')
+        self.assertEqual(graph.run({'arg': 'a'}), 3)
+        self.assertEqual(sorted(calls[:2]), ['prepare', 'register'])
+        self.assertEqual(calls[2:], ['config', 'install'])
+
+        # Continues from the failed step, invalidated step is executed again
+        fail['install'] = False
+        del calls[:]
+        journal, graph = build('a')
+        self.assertTrue(journal.is_unfinished())
+        self.assertEqual(journal.get_failed_step(), 'install')
+        ctx = {'arg': 'a'}
+        self.assertEqual(graph.run(ctx), 0)
+        self.assertEqual(sorted(calls), ['check', 'install', 'prepare'])
+        self.assertEqual(graph.get_task('register').state, tasks.Task.RESTORED)
+        self.assertEqual(ctx['identity'], {'user': 'a'})
+        self.assertEqual(ctx['config'], 'restored')
+        self.assertFalse(journal.is_unfinished())
+
+        # Changed input, the step and its dependents are executed again
+        fail['install'] = True
+        os.remove(path)
+        self.assertEqual(build('a')[1].run({'arg': 'a'}), 3)
+        del calls[:]
+        self.assertEqual(build('b')[1].run({'arg': 'b'}), 3)
+        self.assertEqual(sorted(calls[:2]), ['prepare', 'register'])
+        self.assertEqual(calls[2:], ['config', 'install'])
+
+    def test_optional(self):
+        graph = tasks.TaskGraph()
+        graph.add('opt', lambda ctx: ctx.update(x=False) or 2, outputs=['x'], optional=True)
+        graph.add('next', lambda ctx: ctx.update(y=1), inputs=['x'], outputs=['y'])
+        self.assertEqual(graph.run({}), 0)
+        self.assertEqual(graph.get_task('opt').code, 2)
+        self.assertEqual(graph.get_task('next').state, tasks.Task.DONE)
+
+    def test_optional_journal(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'journal-test.json')
+        journal = tasks.TaskJournal(path)
+        graph = tasks.TaskGraph(journal=journal)
+        graph.add('install', lambda ctx: ctx.update(x=True), outputs=['x'], checkpoint=True)
+        graph.add('opt', lambda ctx: 2, inputs=['x'], checkpoint=True, optional=True)
+        self.assertEqual(graph.run({}), 0)
+
+        # Failed optional step does not leave the workflow unfinished
+        journal = tasks.TaskJournal(path)
+        self.assertTrue(journal.load())
+        self.assertFalse(journal.is_unfinished())
+        self.assertIsNone(journal.get_failed_step())
+        self.assertEqual(journal.get_warnings(), ['opt'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import threading
+import time
+import unittest
+from ebaws import util
+
+
+__author__ = 'dusanklinec'
+
+
+class WaitUntilTest(unittest.TestCase):
+    """Readiness waits"""
+
+    def test_backoff_deadline(self):
+        calls = []
+        time_start = time.time()
+        res = util.wait_until(lambda: calls.append(time.time()), timeout=0.5, interval=0.05, backoff=2.0)
+        self.assertFalse(res)
+        self.assertLess(time.time() - time_start, 1.0)
+        self.assertTrue(3 <= len(calls) <= 6)
+
+    def test_attempts_and_value(self):
+        calls = []
+        res = util.wait_until(lambda: len(calls) >= 2 or calls.append(1), timeout=None, interval=0.01, attempts=5)
+        self.assertTrue(res)
+        self.assertEqual(len(calls), 2)
+        self.assertFalse(util.wait_until(lambda: False, timeout=None, interval=0.01, attempts=3))
+
+    def test_event_wakeup(self):
+        event = threading.Event()
+        flag = []
+
+        def trigger():
+            flag.append(1)
+            event.set()
+
+        timer = threading.Timer(0.2, trigger)
+        timer.start()
+
+        time_start = time.time()
+        res = util.wait_until(lambda: len(flag) > 0, timeout=10, interval=5, event=event)
+        self.assertTrue(res)
+        self.assertLess(time.time() - time_start, 2)
+
+    def test_dummy_server(self):
+        server = util.DummyTCPServer(('127.0.0.1', 0))
+        server.start()
+        try:
+            self.assertTrue(server.wait_ready())
+            port = server.server.server_address[1]
+            self.assertTrue(util.is_port_listening('127.0.0.1', port))
+            self.assertTrue(util.test_port_open('127.0.0.1', port, timeout=2, attempts=2))
+        finally:
+            server.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
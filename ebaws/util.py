@@ -12,18 +12,14 @@ import stat
 import subprocess
 import sys
 import errors
+import process
+import portprobe
 import shutil
 import random
 import string
 import pwd
 import grp
-import OpenSSL
 import binascii
-from cryptography.hazmat.backends import default_backend
-from Crypto.PublicKey import RSA
-from cryptography.hazmat.primitives import serialization
-from cryptography.x509.base import load_pem_x509_certificate
-from sarge import run, Capture, Feeder
 from datetime import datetime
 import time
 import types
@@ -36,25 +32,28 @@ import hmac
 logger = logging.getLogger(__name__)
 
 
-def run_script(params, shell=False):
+def run_script(params, shell=False, run_as=None):
     """Run the script with the given params.
 
     :param list params: List of parameters to pass to Popen
+    :param run_as: process.RunAs identity to run the script under
 
     """
+    out, err = [], []
+    runner = process.CmdRunner(params, shell=shell, on_out=out.append, on_err=err.append, label='script',
+                                run_as=run_as)
     try:
-        proc = subprocess.Popen(params, shell=shell,
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE)
+        runner.start()
 
     except (OSError, ValueError):
         msg = "Unable to run the command: %s" % " ".join(params)
         logger.error(msg)
         raise errors.SubprocessError(msg)
 
-    stdout, stderr = proc.communicate()
+    runner.wait()
+    stdout, stderr = ''.join(out), ''.join(err)
 
-    if proc.returncode != 0:
+    if runner.process.returncode != 0:
         msg = "Error while running %s.\n%s\n%s" % (
             " ".join(params), stdout, stderr)
         # Enter recovery routine...
@@ -245,6 +244,31 @@ def safe_open(path, mode="w", chmod=None, buffering=None):
         mode, *fdopen_args)
 
 
+def write_atomic(path, data, chmod=0o600):
+    """
+    Writes the file atomically - temporary file in the same directory renamed over the path,
+    readers never see a partially written file.
+
+    :param path:
+    :param data:
+    :param chmod:
+    :return: path
+    """
+    fhnd, tmp_path = unique_file(os.path.join(os.path.dirname(os.path.abspath(path)),
+                                              '.%s.tmp' % os.path.basename(path)), chmod)
+    try:
+        with fhnd:
+            fhnd.write(data)
+            fhnd.flush()
+            os.fsync(fhnd.fileno())
+        os.rename(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return path
+
+
 def safe_new_dir(path, mode=0o755):
     """
     Creates a new unique directory. If the given directory already exists,
@@ -388,6 +412,7 @@ def gen_ss_cert(key, domains, not_before=None,
     extension is used, unless `force_san` is ``True``.
 
     """
+    import OpenSSL
     assert domains, "Must provide one or more hostnames for the cert."
     cert = OpenSSL.crypto.X509()
     cert.set_serial_number(int(binascii.hexlify(OpenSSL.rand.bytes(16)), 16))
@@ -420,120 +445,103 @@ def gen_ss_cert(key, domains, not_before=None,
 
 
 def get_backend(backend=None):
+    from cryptography.hazmat.backends import default_backend
     return default_backend() if backend is None else backend
 
 
 def load_x509(data, backend=None):
+    from cryptography.x509 import load_pem_x509_certificate
     backend = get_backend(backend)
     return load_pem_x509_certificate(data, backend)
 
 
 def load_pem_private_key(data, password=None, backend=None):
+    from cryptography.hazmat.primitives import serialization
     return serialization.load_pem_private_key(data, None, get_backend(backend))
 
 
 def load_pem_private_key_pycrypto(data, password=None):
+    from Crypto.PublicKey import RSA
     return RSA.importKey(data, passphrase=password)
 
 
-def cli_cmd_sync(cmd, log_obj=None, write_dots=False, on_out=None, on_err=None, cwd=None):
+def _cli_cmd_log(log_obj):
     """
-    Runs command line task synchronously
-    :return:
+    Opens the command log - either filename or logger itself.
+    :return: (log, close_log)
     """
-    feeder = Feeder()
-    p = run(cmd,
-            input=feeder, async=True,
-            stdout=Capture(buffer_size=1),
-            stderr=Capture(buffer_size=1),
-            cwd=cwd)
-
-    out_acc = []
-    err_acc = []
-    ret_code = 1
-    log = None
-    close_log = False
-
-    # Logging - either filename or logger itself
-    if log_obj is not None:
-        if isinstance(log_obj, types.StringTypes):
-            delete_file_backup(log_obj, chmod=0o600)
-            log = safe_open(log_obj, mode='w', chmod=0o600)
-            close_log = True
-        else:
-            log = log_obj
+    if log_obj is None:
+        return None, False
+    if isinstance(log_obj, types.StringTypes):
+        delete_file_backup(log_obj, chmod=0o600)
+        return safe_open(log_obj, mode='w', chmod=0o600), True
+    return log_obj, False
+
+
+def cli_cmd_sync(cmd, log_obj=None, write_dots=False, on_out=None, on_err=None, cwd=None, shell=False, env=None,
+                 out_capture=None, err_capture=None, responder=None, label=None, run_as=None):
+    """
+    Runs command line task synchronously.
+    Output pipes are processed by the event driven engine, callbacks are called for each output line
+    as on_out(line, feeder, p). Feeder can be used to answer the process prompts.
 
+    By default the whole output is returned. With out_capture / err_capture (process.OutputCapture)
+    only the bounded tail is kept and returned, the capture watchers see every line.
+
+    Responder (process.PromptResponder) answers prompts on the raw output as it arrives,
+    prompts not terminated by a newline included.
+
+    Resource usage of the command is recorded to process.collector under the given label.
+    Command given as a list is executed directly, run_as (process.RunAs) switches the user in the child.
+
+    :return: (return code, stdout lines, stderr lines)
+    """
+    from sarge import Feeder
+    log, close_log = _cli_cmd_log(log_obj)
+    job = process.CmdJob(cmd, on_out=on_out, on_err=on_err, feeder=Feeder(), log=log, write_dots=write_dots,
+                         cwd=cwd, env=env, shell=shell, out_capture=out_capture, err_capture=err_capture,
+                         responder=responder, label=label, run_as=run_as)
     try:
-        while len(p.commands) == 0:
-            time.sleep(0.15)
-
-        while p.commands[0].returncode is None:
-            out = p.stdout.readline()
-            err = p.stderr.readline()
-
-            # If output - react on input challenges
-            if out is not None and len(out) > 0:
-                out_acc.append(out)
-
-                if log is not None:
-                    log.write(out)
-                    log.flush()
-
-                if write_dots:
-                    sys.stderr.write('.')
-
-                if on_out is not None:
-                    on_out(out, feeder, p)
-
-            # Collect error
-            if err is not None and len(err) > 0:
-                err_acc.append(err)
-
-                if log is not None:
-                    log.write(err)
-                    log.flush()
-
-                if write_dots:
-                    sys.stderr.write('.')
-
-                if on_err is not None:
-                    on_err(err, feeder, p)
-
-            p.commands[0].poll()
-            time.sleep(0.01)
-
-        ret_code = p.commands[0].returncode
-
-        # Collect output to accumulator
-        rest_out = p.stdout.readlines()
-        if rest_out is not None and len(rest_out) > 0:
-            for out in rest_out:
-                out_acc.append(out)
-                if log is not None:
-                    log.write(out)
-                    log.flush()
-                if on_out is not None:
-                    on_out(out, feeder, p)
-
-        # Collect error to accumulator
-        rest_err = p.stderr.readlines()
-        if rest_err is not None and len(rest_err) > 0:
-            for err in rest_err:
-                err_acc.append(err)
-                if log is not None:
-                    log.write(err)
-                    log.flush()
-                if on_err is not None:
-                    on_err(err, feeder, p)
-
-        return ret_code, out_acc, err_acc
+        job.start()
+        job.wait()
+        return job.result()
 
     finally:
-        feeder.close()
+        job.feeder.close()
         if close_log:
             log.close()
 
 
+def cli_cmd_async(cmd, loop=None, log_obj=None, write_dots=False, on_out=None, on_err=None, cwd=None, shell=False,
+                  env=None, timeout=None, out_capture=None, err_capture=None, responder=None, label=None,
+                  run_as=None):
+    """
+    Schedules command line task in the event loop, returns immediately.
+    Several commands can run concurrently in one loop, the loop is driven by loop.run() or job.wait().
+    Callbacks have the same contract as in cli_cmd_sync, the feeder is non-blocking (answers are queued).
+
+    :param loop: CmdLoop to schedule the job to, new loop is created if None
+    :param timeout: deadline in seconds, process is terminated after it elapses
+    :return: CmdJob, job.result() gives (return code, stdout lines, stderr lines) when done
+    """
+    log, close_log = _cli_cmd_log(log_obj)
+
+    def on_done(job):
+        if close_log:
+            log.close()
+
+    job = process.CmdJob(cmd, on_out=on_out, on_err=on_err, log=log, write_dots=write_dots, timeout=timeout,
+                         on_done=on_done, cwd=cwd, env=env, shell=shell,
+                         out_capture=out_capture, err_capture=err_capture, responder=responder, label=label,
+                         run_as=run_as)
+    try:
+        (loop if loop is not None else process.CmdLoop()).add(job)
+    except:
+        on_done(job)
+        raise
+    return job
+
+
 def get_file_mtime(file):
     return os.path.getmtime(file)
 
@@ -694,6 +702,86 @@ def get_utc_sec():
     return time.time()
 
 
+def wait_until(predicate, timeout=60, interval=0.1, max_interval=5, backoff=2.0, attempts=None, event=None):
+    """
+    Waits until the predicate returns a true value.
+    Predicate is polled with exponential backoff until the overall deadline elapses.
+    The wait between polls is interrupted when the event (threading.Event) gets set,
+    so event sources (socket accept, file appearance, log line) wake the waiter immediately.
+
+    :param predicate: readiness check, called without arguments
+    :param timeout: overall deadline in seconds, None for no deadline
+    :param interval: initial poll interval
+    :param max_interval: poll interval cap
+    :param backoff: poll interval multiplier
+    :param attempts: maximal number of predicate calls, None for unlimited
+    :param event: optional threading.Event
+    :return: the last predicate result (false on timeout)
+    """
+    deadline = time.time() + timeout if timeout is not None else None
+    idx = 0
+    while True:
+        res = predicate()
+        idx += 1
+        if res:
+            return res
+        if attempts is not None and idx >= attempts:
+            return res
+
+        wait = interval
+        if deadline is not None:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return res
+            wait = min(wait, remaining)
+
+        if event is not None:
+            if event.is_set():
+                event.clear()   # consumed, did not make the predicate true
+            event.wait(wait)
+        else:
+            time.sleep(wait)
+        interval = min(interval * backoff, max_interval)
+
+
+def wait_for_file(path, timeout=60, interval=0.1, max_interval=2):
+    """
+    Waits until the file appears
+    :return: True if the file exists
+    """
+    return wait_until(lambda: os.path.exists(path), timeout=timeout, interval=interval, max_interval=max_interval)
+
+
+def is_port_listening(host='127.0.0.1', port=80, timeout=1):
+    """
+    Quick check whether something accepts connections on the port
+    :return:
+    """
+    sock = None
+    try:
+        sock = socket.create_connection((host, port), timeout=timeout)
+        return True
+    except:
+        return False
+    finally:
+        silent_close(sock)
+
+
+def pid_running(pid):
+    """
+    Returns True if the process with the given pid exists
+    :param pid:
+    :return:
+    """
+    if pid is None:
+        return False
+    try:
+        os.kill(pid, 0)
+        return True
+    except OSError as e:
+        return e.errno == errno.EPERM
+
+
 def silent_close(c):
     try:
         if c is not None:
@@ -706,46 +794,22 @@ def hmac_obj(key, data):
     return hmac.new(key, data, hashlib.sha256)
 
 
-def test_port_open(host='127.0.0.1', port=80, timeout=15, attempts=3, test_upper_read_write=True):
+def test_port_open(host='127.0.0.1', port=80, timeout=15, attempts=3, test_upper_read_write=True, stagger=1.0):
     """
     Test if the given port is open on the TCP.
+    Attempts are staggered, not sequential - the next one starts without waiting for the previous one to time out.
 
     :param host:
     :param port:
     :param attempts:
     :param timeout:
+    :param test_upper_read_write: the peer has to echo the nonce upper-cased (DummyTCPServer)
+    :param stagger: delay between the attempt starts
     :return:
     """
-    idx = 0
-    while idx < attempts:
-        sock = None
-        try:
-            sock = socket.create_connection((host, port), timeout=timeout)
-
-            # read/write test on the dummy server - our.
-            if test_upper_read_write:
-                random_nonce = 'ebaws-letsencrypt-test-' + (random_password(32).lower())
-
-                sock.sendall(random_nonce)
-                read_data = sock.recv(4096)
-                if read_data is None or len(read_data) == 0:
-                    raise ValueError('Data read from the socket is empty')
-                if read_data.strip() != random_nonce.upper().strip():
-                    raise ValueError('Data read from the socket do not match the expectations')
-            
-            silent_close(sock)
-            sock = None
-            return True
-
-        except:
-            time.sleep(1)
-            pass
-
-        finally:
-            idx += 1
-            silent_close(sock)
-
-    return False
+    results = portprobe.probe_ports([(host, port)], timeout=timeout, attempts=attempts, stagger=stagger,
+                                    echo_check=test_upper_read_write)
+    return bool(results[(host, port)].ok) if (host, port) in results else False
 
 
 class DummyTCPHandler(socketserver.BaseRequestHandler):
@@ -771,6 +835,7 @@ class DummyTCPServer(object):
         self.address = address
         self.server = socketserver.TCPServer(self.address, DummyTCPHandler, False)
         self.thread = None
+        self.ready = threading.Event()
 
     def start(self):
         """
@@ -781,11 +846,22 @@ class DummyTCPServer(object):
         self.server.server_bind()     # Manually bind, to support allow_reuse_address
         self.server.server_activate() #
 
-        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread = threading.Thread(target=self.serve)
         self.thread.setDaemon(True)
         self.thread.start()
         return self
 
+    def serve(self):
+        self.ready.set()
+        self.server.serve_forever()
+
+    def wait_ready(self, timeout=5):
+        """
+        Waits until the server thread is accepting connections
+        :return:
+        """
+        return wait_until(self.ready.is_set, timeout=timeout, event=self.ready)
+
     def close(self):
         """
         Shuts down the server
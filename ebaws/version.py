@@ -0,0 +1,4 @@
+__author__ = 'dusanklinec'
+
+# Single source of the package version, read by setup.py and the cli without pkg_resources
+__version__ = '0.1.4'
@@ -1,16 +1,20 @@
+import os
+import re
 import sys
 
 from setuptools import setup
 from setuptools import find_packages
 
-version = '0.1.4'
+# Version is kept in ebaws/version.py, the cli reads it without pkg_resources
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ebaws', 'version.py')) as fh:
+    version = re.search(r"^__version__ = '([^']+)'", fh.read(), re.M).group(1)
 
 # Please update tox.ini when modifying dependency version requirements
 install_requires = [
     'ebclient.py>=0.1.15',
     'cmd2>=0.6.9',
     'pycrypto>=2.6',
-    'cryptography>=0.7',   # load_pem_x509_certificate
+    'cryptography>=3.0',   # pkcs12.serialize_key_and_certificates
     'parsedatetime>=1.3',  # Calendar.parseDT
     'PyOpenSSL',
     'requests',
@@ -86,7 +90,7 @@ setup(
 
     entry_points={
         'console_scripts': [
-            'ebaws-cli = ebaws.cli:main',
+            'ebaws-cli = ebaws.launcher:main',
         ],
     }
 )